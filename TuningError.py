@@ -1,2 +1,6 @@
 class TuningError(Exception):
+    pass
+
+
+class SessionInterrupted(TuningError):
     pass
\ No newline at end of file
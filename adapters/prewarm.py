@@ -0,0 +1,169 @@
+import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pg_executor import QueryError
+
+EXTENSIONS = ("pg_buffercache", "pg_prewarm")
+FORKS = {0: "main", 1: "fsm", 2: "vm"}
+# share of the new shared_buffers filled by the prewarm, the rest is left to the workload
+BUDGET_FRACTION = 0.75
+MAX_WORKERS = 4
+# a worker per this many blocks to load (1GB of 8kB blocks)
+BLOCKS_PER_WORKER = 131072
+# blocks loaded by one statement, keeps each well within the executor's query timeout
+BATCH_BLOCKS = 16384
+
+# contiguous runs of cached blocks of this database's relations and the shared catalogs, hottest first
+CACHED_RANGES = """WITH blocks AS (
+        SELECT c.oid AS relation, b.relforknumber AS fork, b.relblocknumber AS block, b.usagecount AS usage
+        FROM pg_buffercache b JOIN pg_class c ON b.relfilenode = pg_relation_filenode(c.oid)
+        WHERE b.reldatabase IN (0, (SELECT oid FROM pg_database WHERE datname = current_database())) AND b.relforknumber IN (0, 1, 2)),
+    runs AS (SELECT *, block - row_number() OVER (PARTITION BY relation, fork ORDER BY block) AS run FROM blocks)
+    SELECT relation, fork, min(block), max(block) FROM runs GROUP BY relation, fork, run
+    ORDER BY avg(usage) DESC, relation, fork, min(block)"""
+# relations dropped or truncated since the snapshot are skipped or clamped to their current size
+LOAD_RANGES = """SELECT coalesce(sum(pg_prewarm(r.relation::regclass, 'buffer', r.fork, r.first_block,
+                                              least(r.last_block, pg_relation_size(r.relation::regclass, r.fork) / current_setting('block_size')::bigint - 1))), 0)
+    FROM (VALUES {}) AS r(relation, fork, first_block, last_block)
+    WHERE r.first_block < pg_relation_size(r.relation::regclass, r.fork) / current_setting('block_size')::bigint"""
+
+
+def drop_extensions(executor, names):
+    for name in names:
+        try:
+            executor.execute("DROP EXTENSION IF EXISTS {}".format(name))
+        except QueryError:
+            pass
+
+
+def remove_leftovers(executor, session_state):
+    """Drops the extensions an earlier run's prewarm created and never got to remove."""
+    leftovers = session_state.get("prewarm_extensions")
+    if leftovers:
+        logging.info("Prewarm: dropping the {} extensions an earlier run left".format(" and ".join(leftovers)))
+        drop_extensions(executor, leftovers)
+        session_state.save(prewarm_extensions=[])
+
+
+def batches(ranges, budget):
+    """Splits the hottest ranges that fit in budget blocks into batches of at most BATCH_BLOCKS blocks."""
+    batch, batch_blocks = [], 0
+    for relation, fork, first, last in ranges:
+        while first <= last and budget > 0:
+            blocks = min(last - first + 1, BATCH_BLOCKS - batch_blocks, budget)
+            batch.append((relation, fork, first, first + blocks - 1))
+            first += blocks
+            budget -= blocks
+            batch_blocks += blocks
+            if batch_blocks == BATCH_BLOCKS:
+                yield batch
+                batch, batch_blocks = [], 0
+    if batch:
+        yield batch
+
+
+class BufferCachePrewarm:
+    """Reloads the blocks that were in shared buffers before a restart, so the warmup starts warm.
+
+    The cached block ranges are read from pg_buffercache before postgres goes down
+    and loaded with pg_prewarm once it is back, hottest first, by a few parallel
+    sessions, up to a share of the new shared_buffers. Loading runs in the
+    background while the workload reconnects; wait() returns what it did. The
+    extensions it creates are listed in the session state before they are
+    created, so a run that ends without remove() leaves them for the next to drop.
+    """
+
+    def __init__(self, executor, executor_factory, clock, session_state):
+        self.executor = executor
+        self.executor_factory = executor_factory
+        self.clock = clock
+        self.session_state = session_state
+        self.ranges = []
+        # an interrupted run's extensions are this one's to remove
+        self.created = list(session_state.get("prewarm_extensions", []))
+        self.loading = None
+        self.enabled = self.enable()
+
+    def enable(self):
+        try:
+            # autoprewarm already reloads the buffers by itself
+            if self.executor.query_value("SELECT current_setting('pg_prewarm.autoprewarm', true)") == "on":
+                logging.info("Prewarm: autoprewarm is on, leaving the prewarm to it")
+                return False
+            available = {name for name, in self.executor.query("SELECT name FROM pg_available_extensions WHERE name IN {}".format(EXTENSIONS))}
+            if available != set(EXTENSIONS):
+                logging.warning("Prewarm: needs the {} extensions, disabled".format(" and ".join(EXTENSIONS)))
+                return False
+            installed = {name for name, in self.executor.query("SELECT extname FROM pg_extension WHERE extname IN {}".format(EXTENSIONS))}
+            for name in EXTENSIONS:
+                if name not in installed:
+                    if name not in self.created:
+                        self.created.append(name)
+                        self.session_state.save(prewarm_extensions=self.created)
+                    self.executor.execute("CREATE EXTENSION {}".format(name))
+        except QueryError as err:
+            logging.warning("Prewarm: couldn't set up the extensions ({}), disabled".format(err))
+            return False
+        return True
+
+    def snapshot(self):
+        if not self.enabled:
+            return
+        try:
+            self.ranges = [(int(relation), int(fork), int(first), int(last)) for relation, fork, first, last in self.executor.query(CACHED_RANGES)]
+        except QueryError as err:
+            logging.warning("Prewarm: couldn't read the cached blocks ({})".format(err))
+            self.ranges = []
+        logging.debug("Prewarm: {} cached block ranges".format(len(self.ranges)))
+
+    def start(self):
+        if not self.enabled or not self.ranges:
+            return
+        runner = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dbtune-prewarm")
+        self.loading = runner.submit(self.load)
+        runner.shutdown(wait=False)
+
+    def wait(self):
+        if self.loading is None:
+            return {}
+        loading, self.loading = self.loading, None
+        try:
+            return loading.result()
+        except Exception as err:
+            logging.warning("Prewarm: failed ({})".format(err))
+            return {}
+
+    def load(self):
+        started = self.clock.monotonic()
+        # taken whether or not the load succeeds, ranges from before an earlier restart would be stale
+        ranges, self.ranges = self.ranges, []
+        shared_buffers = self.executor.query_value("SELECT setting FROM pg_settings WHERE name = 'shared_buffers'", int)
+        budget = int(shared_buffers * BUDGET_FRACTION)
+        work = list(batches(ranges, budget))
+        blocks = sum(last - first + 1 for batch in work for _, _, first, last in batch)
+        workers = max(1, min(MAX_WORKERS, os.cpu_count() or 1, -(-blocks // BLOCKS_PER_WORKER)))
+        executor = self.executor_factory(pool_size=workers, name="prewarm")
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="dbtune-prewarm") as pool:
+                loaded = sum(pool.map(lambda batch: self.load_batch(executor, batch), work))
+        finally:
+            executor.close()
+        elapsed = self.clock.monotonic() - started
+        logging.info("Prewarm: loaded {} blocks into shared buffers in {:.1f}s with {} sessions".format(loaded, elapsed, workers))
+        return {"prewarm_seconds": elapsed, "prewarm_blocks": loaded, "prewarm_workers": workers}
+
+    @staticmethod
+    def load_batch(executor, batch):
+        values = ", ".join("({}::oid, '{}', {}::bigint, {}::bigint)".format(relation, FORKS[fork], first, last) for relation, fork, first, last in batch)
+        try:
+            return executor.query_value(LOAD_RANGES.format(values), int) or 0
+        except QueryError as err:
+            logging.debug("Prewarm: batch failed ({})".format(err))
+            return 0
+
+    def remove(self):
+        if not self.created:
+            return
+        drop_extensions(self.executor, self.created)
+        self.created = []
+        self.session_state.save(prewarm_extensions=[])
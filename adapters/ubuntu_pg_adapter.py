@@ -1,18 +1,32 @@
 import os
+import re
 import time
 import datetime
 import subprocess
 import sys
 import platform
-from threading import Timer, Condition, Thread
+from threading import Timer, Lock
 import logging
 import psutil
 import distro
 import json
+from collections import namedtuple
 import numpy as np
-from TuningError import TuningError
+from TuningError import TuningError, SessionInterrupted
 from adapters.adapter import Adapter
 from adapters.utility import ensure_dir
+from adapters.prewarm import BufferCachePrewarm, remove_leftovers
+from clock import SystemClock
+from crash_detection import postmaster_pid, pid_alive
+from instrumentation import instrumentation
+from pg_executor import PgExecutor, QueryError
+from readiness import ReadinessProbe, READY
+from session_state import SessionState
+from stats.host_stats import HostSampler
+from stats.query_stats import QueryStats, pack_keys
+from stats.sketch import DDSketch
+from stats.measurement import MeasurementWindow, MAX_DURATION
+from stats.steady_state import SteadyStateDetector
 
 LOG_LEVEL = os.getenv("PGTUNE_LOGGING", "NONE")
 VERBOSE = "VERBOSE"
@@ -32,19 +46,22 @@ PG_CONFIG_UNITS = {
             "seq_page_cost":""
         }
 
-def get_connect(pg_isready_path, port):
-    p1 = subprocess.Popen([pg_isready_path, "-h", "localhost", "-p", str(port)],stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    command_output, _ = p1.communicate()
-    logging.debug(command_output.decode('ascii').strip())
-    return p1.returncode
-
-def wait_for_postgres_ready_for_connect(pg_isready_path, port):
-    logging.info("UbuntuPgAdapter: Waiting for connect...")
-    state = get_connect(pg_isready_path, port)
-    while not state == 0 and not state == 2:
-        print('.', end='', flush=True)
-        time.sleep(1)
-    return state
+# objectives where lower is better, all need pg_stat_statements
+LATENCY_OBJECTIVES = ["query_runtime", "query_runtime_p50", "query_runtime_p95", "query_runtime_p99"]
+# seconds between checks of whether an adaptive measurement can stop
+MEASUREMENT_CHECK_INTERVAL = 10
+# seconds between checks of whether an adaptive warmup is over
+WARMUP_CHECK_INTERVAL = 5
+# pg_settings contexts whose settings only change when postgres is restarted
+RESTART_CONTEXTS = {"postmaster"}
+# seconds to wait for postgres to reread its configuration files after pg_reload_conf()
+RELOAD_TIMEOUT = 5
+# seconds between checks of whether the old postmaster is gone while restarting
+RESTART_POLL_INTERVAL = 0.05
+# transactions the client itself commits between two checks for commits, its own polling and stats snapshot
+OWN_COMMITS_PER_POLL = 3
+
+MetricsSnapshot = namedtuple("MetricsSnapshot", ["timestamp", "xact_commit", "xact_rollback", "blks_read", "blks_hit", "calls", "total_exec_time", "query_stats"])
 
 def shell_command(command):
     p1 = subprocess.Popen([command],stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
@@ -54,13 +71,23 @@ def shell_command(command):
 
 
 class UbuntuPgAdapter(Adapter):
-    def __init__(self, adapter_data):
+    def __init__(self, adapter_data, clock=None, executor_factory=PgExecutor, host_sampler_factory=HostSampler, readiness_probe_factory=ReadinessProbe,
+                 session_state=None):
+        # the factories and clock are swapped for fakes when the tuning loop is simulated
+        self.clock = clock or SystemClock()
+        # without a saved session state nothing outlives the process
+        self.session_state = session_state or SessionState(None)
         self.pg_stats = None
         self.bestPointFound = None
         self.bestPerformance = None
         self.MODE = "pre-tuning"
+        # iteration being measured, 0 before tuning starts and -1 after it ended
+        self.ITERATION = 0
         logging.info("Initiating PostgreSQL adapter")
         self.ALLOW_RESTART = adapter_data["restart_allowed"]
+        # started from a validated connection profile, nothing may be asked
+        self.UNATTENDED = adapter_data.get("unattended", False)
+        self.PG_STAT_STATEMENTS_RESTART = adapter_data.get("pg_stat_statements_restart", False)
         self.OPTIMIZATION_OBJECTIVE = adapter_data["optimization_target"]
         self.PSQL_PATH = adapter_data["psql_path"]
         self.PG_ISREADY_PATH = adapter_data["pg_isready_path"]
@@ -72,12 +99,49 @@ class UbuntuPgAdapter(Adapter):
         self.PG_STATS_STATEMENTS_ENABLE = False
         self.WARMUP_TIME = 300
         self.CRASH_DETECTED = False
-        self.CRASH_DETECTION = Condition()
+        self.CRASH_REASON = None
+        self.CRASH_DETECTION = self.clock.condition()
+        # set by the runtime when the session is aborted, ends any wait in progress
+        self.INTERRUPTED = False
+        # called by safely_abort before it ends the process, the runtime writes its profile there
+        self.exit_hooks = []
+        # set while we restart postgres ourselves so the crash detector ignores the postmaster exiting
+        self.RESTART_IN_PROGRESS = False
         self.EXPERIMENT_DURATION = 600
-        self.DATA_DIRECTORY_PATH = os.path.dirname(self.psql("-At -c \"show data_directory\";").splitlines()[-1].strip())+"/"
-
-        # Does the restart command work (only if they have restart enabled)
-        if self.ALLOW_RESTART:
+        # "adaptive" ends the measurement once the objective is known precisely enough,
+        # EXPERIMENT_DURATION is then the longest it runs
+        self.MEASUREMENT_MODE = os.environ.get("DBTUNE_MEASUREMENT_MODE", "fixed")
+        self.MIN_EXPERIMENT_DURATION = 120
+        self.measurement = None
+        # "adaptive" ends the warmup once the workload is steady, between MIN_WARMUP_TIME and MAX_WARMUP_TIME
+        self.WARMUP_MODE = os.environ.get("DBTUNE_WARMUP_MODE", "fixed")
+        self.MIN_WARMUP_TIME = 60
+        self.MAX_WARMUP_TIME = None
+        self.warmup = None
+        # knobs written to the override file since postgres last reloaded or restarted
+        self.changed_knobs = set()
+        self.knob_contexts = {}
+        # restart commands built on pg_ctl get "-m fast" unless they set a shutdown mode
+        self.FAST_SHUTDOWN = adapter_data.get("fast_shutdown", True)
+        # reload the blocks that were cached before each restart
+        self.PREWARM = os.environ.get("DBTUNE_PREWARM", "off") == "on"
+        self.prewarm = None
+        self.executor = executor_factory(self.PSQL_PATH, self.PG_PORT, self.DATABASE_NAME, self.USERNAME, self.PASSWORD_AUTH)
+        # snapshots run on their own session so its temp table tracks what was already collected
+        self.snapshot_executor = executor_factory(self.PSQL_PATH, self.PG_PORT, self.DATABASE_NAME, self.USERNAME, self.PASSWORD_AUTH, pool_size=1, name="snapshots")
+        self.snapshot_lock = Lock()
+        self.query_stats = QueryStats.empty()
+        self.query_stats_backend = None
+        self.latency_sketch = DDSketch()
+        self.PG_DATA_DIRECTORY = self.executor.query_value("SELECT current_setting('data_directory')")
+        self.DATA_DIRECTORY_PATH = os.path.dirname(self.PG_DATA_DIRECTORY)+"/"
+        self.host_sampler = host_sampler_factory(self.DATA_DIRECTORY_PATH)
+        # probed where the executor connects, the Unix socket unless it uses password authentication over TCP
+        socket_directory = None if self.PASSWORD_AUTH else (self.executor.query_value("SELECT current_setting('unix_socket_directories')") or "").split(",")[0].strip()
+        self.readiness = readiness_probe_factory(self.PG_PORT, socket_directory, self.USERNAME, self.DATABASE_NAME, clock=self.clock)
+
+        # Does the restart command work (only if they have restart enabled), the profile's validation already ran it
+        if self.ALLOW_RESTART and not self.UNATTENDED:
             modified_restart_command = self.POSTGRES_RESTART_COMMAND.replace("restart", "status")
             restart_command_status_worked = False
             i = 0
@@ -101,14 +165,22 @@ class UbuntuPgAdapter(Adapter):
             self.pg_stat_col = "total_time"
         if {"WARMUP_TIME"} <= adapter_data.keys():
             self.WARMUP_TIME = adapter_data["WARMUP_TIME"]
+        for setting in ["EXPERIMENT_DURATION", "MIN_EXPERIMENT_DURATION", "MEASUREMENT_MODE", "WARMUP_MODE", "MIN_WARMUP_TIME", "MAX_WARMUP_TIME", "PREWARM"]:
+            if setting in adapter_data:
+                setattr(self, setting, adapter_data[setting])
         self.relative_os_paths()
         self.check_and_enable_pg_stat_statement()
+        if self.PREWARM and self.ALLOW_RESTART:
+            self.prewarm = BufferCachePrewarm(self.executor, lambda **kwargs: executor_factory(self.PSQL_PATH, self.PG_PORT, self.DATABASE_NAME, self.USERNAME, self.PASSWORD_AUTH, **kwargs),
+                                              self.clock, self.session_state)
+        else:
+            remove_leftovers(self.executor, self.session_state)
         self.units = PG_CONFIG_UNITS
         logging.info("End of initiating PostgreSQL adapter\n")
 
 
     def relative_os_paths(self):
-        self.CONF_PATH = os.path.dirname(self.psql("-At -c \"SHOW config_file\";").splitlines()[-1].strip())+"/"
+        self.CONF_PATH = os.path.dirname(self.executor.query_value("SELECT current_setting('config_file')"))+"/"
         if not os.path.isdir(self.CONF_PATH):
             logging.error("Can't locate postgres main directory {}".format(self.CONF_PATH))
             raise
@@ -135,65 +207,131 @@ class UbuntuPgAdapter(Adapter):
 
 
     def get_xact_commit(self):
-        output = self.psql("-At -c \"SELECT xact_commit FROM pg_stat_database WHERE datname='{}';\"".format(self.DATABASE_NAME))
         try:
-            commit = int(output.splitlines()[-1].strip())
-        except ValueError:
+            commit = self.executor.query_value("SELECT xact_commit FROM pg_stat_database WHERE datname='{}'".format(self.DATABASE_NAME), int)
+        except QueryError:
+            commit = None
+        if commit is None:
             logging.debug("Couldn't find anything in xaxt_commit, defaulting to 0")
             commit = 0
         return commit
 
     def calculate_query_latency(self, end_stats, start_stats):
-        mean_exec_times_pr = []
-        calls_pr = []
-        total_calls_pr = 0
-        #print("start_stats ", start_stats)
-        for i in end_stats.keys():
-            if i in start_stats.keys():
-                exec_time_pr_pq = end_stats[i]['total_exec_time'] - start_stats[i]['total_exec_time']
-                calls_pr_pq = end_stats[i]['calls'] - start_stats[i]['calls']
-            elif i not in start_stats.keys():
-                exec_time_pr_pq = end_stats[i]['total_exec_time'] - 0
-                calls_pr_pq = end_stats[i]['calls'] - 0
-            calls_pr.append(calls_pr_pq)
-            #logging.info("calls_pr {}".format(calls_pr))
-            #logging.info("calls_pr_pq {}".format(calls_pr_pq))
-            if calls_pr_pq == 0:
-                mean_exec_times_pr.append(0)
-            else:
-                mean_exec_time_pr_pq = exec_time_pr_pq / calls_pr_pq
-                mean_exec_times_pr.append(mean_exec_time_pr_pq)
-            total_calls_pr += calls_pr_pq
-        #logging.info("mean_exec_times_pr {}".format(mean_exec_times_pr))
-        latency = float(np.sum(np.divide(np.array(calls_pr), np.array(total_calls_pr)) * mean_exec_times_pr))
-        return latency
-
-
-    def get_pg_queries_statistics(self):
-        query_runtime_stats = self.psql("-At -d {} -c \"SELECT JSON_OBJECT_AGG(queryid, JSON_BUILD_OBJECT('calls',calls,'total_exec_time',{})) FROM (SELECT * FROM pg_stat_statements ORDER BY calls DESC) AS f;\"".format(self.DATABASE_NAME, self.pg_stat_col)).splitlines()[-1]
-        try:
-            query_stats = json.loads(query_runtime_stats)
-        except ValueError:
-            logging.debug("Couldn't find anything in pg_stat_statments, defaulting to 0")
+        return end_stats.mean_latency(start_stats)
+
+    def snapshot_query(self):
+        summary = """SELECT 's' AS kind, extract(epoch FROM clock_timestamp())::text, xact_commit::text, xact_rollback::text,
+                blks_read::text, blks_hit::text, pg_backend_pid()::text, {} FROM pg_stat_database WHERE datname = '{}'"""
+        if not self.PG_STATS_STATEMENTS_ENABLE:
+            return summary.format("NULL", self.DATABASE_NAME)
+        stats_reset = "(SELECT stats_reset::text FROM pg_stat_statements_info)" if int(float(self.db_version)) >= 14 else "NULL"
+        # The temp table holds what this session reported last time, so only entries whose calls
+        # changed (or that disappeared) are sent back instead of the whole view every tick.
+        # sum of squares is rebuilt from the population stddev and mean so per interval variance can be derived
+        return """CREATE TEMP TABLE IF NOT EXISTS dbtune_pg_stat_statements (userid oid, dbid oid, queryid bigint, calls bigint,
+                total_exec_time float8, sum_sq_exec_time float8, min_exec_time float8, max_exec_time float8,
+                PRIMARY KEY (userid, dbid, queryid));
+            WITH latest AS (SELECT userid, dbid, queryid, sum(calls) AS calls, sum({col}) AS total_exec_time,
+                    sum(calls * (power({stddev}, 2) + power({mean}, 2))) AS sum_sq_exec_time, min({min}) AS min_exec_time, max({max}) AS max_exec_time
+                    FROM pg_stat_statements WHERE queryid IS NOT NULL GROUP BY userid, dbid, queryid),
+                changed AS (SELECT c.* FROM latest c LEFT JOIN dbtune_pg_stat_statements p USING (userid, dbid, queryid)
+                    WHERE p.calls IS DISTINCT FROM c.calls),
+                removed AS (DELETE FROM dbtune_pg_stat_statements p WHERE NOT EXISTS
+                    (SELECT 1 FROM latest c WHERE c.userid = p.userid AND c.dbid = p.dbid AND c.queryid = p.queryid)
+                    RETURNING p.userid, p.dbid, p.queryid),
+                saved AS (INSERT INTO dbtune_pg_stat_statements SELECT * FROM changed ON CONFLICT (userid, dbid, queryid)
+                    DO UPDATE SET calls = excluded.calls, total_exec_time = excluded.total_exec_time, sum_sq_exec_time = excluded.sum_sq_exec_time,
+                        min_exec_time = excluded.min_exec_time, max_exec_time = excluded.max_exec_time)
+            {summary}
+            UNION ALL SELECT 'c', userid::text, dbid::text, queryid::text, calls::text, total_exec_time::text,
+                sum_sq_exec_time::text, min_exec_time::text, max_exec_time::text FROM changed
+            UNION ALL SELECT 'r', userid::text, dbid::text, queryid::text, NULL, NULL, NULL, NULL, NULL FROM removed""".format(
+                col=self.pg_stat_col, stddev=self.pg_stat_col.replace("total", "stddev"), mean=self.pg_stat_col.replace("total", "mean"),
+                min=self.pg_stat_col.replace("total", "min"), max=self.pg_stat_col.replace("total", "max"),
+                summary=summary.format(stats_reset + ", NULL", self.DATABASE_NAME))
+
+    def get_snapshot(self):
+        # One statement so every counter is read at the same instant, timed by the server clock
+        with self.snapshot_lock:
+            try:
+                rows = self.snapshot_executor.query(self.snapshot_query())
+            except QueryError:
+                rows = []
+            summary = next((row for row in rows if row[0] == "s"), None)
+            if summary is None:
+                logging.debug("Couldn't read the metrics snapshot, defaulting to 0")
+                return MetricsSnapshot(self.clock.time(), 0, 0, 0, 0, 0, 0.0, None)
             query_stats = None
-        return query_stats
+            if self.PG_STATS_STATEMENTS_ENABLE:
+                query_stats = self.update_query_stats(rows, int(summary[6]), summary[7])
+            return MetricsSnapshot(float(summary[1]), int(summary[2]), int(summary[3]), int(summary[4]), int(summary[5]),
+                                   int(query_stats.calls.sum()) if query_stats is not None else 0,
+                                   float(query_stats.total_exec_time.sum()) if query_stats is not None else 0.0,
+                                   query_stats)
+
+    def update_query_stats(self, rows, backend_pid, stats_reset):
+        if backend_pid != self.query_stats_backend:
+            # a new backend starts with an empty temp table and reports every entry again
+            self.query_stats = QueryStats.empty()
+            self.query_stats_backend = backend_pid
+        changed = [row for row in rows if row[0] == "c"]
+        removed = [row for row in rows if row[0] == "r"]
+        changed_stats = QueryStats.from_columns(*(np.array([row[i] for row in changed], dtype=dtype)
+                                                  for i, dtype in ((1, np.int64), (2, np.int64), (3, np.int64), (4, np.int64),
+                                                                   (5, np.float64), (6, np.float64), (7, np.float64), (8, np.float64))))
+        removed_keys = pack_keys(*(np.array([row[i] for row in removed], dtype=np.int64) for i in (1, 2, 3)))
+        self.query_stats = self.query_stats.merge(changed_stats, removed_keys, stats_reset)
+        return self.query_stats
+
+    def reset_connections(self):
+        self.executor.reset()
+        self.snapshot_executor.reset()
+
+    def interval_sketch(self, start_snapshot, end_snapshot):
+        sketch = DDSketch()
+        if start_snapshot.query_stats is not None and end_snapshot.query_stats is not None:
+            sketch.add_distributions(*end_snapshot.query_stats.interval_moments(start_snapshot.query_stats))
+        return sketch
+
+    def calculate_performance(self, start_snapshot, end_snapshot, sketch=None):
+        performance = {}
+        commits = end_snapshot.xact_commit - start_snapshot.xact_commit
+        if start_snapshot.xact_commit <= 0 or end_snapshot.xact_commit <= 0 or commits < 0:
+            commits = 0
+        elapsed = end_snapshot.timestamp - start_snapshot.timestamp
+        performance["throughput"] = commits / elapsed if elapsed > 0 else 0
+        if self.PG_STATS_STATEMENTS_ENABLE:
+            if start_snapshot.query_stats is None or end_snapshot.query_stats is None:
+                performance["query_runtime"] = 0
+            else:
+                performance["query_runtime"] = self.calculate_query_latency(end_snapshot.query_stats, start_snapshot.query_stats)
+            if sketch is None or sketch.count == 0:
+                sketch = self.interval_sketch(start_snapshot, end_snapshot)
+            performance.update(sketch.percentiles("query_runtime"))
+        return performance
 
 
     def wait_for_commits(self):
+        # returns when the workload committed for the first time
         start_commit = end_commit = self.get_xact_commit()
+        first_commit = None
         logging.debug("Waiting for commits...")
         while end_commit - start_commit < 100:
-            time.sleep(1)
-            end_commit = self.get_xact_commit()
+            self.clock.sleep(1)
+            previous_commit, end_commit = end_commit, self.get_xact_commit()
+            if first_commit is None and end_commit - previous_commit > OWN_COMMITS_PER_POLL:
+                first_commit = self.clock.monotonic()
+        return first_commit if first_commit is not None else self.clock.monotonic()
             
 
     def check_and_enable_pg_stat_statement(self):
-        existsLines = self.psql("-At -c \"SELECT name, setting FROM pg_settings WHERE name LIKE 'shared_preload_libraries';\"").splitlines()[-1]
-        exists = existsLines.split('|')[1]
+        exists = self.executor.query_value("SELECT setting FROM pg_settings WHERE name = 'shared_preload_libraries'")
         if "pg_stat_statements" not in exists:
             logging.debug("pg_stat_statements does not exist")
             while True:
-                if self.OPTIMIZATION_OBJECTIVE == "query_runtime":
+                if self.UNATTENDED and not self.ALLOW_RESTART:
+                    response = "Y" if self.PG_STAT_STATEMENTS_RESTART else "N"
+                elif self.OPTIMIZATION_OBJECTIVE in LATENCY_OBJECTIVES:
                     if self.ALLOW_RESTART:
                         response = "Y"
                     else:
@@ -204,7 +342,7 @@ class UbuntuPgAdapter(Adapter):
                     else:
                         response = input("Database must be restarted at least once in order to enable pg_stat_statements. Would you like to continue the optimization? [Y] Restart once      [N] Continue without query_runtime stats: ")
                 if response not in ['Y','y','N','n']:
-                    if self.OPTIMIZATION_OBJECTIVE == "query_runtime":
+                    if self.OPTIMIZATION_OBJECTIVE in LATENCY_OBJECTIVES:
                         response = input("To optimize for query_runtime database must be restarted at least once in order to enable pg_stat_statements. Would you like to continue the optimization? [Y] Restart once      [N] Abort optimization: ")
                     elif self.OPTIMIZATION_OBJECTIVE == "throughput":
                         response = input("Database must be restarted at least once in order to enable pg_stat_statements. Would you like to continue the optimization? [Y] Restart once      [N] Continue without query_runtime stats: ")
@@ -215,8 +353,14 @@ class UbuntuPgAdapter(Adapter):
                 with open(self.CONF_OVERRIDE_FILE_PG_STATS, 'w') as pg_stat_file:
                     pg_stat_file.write("shared_preload_libraries = 'pg_stat_statements'")
                 os.system(f"{self.POSTGRES_RESTART_COMMAND}")
+                self.reset_connections()
+                if self.readiness.wait() != READY:
+                    sys.exit("Unable to connect to postgres after enabling pg_stat_statements")
             elif response in ["N", "n"]:
-                if self.OPTIMIZATION_OBJECTIVE == "query_runtime":
+                if self.OPTIMIZATION_OBJECTIVE in LATENCY_OBJECTIVES and self.UNATTENDED:
+                    sys.exit("Optimizing for query runtime needs pg_stat_statements, which postgres only loads on a restart. "
+                             "Allow restarts, or set pg_stat_statements_restart (DBTUNE_PG_STAT_STATEMENTS_RESTART) in the connection profile to restart once.")
+                if self.OPTIMIZATION_OBJECTIVE in LATENCY_OBJECTIVES:
                     logging.info("Restart not allowed, aborting optimization!")
                     sys.exit(0)
                 else:
@@ -230,181 +374,338 @@ class UbuntuPgAdapter(Adapter):
                 except:
                     pass
 
-        installed = int(self.psql("-At -d {} -c  \"SELECT count(*) FROM pg_extension WHERE extname = 'pg_stat_statements';\"".format(self.DATABASE_NAME)).splitlines()[-1])
+        installed = self.executor.query_value("SELECT count(*) FROM pg_extension WHERE extname = 'pg_stat_statements'", int)
         if not installed:
             logging.debug("Installing pg_stat_statements extension")
-            self.psql("-At -d {} -c \"CREATE EXTENSION pg_stat_statements;\"".format(self.DATABASE_NAME))
+            self.executor.execute("CREATE EXTENSION pg_stat_statements")
         else:
             logging.debug("pg_stat_statements extension already installed")
             pass
         self.PG_STATS_STATEMENTS_ENABLE = True
         logging.debug("Resetting pg_stat_statements table")
-        self.psql("-At -d {} -c \"SELECT pg_stat_statements_reset();\"".format(self.DATABASE_NAME))
+        self.executor.execute("SELECT pg_stat_statements_reset()")
 
     @staticmethod
     def s():
         return time.time()
 
-    def restart(self):
+    def restart(self, after_crash=False):
+        """Applies the installed configuration, restarting postgres only when it must.
+
+        Returns how it was applied and, after a restart, how long the checkpoint,
+        shutdown and startup took and how long until the workload committed again.
+        after_crash restarts postgres whatever changed, as the crash path does.
+        """
         # We need to this here instead of in client since WARMUP_TIME is
         # handled here. We probably want to apply WARMUP_TIME even if we
         # don't restart.
-        if self.ALLOW_RESTART:
-            logging.info("UbuntuPgAdapter: Restarting Database")
-            os.system(f"{self.POSTGRES_RESTART_COMMAND}")
-            logging.info("UbuntuPgAdapter: Database restarted")
-        else:
-            logging.info("Skipping restart")
-            self.psql("-At -c \"SELECT pg_reload_conf();\"")
-        if wait_for_postgres_ready_for_connect(self.PG_ISREADY_PATH, self.PG_PORT) == 2:
-            sys.exit("Unable to connect to postgres")
+        changed_knobs, self.changed_knobs = self.changed_knobs, set()
+        report = {"config_applied_by": "reload"}
+        if after_crash:
+            # the postmaster may be gone or in crash recovery, a reload can't reach it
+            logging.info("UbuntuPgAdapter: Restarting after the crash")
+            return self.finish_restart(self.restart_postgres())
+        if self.CRASH_DETECTED:
+            # raised while monitoring the defaults or between iterations, not by the configuration applied now
+            logging.info("UbuntuPgAdapter: Ignoring the crash signal raised before this configuration ({})".format(self.CRASH_REASON))
+            self.CRASH_DETECTED = False
+            self.CRASH_REASON = None
+        restart_knobs = [name for name, context in self.knob_contexts_of(changed_knobs).items() if context in RESTART_CONTEXTS]
+        if self.ALLOW_RESTART and restart_knobs:
+            logging.info("UbuntuPgAdapter: {} changed".format(", ".join(sorted(restart_knobs))))
+            report = self.restart_postgres()
         else:
-            #print("UbuntuPgAdapter: Sleeping for safety")
-            #time.sleep(30)
-            self.wait_for_commits()
-
-    def get_metric_stats_monitoring(self, start_commit_monitoring, start_time_monitoring, start_query_stats_monitoring):
-        stats = {}
-        stats["db"] = {}
-        physical_derive = shell_command('df '+ self.DATA_DIRECTORY_PATH).split('\n')[1].split()[0]
-        physical_derive = os.path.basename(physical_derive)
-        disk_stats_keys, disk_stats_values=shell_command('iostat -xc -y -p '+ physical_derive + ' 1 1').split('\n')[-5:-3]
-        stats["io"] = dict(zip(disk_stats_keys.split(), disk_stats_values.replace(',','.').split()))
-        stats["io"]["iops"] = float(stats["io"]['r/s'])+float(stats["io"]['w/s'])
-        stats["mem"] = psutil.virtual_memory()._asdict()
-        stats["cpu"] = {"cpu_util":psutil.cpu_percent()}
-        stats["timestamp"] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-        time.sleep(max(1-(time.time()-start_time_monitoring),0))
+            # a reload keeps the shared buffers warm
+            try:
+                pending_restart = self.reload_config()
+            except QueryError as err:
+                if not self.ALLOW_RESTART:
+                    raise
+                logging.warning("UbuntuPgAdapter: Reloading the configuration failed ({}), restarting instead".format(err))
+                pending_restart = []
+                report = self.restart_postgres()
+            if pending_restart and self.ALLOW_RESTART:
+                logging.info("UbuntuPgAdapter: {} only change on restart".format(", ".join(pending_restart)))
+                report = self.restart_postgres()
+            elif pending_restart:
+                logging.warning("UbuntuPgAdapter: Restart not allowed, {} keep their current values".format(", ".join(pending_restart)))
+        return self.finish_restart(report)
+
+    def finish_restart(self, report):
+        """Waits until postgres is back and its workload commits again, completing the report of restart()."""
+        logging.info("UbuntuPgAdapter: Waiting for connect...")
+        state = self.readiness.wait()
+        if state != READY:
+            sys.exit("Unable to connect to postgres ({})".format(state))
+        ready = self.clock.monotonic()
+        if self.prewarm is not None:
+            # loads alongside the workload reconnecting, and is done before the warmup starts
+            self.prewarm.start()
+        first_commit = self.wait_for_commits()
+        if self.prewarm is not None:
+            report.update(self.prewarm.wait())
+        if report["config_applied_by"] == "restart":
+            report["startup_seconds"] = ready - report.pop("stopped")
+            report["time_to_first_commit"] = first_commit - ready
+            report["downtime_seconds"] = first_commit - report.pop("shutdown_started")
+            for phase in ("checkpoint", "shutdown", "startup"):
+                if report.get(phase + "_seconds") is not None:
+                    instrumentation.observe("restart", report[phase + "_seconds"], phase=phase)
+            instrumentation.observe("restart", report["time_to_first_commit"], phase="first_commit")
+            logging.info("UbuntuPgAdapter: Restart took {:.1f}s until the first commit (checkpoint {:.1f}s, startup {:.1f}s)".format(
+                report["downtime_seconds"] + report["checkpoint_seconds"], report["checkpoint_seconds"], report["startup_seconds"]))
+        return report
+
+    def restart_postgres(self):
+        logging.info("UbuntuPgAdapter: Restarting Database")
+        if self.prewarm is not None:
+            self.prewarm.snapshot()
+        # flushing dirty buffers while postgres still serves queries leaves little for the shutdown checkpoint to write
+        checkpoint_started = self.clock.monotonic()
         try:
-            end_commit = self.get_xact_commit()
-            end_time = time.time()
-            commits = end_commit-start_commit_monitoring
-            if start_commit_monitoring <= 0 or end_commit <= 0 or commits < 0:
-                commits = 0
-            if self.PG_STATS_STATEMENTS_ENABLE:
-                end_query_stats = self.get_pg_queries_statistics()
-                if end_query_stats == None or start_query_stats_monitoring==None:
-                    stats["db"]["query_runtime"] = 0
-                else:
-                    stats["db"]["query_runtime"] = self.calculate_query_latency(end_query_stats,start_query_stats_monitoring)
-            stats["db"]["throughput"] = commits / (end_time-start_time_monitoring)
-        except:
-            stats["db"]["throughput"] = 0
-            stats["db"]["query_runtime"] = 0
-            end_query_stats = None
-        return stats, end_commit, end_time, end_query_stats
+            self.executor.execute("CHECKPOINT")
+        except QueryError as err:
+            logging.warning("UbuntuPgAdapter: CHECKPOINT before restarting failed: {}".format(err))
+        report = {"config_applied_by": "restart", "checkpoint_seconds": self.clock.monotonic() - checkpoint_started}
+        pid = postmaster_pid(self.PG_DATA_DIRECTORY)
+        self.RESTART_IN_PROGRESS = True
+        try:
+            report["shutdown_started"] = stopped = self.clock.monotonic()
+            process = subprocess.Popen(self.restart_command(), shell=True)
+            # the restart command returns once postgres is back, the old postmaster exiting marks the end of the shutdown
+            while process.poll() is None:
+                if pid is not None and not pid_alive(pid):
+                    report["shutdown_seconds"] = self.clock.monotonic() - stopped
+                    stopped, pid = self.clock.monotonic(), None
+                self.clock.sleep(RESTART_POLL_INTERVAL)
+            if process.returncode != 0:
+                logging.warning("UbuntuPgAdapter: {} exited with code {}".format(self.POSTGRES_RESTART_COMMAND, process.returncode))
+        finally:
+            self.RESTART_IN_PROGRESS = False
+        # without the postmaster's pid, startup counts from the start of the restart command
+        report["stopped"] = stopped
+        self.reset_connections()
+        logging.info("UbuntuPgAdapter: Database restarted")
+        return report
+
+    def restart_command(self):
+        command = self.POSTGRES_RESTART_COMMAND
+        # pg_ctl and pg_ctlcluster take the shutdown mode, the systemd units already stop postgres in fast mode
+        if not self.FAST_SHUTDOWN or re.search(r"(^|\s)(-m|--mode)\b", command):
+            return command
+        segments = re.split(r"(&&|\|\||[;|\n])", command)
+        calls = [i for i, segment in enumerate(segments) if re.search(r"\bpg_ctl(cluster)?\b", segment)]
+        if not calls:
+            return command
+        if len(calls) > 1 or re.search(r"[\"'`$()]", command):
+            logging.info("UbuntuPgAdapter: Not adding -m fast to {}, set the shutdown mode in the command itself".format(command))
+            return command
+        # the flag goes at the end of the pg_ctl call, before any redirection of its output
+        segment = segments[calls[0]]
+        redirect = re.search(r"\s+\d*[<>]", segment)
+        end = redirect.start() if redirect else len(segment.rstrip())
+        segments[calls[0]] = segment[:end] + " -m fast" + segment[end:]
+        return "".join(segments)
+
+    def reload_config(self):
+        """Reloads the configuration files, returns the settings that still wait for a restart."""
+        logging.info("UbuntuPgAdapter: Reloading configuration")
+        reloaded_at, _ = self.executor.query_one("SELECT clock_timestamp()::text, pg_reload_conf()")
+        # backends reread the files when they get the postmaster's SIGHUP, which is asynchronous
+        deadline = self.clock.monotonic() + RELOAD_TIMEOUT
+        while not self.executor.query_value("SELECT pg_conf_load_time() >= '{}'::timestamptz".format(reloaded_at)) == "t":
+            if self.clock.monotonic() >= deadline:
+                logging.warning("UbuntuPgAdapter: Configuration not reloaded after {}s".format(RELOAD_TIMEOUT))
+                break
+            self.clock.sleep(0.1)
+        for name, error in self.executor.query("SELECT name, error FROM pg_file_settings WHERE error IS NOT NULL"):
+            logging.warning("UbuntuPgAdapter: {} not applied: {}".format(name, error))
+        return [name for name, in self.executor.query("SELECT name FROM pg_settings WHERE pending_restart ORDER BY name")]
+
+    def knob_contexts_of(self, names):
+        # contexts never change while postgres runs, so they are looked up once
+        missing = [name for name in names if name not in self.knob_contexts]
+        if missing:
+            rows = self.executor.query("SELECT name, context FROM pg_settings WHERE name IN ({})".format(", ".join("'{}'".format(name) for name in missing)))
+            self.knob_contexts.update(rows)
+        return {name: self.knob_contexts.get(name) for name in names}
+
+    def read_override_file(self):
+        knobs = {}
+        try:
+            with open(self.CONF_OVERRIDE_FILE) as conf_file:
+                for line in conf_file:
+                    if "=" in line:
+                        name, value = line.split("=", 1)
+                        knobs[name.strip()] = value.strip()
+        except OSError:
+            pass
+        return knobs
+
+    def get_metric_stats_monitoring(self, start_snapshot):
+        stats = self.host_sampler.sample()
+        stats["timestamp"] = datetime.datetime.fromtimestamp(self.clock.time()).strftime("%Y-%m-%d %H:%M:%S.%f")
+        end_snapshot = self.get_snapshot()
+        tick_sketch = self.interval_sketch(start_snapshot, end_snapshot)
+        # the per tick distributions add up to the latency distribution of the measurement window
+        self.latency_sketch.merge(tick_sketch)
+        stats["db"] = self.calculate_performance(start_snapshot, end_snapshot, tick_sketch)
+        warmup = self.warmup
+        if warmup is not None:
+            warmup.add(self.warmup_sample(start_snapshot, end_snapshot, stats))
+        measurement = self.measurement
+        if measurement is not None:
+            value = stats["db"].get(self.OPTIMIZATION_OBJECTIVE)
+            # a tick without any statement has no latency to sample
+            if value is not None and (value > 0 or self.OPTIMIZATION_OBJECTIVE == "throughput"):
+                measurement.add(value)
+        return stats, end_snapshot
+
+    def wait(self, timeout):
+        # returns early when a crash is signalled, raises once the session was interrupted
+        with self.CRASH_DETECTION:
+            if not self.INTERRUPTED:
+                self.CRASH_DETECTION.wait(timeout)
+            if self.INTERRUPTED:
+                raise SessionInterrupted("Tuning session interrupted")
+
+    def interrupt(self):
+        with self.CRASH_DETECTION:
+            self.INTERRUPTED = True
+            self.CRASH_DETECTION.notify_all()
+
+    @staticmethod
+    def warmup_sample(start_snapshot, end_snapshot, stats):
+        blks_hit = end_snapshot.blks_hit - start_snapshot.blks_hit
+        blks_accessed = blks_hit + end_snapshot.blks_read - start_snapshot.blks_read
+        return {
+            "throughput": stats["db"]["throughput"],
+            "hit_ratio": blks_hit / blks_accessed if blks_accessed > 0 else None,
+            "read_iops": stats["io"].get("r/s"),
+        }
+
+    def warm_up_adaptively(self, started):
+        # the samples come from the stats ticks
+        max_warmup_time = self.MAX_WARMUP_TIME or 2 * self.WARMUP_TIME
+        unsteady = None
+        try:
+            while not self.CRASH_DETECTED:
+                elapsed = self.clock.monotonic() - started
+                if elapsed >= self.MIN_WARMUP_TIME:
+                    unsteady = self.warmup.unsteady()
+                    if unsteady == []:
+                        break
+                if elapsed >= max_warmup_time:
+                    logging.info("Warmup didn't settle after {:.0f}s ({} still changing), measuring anyway".format(elapsed, ", ".join(unsteady or [])))
+                    break
+                self.wait(min(WARMUP_CHECK_INTERVAL, max_warmup_time - elapsed))
+        finally:
+            self.warmup = None
+        warmup_time = self.clock.monotonic() - started
+        logging.info("Warmed up in {:.0f}s".format(warmup_time))
+        return warmup_time
+
+    def measure_adaptively(self):
+        # the samples come from the stats ticks
+        measurement = MeasurementWindow(higher_is_better=self.OPTIMIZATION_OBJECTIVE == "throughput")
+        self.measurement = measurement
+        start = self.clock.monotonic()
+        try:
+            while not self.CRASH_DETECTED:
+                elapsed = self.clock.monotonic() - start
+                if elapsed >= self.EXPERIMENT_DURATION:
+                    measurement.stop_reason = MAX_DURATION
+                    break
+                if elapsed >= self.MIN_EXPERIMENT_DURATION:
+                    measurement.stop_reason = measurement.decision(self.bestPerformance)
+                    if measurement.stop_reason:
+                        break
+                self.wait(min(MEASUREMENT_CHECK_INTERVAL, self.EXPERIMENT_DURATION - elapsed))
+        finally:
+            self.measurement = None
+        report = measurement.report(self.clock.monotonic() - start)
+        logging.info("Measured for {:.0f}s ({} samples), stopped: {}".format(report["measurement_duration"], report["measurement_samples"], report["measurement_stop_reason"]))
+        return report
+
+    def crashed_performance(self, start_snapshot):
+        logging.info("UbuntuPgAdapter: Crash detected ({}), reverting to the default configuration".format(self.CRASH_REASON))
+        performance = self.calculate_performance(start_snapshot, self.get_snapshot())
+        performance["Valid"] = "false"
+        self.revert_to_default_configuration()
+        self.restart(after_crash=True)
+        self.CRASH_DETECTED = False
+        self.CRASH_REASON = None
+        return performance
 
     def get_metric_stats(self, state = "tuning" ):
-        performance = {}
+        measurement_report = {}
         if state=="monitoring":
-            start_time = time.time()
-            start_commit = self.get_xact_commit()
-            if self.PG_STATS_STATEMENTS_ENABLE:
-                start_query_stats = self.get_pg_queries_statistics()
-            time.sleep(600)
+            start_snapshot = self.get_snapshot()
+            self.latency_sketch = DDSketch()
+            with instrumentation.timer("phase", phase="monitoring"):
+                self.wait(600)
         if state=="tuning":
-            start_time_before_warmup = time.time()
-            start_commit_before_warmup = self.get_xact_commit()
-            if self.PG_STATS_STATEMENTS_ENABLE:
-                start_query_stats_before_warmup = self.get_pg_queries_statistics()
+            start_snapshot_before_warmup = self.get_snapshot()
             with self.CRASH_DETECTION:
-                # start a new thread to check crash detection
-                worker = Thread(args=(self.CRASH_DETECTION))
-                worker.start()
                 # wait to be notified
                 if self.WARMUP_TIME and self.WARMUP_TIME > 0:
-                    logging.info("UbuntuPgAdapter: Warming up the database for {}s after installing proposed configuration.".format(self.WARMUP_TIME))
-
-                    # Early bad point detection
-                    early_performance = {}
-                    self.CRASH_DETECTION.wait(timeout=20)
-                    start_time_early_exit = time.time()
-                    start_commit_early_exit = self.get_xact_commit()
-                    if self.PG_STATS_STATEMENTS_ENABLE:
-                        start_query_stats_early_exit = self.get_pg_queries_statistics()
-                    self.CRASH_DETECTION.wait(timeout=40)
-                    worker.join()
-                    end_commit_early_exit = self.get_xact_commit()
-                    commits = end_commit_early_exit-start_commit_early_exit
-                    if start_commit_early_exit <= 0 or end_commit_early_exit <= 0:
-                        commits=0
-                    end_time_early_exit = time.time()
-                    early_performance["throughput"] = commits / (end_time_early_exit-start_time_early_exit)
-                    early_performance["Valid"] = "true"
-                    if self.PG_STATS_STATEMENTS_ENABLE:
-                        end_query_stats_early_exit = self.get_pg_queries_statistics()
-                        early_performance["query_runtime"] = self.calculate_query_latency(end_query_stats_early_exit, start_query_stats_early_exit)
-
-                        if self.OPTIMIZATION_OBJECTIVE == "throughput":
-                            if early_performance[self.OPTIMIZATION_OBJECTIVE] < self.bestPerformance * 0.4:
-                                return early_performance
-
-                        elif self.OPTIMIZATION_OBJECTIVE == "query_runtime":
-                            if early_performance[self.OPTIMIZATION_OBJECTIVE] > self.bestPerformance * 1.6:
-                                return early_performance
-
-                        self.CRASH_DETECTION.wait(timeout=self.WARMUP_TIME-60)
-                        if self.CRASH_DETECTED:
-                            worker.join()
-                            print("crash detected warmup phase")
-                            end_commit_before_crash = self.get_xact_commit()
-                            commits = end_commit_before_crash-start_commit_before_warmup
-                            if start_commit_before_warmup <= 0 or end_commit_before_crash <= 0:
-                                commits=0
-                            end_time_before_crash = time.time()
-                            performance["throughput"] = commits / (end_time_before_crash-start_time_before_warmup)
-                            performance["Valid"] = "false"
-                            if self.PG_STATS_STATEMENTS_ENABLE:
-                                end_query_stats_before_crash = self.get_pg_queries_statistics()
-                                performance["query_runtime"] = self.calculate_query_latency(end_query_stats_before_crash, start_query_stats_before_warmup)
-                            self.revert_to_default_configuration()
-                            self.restart()
-                            self.CRASH_DETECTED = False
-                            return performance
-                    logging.info("Measuring database performance for {}s".format(self.EXPERIMENT_DURATION))
-                    start_time = time.time()
-                    start_commit = self.get_xact_commit()
-                    if self.PG_STATS_STATEMENTS_ENABLE:
-                        start_query_stats = self.get_pg_queries_statistics()
-                    self.CRASH_DETECTION.wait(self.EXPERIMENT_DURATION)
-                    if self.CRASH_DETECTED:
-                        worker.join()
-                        print("crash detected measurement phase")
-                        end_commit_before_crash = self.get_xact_commit()
-                        commits = end_commit_before_crash-start_commit_before_warmup
-                        if start_commit_before_warmup <= 0 or end_commit_before_crash <= 0:
-                            commits=0
-                        end_time_before_crash = time.time()
-                        performance["throughput"] = commits / (end_time_before_crash-start_time_before_warmup)
-                        performance["Valid"] = "false"
+                    with instrumentation.timer("phase", phase="warmup"):
+                        warmup_started = self.clock.monotonic()
+                        if self.WARMUP_MODE == "adaptive":
+                            logging.info("UbuntuPgAdapter: Warming up the database until the workload is steady after installing proposed configuration.")
+                            self.warmup = SteadyStateDetector()
+                        else:
+                            logging.info("UbuntuPgAdapter: Warming up the database for {}s after installing proposed configuration.".format(self.WARMUP_TIME))
+
+                        # Early bad point detection
+                        self.wait(20)
+                        start_snapshot_early_exit = self.get_snapshot()
+                        self.wait(40)
+                        early_performance = self.calculate_performance(start_snapshot_early_exit, self.get_snapshot())
+                        early_performance["Valid"] = "true"
                         if self.PG_STATS_STATEMENTS_ENABLE:
-                            end_query_stats_before_crash = self.get_pg_queries_statistics()
-                            performance["query_runtime"] = self.calculate_query_latency(end_query_stats_before_crash, start_query_stats_before_warmup)
-                        self.revert_to_default_configuration()
-                        self.restart()
-                        self.CRASH_DETECTED = False
-                        return performance
-
-                worker.join()
-        end_commit = self.get_xact_commit()
-        commits = end_commit-start_commit
-        if start_commit <= 0 or end_commit <= 0 or commits<0:
-            commits=0
-        end_time = time.time()
-        performance["throughput"] = commits / (end_time-start_time)
+                            if self.OPTIMIZATION_OBJECTIVE == "throughput":
+                                if early_performance[self.OPTIMIZATION_OBJECTIVE] < self.bestPerformance * 0.4:
+                                    self.warmup = None
+                                    return early_performance
+
+                            elif self.OPTIMIZATION_OBJECTIVE in LATENCY_OBJECTIVES:
+                                if early_performance[self.OPTIMIZATION_OBJECTIVE] > self.bestPerformance * 1.6:
+                                    self.warmup = None
+                                    return early_performance
+
+                        if self.WARMUP_MODE == "adaptive":
+                            # the commit rate, hit ratio and read IOPS it watches don't need pg_stat_statements
+                            measurement_report["warmup_duration"] = self.warm_up_adaptively(warmup_started)
+                        elif self.PG_STATS_STATEMENTS_ENABLE:
+                            self.wait(self.WARMUP_TIME-60)
+                        if self.CRASH_DETECTED:
+                            logging.info("UbuntuPgAdapter: Crash detected in the warmup phase")
+                            return self.crashed_performance(start_snapshot_before_warmup)
+                    self.warmup = None
+                    start_snapshot = self.get_snapshot()
+                    self.latency_sketch = DDSketch()
+                    with instrumentation.timer("phase", phase="measurement"):
+                        if self.MEASUREMENT_MODE == "adaptive":
+                            logging.info("Measuring database performance for {}s to {}s".format(self.MIN_EXPERIMENT_DURATION, self.EXPERIMENT_DURATION))
+                            measurement_report.update(self.measure_adaptively())
+                        else:
+                            logging.info("Measuring database performance for {}s".format(self.EXPERIMENT_DURATION))
+                            self.wait(self.EXPERIMENT_DURATION)
+                        if self.CRASH_DETECTED:
+                            logging.info("UbuntuPgAdapter: Crash detected in the measurement phase")
+                            return self.crashed_performance(start_snapshot_before_warmup)
+
+        performance = self.calculate_performance(start_snapshot, self.get_snapshot(), self.latency_sketch)
+        performance.update(measurement_report)
         performance["Valid"] = "true"
-        if self.PG_STATS_STATEMENTS_ENABLE:
-            end_query_stats = self.get_pg_queries_statistics()
-            performance["query_runtime"] = self.calculate_query_latency(end_query_stats, start_query_stats)
         return performance
 
     def get_default_configuration(self):
         default_configuration = {}
-        number_of_knobs = len(PG_CONFIG_UNITS)
-        default_settings = self.psql("-At -c \"SELECT name,setting,unit from pg_settings WHERE name in {}\";".format(tuple(PG_CONFIG_UNITS.keys()))).splitlines()[-number_of_knobs:]
+        default_settings = self.executor.query("SELECT name,setting,unit from pg_settings WHERE name in {}".format(tuple(PG_CONFIG_UNITS.keys())))
         pg_units = {"B": 1/1024, "kB":1, "8kB": 8, "MB":1024, "GB":1024**2,"TB":1024**3, "s":1/60}
-        for i in default_settings:
-            name, setting, unit = map(lambda x: x.strip(),i.split('|'))
+        for name, setting, unit in default_settings:
             try:
                 default_configuration[name] = str(int(int(setting)*pg_units[unit]))
             except:
@@ -417,6 +718,7 @@ class UbuntuPgAdapter(Adapter):
         # 1. create conf.d directory if it not exists
         config_log_list = ["Proposed Configuration:"]
         ensure_dir(self.CONF_OVERRIDE_PATH)
+        previous = self.read_override_file()
         # 2. write the conf file in conf.d directory
         conf_file = open(self.CONF_OVERRIDE_FILE, "w")
         for tKey in tuning_request:
@@ -425,6 +727,9 @@ class UbuntuPgAdapter(Adapter):
             config_log_list.append(tKey + " = " + str(t_value) + self.units[tKey])
         conf_file.close()
         logging.debug('\n'.join(config_log_list))
+        # knobs left out of the new file go back to their defaults, so they changed too
+        current = self.read_override_file()
+        self.changed_knobs |= {name for name in previous.keys() | current.keys() if previous.get(name) != current.get(name)}
         # 3. Make sure conf file is referenced at the end in the main conf file
         with open(self.BASE_CONF_FILE, "r+") as main_conf_file:
             include_line = "include_dir = 'conf.d'\n"
@@ -441,6 +746,8 @@ class UbuntuPgAdapter(Adapter):
             self.abort_optimization()
 
     def revert_to_default_configuration(self):
+            # every knob of the override file goes back to its default
+            self.changed_knobs |= self.read_override_file().keys()
             if os.path.exists(self.CONF_OVERRIDE_FILE):
                 try:
                     os.remove(self.CONF_OVERRIDE_FILE)
@@ -450,7 +757,7 @@ class UbuntuPgAdapter(Adapter):
     def revert_to_default(self, job=None):
         if os.path.exists(self.CONF_OVERRIDE_FILE_PG_STATS) or os.path.exists(self.CONF_OVERRIDE_FILE):
             try:
-                self.psql("-d {} -c \"DROP EXTENSION pg_stat_statements;\"".format(self.DATABASE_NAME))
+                self.executor.execute("DROP EXTENSION pg_stat_statements")
                 os.remove(self.CONF_OVERRIDE_FILE_PG_STATS)
             except:
                 # print(self.CONF_OVERRIDE_FILE_PG_STATS + " does not exist.")
@@ -465,9 +772,10 @@ class UbuntuPgAdapter(Adapter):
             self.safely_abort()
 
     def pre_abort(self):
+        self.remove_prewarm()
         if os.path.exists(self.CONF_OVERRIDE_FILE_PG_STATS):
             try:
-                self.psql("-d {} -c \"DROP EXTENSION pg_stat_statements;\"".format(self.DATABASE_NAME))
+                self.executor.execute("DROP EXTENSION pg_stat_statements")
                 os.remove(self.CONF_OVERRIDE_FILE_PG_STATS)
             except:
                 logging.warning(self.CONF_OVERRIDE_FILE_PG_STATS + " does not exist.")
@@ -591,14 +899,20 @@ class UbuntuPgAdapter(Adapter):
                 elif response in ['N','n']:
                     logging.info("Resuming Optimization!")
 
+    def remove_prewarm(self):
+        # drops the extensions the prewarm created, every way the session ends comes through here
+        if self.prewarm is not None:
+            self.prewarm.remove()
+
     def safely_abort(self, job=None):
+        self.remove_prewarm()
         if self.ALLOW_RESTART:
             logging.info("Restarting postgres")
+            self.RESTART_IN_PROGRESS = True
             os.system(f"{self.POSTGRES_RESTART_COMMAND}")
-        state = get_connect(self.PG_ISREADY_PATH, self.PG_PORT)
-        while not state == 0:
-            if state == 2:
-                raise TuningError("FATAL ERROR: Could not restart postgresql after restoring config")
+        state = self.readiness.wait()
+        if state != READY:
+            raise TuningError("FATAL ERROR: Could not restart postgresql after restoring config ({})".format(state))
 
         logging.info("Tuning stopped. Configuration set. Postgres running.")
         if job == None:
@@ -607,18 +921,13 @@ class UbuntuPgAdapter(Adapter):
             job.update_tuning_status('completed')
         else:
             job.update_tuning_status('aborted')
+        for hook in self.exit_hooks:
+            try:
+                hook()
+            except Exception:
+                logging.exception("UbuntuPgAdapter: exit hook failed")
         os._exit(0)
 
-    def psql(self, command):
-        if self.PASSWORD_AUTH:
-            command = "{} -p {} -U {} -d {} -h localhost {}".format(self.PSQL_PATH, self.PG_PORT, self.USERNAME, self.DATABASE_NAME, command)
-        else:
-            command = "sudo -i -u postgres {} -p {} {}".format(self.PSQL_PATH, self.PG_PORT, command)
-        p1 = subprocess.Popen([command],stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-        command_output, _ = p1.communicate()
-        command_output = command_output.decode('ascii')
-        return command_output
-
 
 def current_milli_time():
     return round(time.time() * 1000)
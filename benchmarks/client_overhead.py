@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import subprocess
+import psutil
+from benchmarks.fake_platform import FakePlatform, load_script
+
+CLIENT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_INTERVAL = 1
+# metrics where a higher value in a new run than in the baseline is a regression
+COMPARED_METRICS = ["cpu_seconds_per_minute", "max_rss_bytes", "forks_per_minute", "transactions_per_minute", "bytes_uploaded_per_minute"]
+
+
+def host_forks():
+    # processes created on the whole host since boot, postgres backends included
+    with open("/proc/stat") as stat_file:
+        for line in stat_file:
+            if line.startswith("processes "):
+                return int(line.split()[1])
+    return 0
+
+
+def database_transactions(psql_path, port, database_name):
+    # every session's transactions on the database, not only the client's
+    output = subprocess.check_output(["sudo", "-i", "-u", "postgres", psql_path, "-p", str(port), "-d", database_name, "-XAt", "-c",
+                                      "SELECT xact_commit + xact_rollback FROM pg_stat_database WHERE datname = current_database()"])
+    return int(output.strip())
+
+
+def process_tree(process):
+    try:
+        return [process] + process.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+class OverheadBenchmark:
+    """Runs the client for a whole session against the fake platform and measures what it costs the host.
+
+    Transactions per minute are read from the database's transaction counters,
+    which count every session on it: the workload, the restarts of the tuning and
+    this benchmark's own reads included. They only measure the client when the
+    database is otherwise idle.
+    """
+
+    def __init__(self, database_name, port=5432, psql_path="psql", duration=None, iterations=None, session=None, answers=None):
+        self.database_name = database_name
+        self.port = port
+        self.psql_path = psql_path
+        self.duration = duration
+        self.platform = FakePlatform(iterations, session)
+        # answers to the connector's questions: standard install, superuser, port, database
+        self.answers = answers or ["Y", "postgres", str(port), database_name]
+
+    def run(self):
+        self.platform.start()
+        environment = dict(os.environ, DBTUNE_ENDPOINT=self.platform.endpoint)
+        start_forks = host_forks()
+        start_transactions = database_transactions(self.psql_path, self.port, self.database_name)
+        started = time.monotonic()
+        client = subprocess.Popen([sys.executable, "__main__.py", "benchmark-api-key", "benchmark-db"], cwd=CLIENT_DIR, env=environment,
+                                  stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client.stdin.write(("\n".join(self.answers) + "\n").encode())
+        client.stdin.flush()
+        process = psutil.Process(client.pid)
+        cpu_seconds = 0.0
+        max_rss = 0
+        try:
+            while client.poll() is None:
+                # completed means the client only monitors the installed configuration from here on
+                if self.platform.metrics()["state"] in ("completed", "aborted"):
+                    break
+                if self.duration and time.monotonic() - started >= self.duration:
+                    break
+                cpu, rss = 0.0, 0
+                for member in process_tree(process):
+                    try:
+                        times = member.cpu_times()
+                        cpu += times.user + times.system
+                        if member.pid == client.pid:
+                            # psql sessions and sudo that already exited were reaped into these
+                            cpu += times.children_user + times.children_system
+                        rss += member.memory_info().rss
+                    except psutil.NoSuchProcess:
+                        pass
+                cpu_seconds = max(cpu_seconds, cpu)
+                max_rss = max(max_rss, rss)
+                time.sleep(SAMPLE_INTERVAL)
+        finally:
+            if client.poll() is None:
+                client.send_signal(signal.SIGTERM)
+                client.wait()
+            elapsed = time.monotonic() - started
+            self.platform.stop()
+        minutes = elapsed / 60
+        platform = self.platform.metrics()
+        bytes_uploaded = sum(platform["bytes_received"].values())
+        return {
+            "duration_seconds": elapsed,
+            "iterations": platform["iterations"],
+            "exit_code": client.returncode,
+            "cpu_seconds_per_minute": cpu_seconds / minutes,
+            "max_rss_bytes": max_rss,
+            "forks_per_minute": (host_forks() - start_forks) / minutes,
+            "transactions_per_minute": (database_transactions(self.psql_path, self.port, self.database_name) - start_transactions) / minutes,
+            "bytes_uploaded_per_minute": bytes_uploaded / minutes,
+            "platform_requests": platform["requests"],
+            "platform_bytes": platform["bytes_received"],
+        }
+
+
+def compare(result, baseline, tolerance):
+    regressions = []
+    for metric in COMPARED_METRICS:
+        if baseline.get(metric) and result[metric] > baseline[metric] * (1 + tolerance):
+            regressions.append("{}: {:.2f} -> {:.2f}".format(metric, baseline[metric], result[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the client's own overhead over a full session against a local postgres")
+    parser.add_argument("database", help="database the client tunes, it should be otherwise idle")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--psql-path", default="psql")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds instead of at the end of the session")
+    parser.add_argument("--script", help="JSON file with the iterations and session settings the fake platform serves")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="results of an earlier run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative increase over the baseline")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+    iterations, session = load_script(args.script) if args.script else (None, None)
+    result = OverheadBenchmark(args.database, args.port, args.psql_path, args.duration, iterations, session).run()
+    json.dump(result, sys.stdout, indent=2)
+    print()
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(result, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            logging.error("Regression: {}".format(regression))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import re
+import sys
+import gzip
+import json
+import logging
+import argparse
+from threading import Lock, Thread
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+DEFAULT_KNOBS = [
+    {"work_mem": 4096, "random_page_cost": 4.0},
+    {"work_mem": 16384, "random_page_cost": 1.1},
+    {"work_mem": 65536, "random_page_cost": 2.0},
+]
+# adapter settings the client reads from the tuning session, kept short for local runs
+DEFAULT_SESSION = {
+    "restart_allowed": False,
+    "optimization_target": "throughput",
+    "default_performance": 1.0,
+    "WARMUP_TIME": 60,
+    "EXPERIMENT_DURATION": 60,
+}
+
+
+class FakePlatform:
+    """Local stand-in for the db/ and job/ endpoints of the platform API.
+
+    Serves a scripted list of tuning requests, accepts whatever the client posts and
+    keeps count of the calls and bytes it received, so a whole tuning session can
+    run against it with DBTUNE_ENDPOINT=http://127.0.0.1:<port>/.
+    """
+
+    def __init__(self, iterations=None, session=None, abort_after=None, host="127.0.0.1", port=0):
+        self.iterations = iterations or DEFAULT_KNOBS
+        self.session = dict(DEFAULT_SESSION, **(session or {}))
+        self.abort_after = abort_after
+        self.iteration = 0
+        self.state = "Tuning"
+        self.received = {}
+        self.lock = Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}/".format(host, port)
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever, name="fake-platform", daemon=True)
+        self.thread.start()
+        logging.info("Fake platform listening on {}".format(self.endpoint))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def metrics(self):
+        with self.lock:
+            return {
+                "iterations": self.iteration,
+                "state": self.state,
+                "requests": {name: count for name, (count, _) in self.received.items()},
+                "bytes_received": {name: size for name, (_, size) in self.received.items()},
+            }
+
+    def record(self, name, size):
+        with self.lock:
+            count, total = self.received.get(name, (0, 0))
+            self.received[name] = (count + 1, total + size)
+
+    def tuning_request(self):
+        objective = self.session["optimization_target"]
+        best = self.iterations[0]
+        if self.iteration >= len(self.iterations):
+            return {"endOfJob": True, "bestPointFound": {objective: best}, "default": best}
+        return {
+            "knobs": self.iterations[self.iteration],
+            "iteration_no": self.iteration + 1,
+            "best_found_configuration": {objective: best, "performance": {objective: self.session["default_performance"]}},
+        }
+
+    def check_state(self):
+        if self.abort_after is not None and self.iteration >= self.abort_after:
+            self.state = "aborted"
+        return {"tuning_session_state": self.state, "abort_tuning_type": "default_config" if self.state == "aborted" else None, "applied_config_on_abort": None}
+
+    def route(self, method, path, body, size):
+        match = re.match(r"^/(db|job)/([^/]+)/([a-z-]+)", path)
+        if match is None:
+            return 404, {"error": "unknown endpoint {}".format(path)}
+        kind, name = match.group(1), match.group(3)
+        self.record(name, size)
+        with self.lock:
+            if (kind, name) == ("db", "database-instance"):
+                return 200, {"db_connection_status": "f", "engine": "postgresql"}
+            if (kind, name) == ("db", "tuning-session-id"):
+                return 200, {"status": True, "tuning_session": dict(self.session, tuning_session_id=match.group(2))}
+            if name == "request":
+                return 200, self.tuning_request()
+            if name == "response":
+                self.iteration += 1
+                return 200, self.tuning_request()
+            if name == "stats":
+                return 200, self.check_state()
+            if name == "update-status":
+                self.state = json.loads(body or b"{}").get("tuning_status", self.state)
+            return 200, {}
+
+    def handler(self):
+        platform = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond("GET", b"")
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                self.respond("POST", body)
+
+            def respond(self, method, body):
+                # sizes are counted as sent, before decompressing
+                size = len(body)
+                if self.headers.get("Content-Encoding") == "gzip":
+                    body = gzip.decompress(body)
+                status, payload = platform.route(method, self.path, body, size)
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logging.debug("Fake platform: " + format % args)
+
+        return Handler
+
+
+def load_script(path):
+    """A JSON file with "iterations" (a list of knob dicts) and "session" (tuning session overrides)."""
+    with open(path) as script_file:
+        script = json.load(script_file)
+    return script.get("iterations"), script.get("session")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a scripted stand-in of the platform API")
+    parser.add_argument("--port", type=int, default=8700)
+    parser.add_argument("--script", help="JSON file with the iterations and session settings to serve")
+    parser.add_argument("--abort-after", type=int, help="report the session aborted after this many iterations")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+    iterations, session = load_script(args.script) if args.script else (None, None)
+    platform = FakePlatform(iterations, session, args.abort_after, port=args.port)
+    platform.start()
+    try:
+        platform.thread.join()
+    except KeyboardInterrupt:
+        platform.stop()
+        json.dump(platform.metrics(), sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,29 +3,41 @@ import sys
 import time
 import traceback
 import config
-import signal
 import logging
 from dbms_adapter_factory import AdapterFactory
 from dbms_connector_factory import ConnectorFactory
 from job import Job
 from connect import Connect
-from stats.stats import Stats
-from crash_detection import MemMonitoring
+from transport import Transport
+from runtime import Runtime
+from instrumentation import instrumentation
+from stats.timeseries import SampleStore
+from session_state import SessionState, CONNECTED, DEFAULT_MEASURED, CONFIG_APPLIED, MEASURED, REPORTED, POST_TUNING
 API_ENDPOINT = config.ENDPOINT
 if "DBTUNE_ENDPOINT" in os.environ:
     API_ENDPOINT = os.environ["DBTUNE_ENDPOINT"]
+SAMPLING_INTERVAL = float(os.environ.get("DBTUNE_SAMPLING_INTERVAL", config.SAMPLING_INTERVAL))
+METRICS_PORT = os.environ.get("DBTUNE_METRICS_PORT", config.METRICS_PORT)
+PROFILE = os.environ.get("DBTUNE_PROFILE", config.PROFILE)
+SAMPLE_STORE = os.environ.get("DBTUNE_SAMPLE_STORE", config.SAMPLE_STORE)
+SAMPLE_RETENTION = int(os.environ.get("DBTUNE_SAMPLE_RETENTION", config.SAMPLE_RETENTION))
+SESSION_STATE = os.environ.get("DBTUNE_SESSION_STATE", config.SESSION_STATE)
 
 def establish_database_connection(api_key, db_id):
-    connect = Connect(API_ENDPOINT, api_key, db_id)
+    transport = Transport(api_key)
+    connect = Connect(API_ENDPOINT, api_key, db_id, transport)
     # is there an active session against this db_id?
     database_instance = connect.get_database_instance()
-    connection = ConnectorFactory.get_connector(database_instance)
+    session_state = SessionState(SESSION_STATE)
+    saved = session_state.load(db_id)
+    connection = ConnectorFactory.get_connector(database_instance, saved.get("connection_details"))
     connection_details = connection.connection_details
     if database_instance["db_connection_status"] == 't':
         pass
     else: # This block will run when the client runs for the first time
         client_info = connection.get_client_info()
         connect.post_client_info(client_info)
+    connection.executor.close()
     logging.info("Waiting for tuning session to start...")
     timeout = time.time() + 60*5
     while True:
@@ -37,64 +49,113 @@ def establish_database_connection(api_key, db_id):
             break
         time.sleep(1)
     print("\n")
+    # extensions the prewarm of an interrupted run created, dropped once the adapter is up
+    prewarm_extensions = saved.get("prewarm_extensions", [])
+    if saved and saved["tuning_session_id"] != job_id:
+        logging.info("Tuning session {} is over, starting tuning session {} afresh".format(saved["tuning_session_id"], job_id))
+        session_state.clear()
+        saved = {}
+    if saved:
+        logging.info("Resuming tuning session {} after {}".format(job_id, saved["phase"]))
+    else:
+        # the password is asked again on resume rather than written to disk
+        session_state.save(db_id=db_id, tuning_session_id=job_id, phase=CONNECTED, prewarm_extensions=prewarm_extensions,
+                           connection_details={key: value for key, value in connection_details.items() if key != "password"})
     tuning_session["engine"] = database_instance["engine"]
-    tuning_session["db_version"] = client_info["DBVERSION"]
+    tuning_session["db_version"] = connection.db_version
     tuning_session = {**tuning_session, **connection_details}
-    job = Job(API_ENDPOINT, api_key, job_id)
-    db = AdapterFactory.get_adapter(tuning_session)
-    signal.signal(signal.SIGINT, lambda sig, frame: db.abort_signal_handler(sig, frame, job))
+    job = Job(API_ENDPOINT, api_key, job_id, transport)
+    db = AdapterFactory.get_adapter(tuning_session, session_state)
+    sample_store = SampleStore(SAMPLE_STORE, SAMPLE_RETENTION) if SAMPLE_STORE else None
+    runtime = Runtime(job, db, interval=SAMPLING_INTERVAL, metrics_port=int(METRICS_PORT) if METRICS_PORT else None, profile=PROFILE,
+                      sample_store=sample_store)
+    runtime.run(lambda runtime: tune(runtime, job, db, tuning_session, session_state))
+
+
+async def tune(runtime, job, db, tuning_session, session_state):
     experiment_duration = 600
-    logging.info("Monitoring default performance for {}s".format(experiment_duration))
-    stats = Stats(job, db)
-    stats.run()
-    mem_monitoring = MemMonitoring(db)
-    mem_monitoring.run()
-    if tuning_session["default_performance"] == None:
-        default_performance = db.get_metric_stats(state="monitoring")
+    if tuning_session["default_performance"] == None and not session_state.get("default_posted"):
+        default_performance = session_state.get("default_performance")
+        default_configuration = session_state.get("default_configuration")
+        if default_performance is None:
+            logging.info("Monitoring default performance for {}s".format(experiment_duration))
+            default_performance = await runtime.step(db.get_metric_stats, state="monitoring")
+            default_performance["Valid"] = "true"
+            default_configuration = await runtime.blocking(db.get_default_configuration)
+            session_state.save(phase=DEFAULT_MEASURED, default_performance=default_performance, default_configuration=default_configuration)
+        else:
+            logging.info("Reporting the default performance measured before the interruption")
         db.bestPerformance = default_performance[db.OPTIMIZATION_OBJECTIVE]
-        default_performance["Valid"] = "true"
-        default_configuration = db.get_default_configuration()
-        job.post_default_performance(default_performance, default_configuration)
+        await runtime.blocking(job.post_default_performance, default_performance, default_configuration)
+        session_state.save(default_posted=True)
 
-    tuning_request = job.get_tuning_request()
-    while "endOfJob" not in tuning_request:
+    tuning_request = await runtime.blocking(job.get_tuning_request)
+    while tuning_request is None or "endOfJob" not in tuning_request:
+        if tuning_request is None:
+            # the platform didn't answer, ask again
+            await runtime.sleep(5)
+            tuning_request = await runtime.blocking(job.get_tuning_request)
+            continue
         knobs = tuning_request["knobs"]
         db.bestPointFound = tuning_request["best_found_configuration"][db.OPTIMIZATION_OBJECTIVE]
         db.bestPerformance = tuning_request["best_found_configuration"]["performance"][db.OPTIMIZATION_OBJECTIVE]
-        state = stats.check_state
+        state = runtime.stats.check_state
         iteration = tuning_request["iteration_no"]
         if state == "Tuning":
             db.MODE = "tuning"
-            logging.info("Starting Iteration {}".format(iteration))
-            db.update_config(knobs)
-            db.restart()
-            performance_metrics = db.get_metric_stats()
-            logging.info("Iteration {} completed!\n".format(iteration))
-            tuning_request = job.iterate(performance_metrics)
+            db.ITERATION = iteration
+            with instrumentation.timer("phase", phase="iteration"):
+                if session_state.resumes(MEASURED, iteration, knobs):
+                    logging.info("Reporting iteration {} as measured before the interruption".format(iteration))
+                    performance_metrics = session_state.get("performance")
+                else:
+                    logging.info("Starting Iteration {}".format(iteration))
+                    with instrumentation.timer("phase", phase="update_config"):
+                        db.update_config(knobs)
+                    with instrumentation.timer("phase", phase="restart"):
+                        restart_report = await runtime.step(db.restart)
+                    session_state.save(phase=CONFIG_APPLIED, iteration=iteration, knobs=knobs,
+                                       best_point=db.bestPointFound, best_performance=db.bestPerformance)
+                    performance_metrics = await runtime.step(db.get_metric_stats)
+                    performance_metrics.update(restart_report)
+                    session_state.save(phase=MEASURED, performance=performance_metrics)
+                    logging.info("Iteration {} completed!\n".format(iteration))
+                with instrumentation.timer("phase", phase="report"):
+                    tuning_request = await runtime.blocking(job.iterate, performance_metrics)
+                session_state.save(phase=REPORTED, performance=None)
+            logging.info("Iteration {} client timings: {}".format(iteration, instrumentation.summary()))
+        else:
+            # the platform state arrives with the stats responses
+            await runtime.sleep(1)
 
     logging.info("Tuning session is over")
     db.MODE = "post-tuning"
+    db.ITERATION = -1
     if "bestPointFound" in tuning_request:
         bestPointFound = tuning_request["bestPointFound"][db.OPTIMIZATION_OBJECTIVE]
         if tuning_request["default"] == bestPointFound:
             logging.info("Installing the default configuration. Unable to find better configuration.")
             db.pre_abort()
-            db.restart()
+            await runtime.step(db.restart)
         else:
             logging.info("Installing the best found configuration!")
             db.update_config(bestPointFound)
-            db.restart()
+            await runtime.step(db.restart)
         # Monitoring after installing the best found configuration for 30 mins and then safely aborting the optimization.
-        job.update_tuning_status('completed')
+        await runtime.blocking(job.update_tuning_status, 'completed')
+        session_state.save(phase=POST_TUNING)
         logging.disable(logging.DEBUG)
         logging.info("Monitoring after installing the best configuration!")
-        time.sleep(600)
-        stats.abort()
-        mem_monitoring.abort()
-        db.safely_abort(job)
+        await runtime.sleep(600)
+        await runtime.stop_monitoring()
+        # before the state holding the prewarm's extensions goes
+        await runtime.step(db.remove_prewarm)
+        # nothing left to resume
+        session_state.clear()
+        await runtime.step(db.safely_abort, job)
     else:
         logging.error("Error: Couldn't apply best point found")
 
-    while not state == "completed":
-        time.sleep(600)
-        tuning_request = job.get_tuning_request()
\ No newline at end of file
+    while not runtime.stats.check_state == "completed":
+        await runtime.sleep(600)
+        tuning_request = await runtime.blocking(job.get_tuning_request)
@@ -0,0 +1,18 @@
+import time
+from threading import Condition
+
+
+class SystemClock:
+    """Real time, as the client sees it outside of simulations."""
+
+    def time(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def condition(self):
+        return Condition()
@@ -1,3 +1,20 @@
 API_KEY = "SOME API KEY"
 DB_ID = "SOME JOB ID"
 ENDPOINT = "https://76lef45sf7.execute-api.us-east-2.amazonaws.com/prod/"
+SAMPLING_INTERVAL = 1
+# port of the local Prometheus metrics endpoint, off when None
+METRICS_PORT = None
+# "cprofile" or "sampling" to profile the client for the whole session
+PROFILE = None
+# local ring buffer of the per second samples, off when None
+SAMPLE_STORE = "dbtune_samples.bin"
+# samples kept in it before the oldest are overwritten
+SAMPLE_RETENTION = 86400
+# progress of the tuning session, resumed after the client restarts, off when None
+SESSION_STATE = "dbtune_session.json"
+# facts about the host that are probed once and reused by later runs, off when None
+INVENTORY_CACHE = "dbtune_inventory.json"
+# JSON file with the connection details for an unattended start, see the README
+CONNECTION_PROFILE = None
+# fingerprint of the last validated connection profile, off when None
+CONNECTION_CACHE = "dbtune_connection.json"
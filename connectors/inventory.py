@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import logging
+import psutil
+import threading
+from pg_executor import QueryError
+from stats.disk_stats import DiskSampler, device_number, rotational
+
+# seconds all probes together may take, the ones still running then are sent as last known
+BUDGET = 10
+# relation files of every tablespace, the shared catalogs included, and the WAL
+DATABASE_SIZE = """SELECT (SELECT sum(pg_tablespace_size(oid)) FROM pg_tablespace)
+    + coalesce((SELECT sum(size) FROM pg_ls_waldir()), 0)"""
+TABLESPACE_SIZE = "SELECT sum(pg_tablespace_size(oid)) FROM pg_tablespace"
+# facts that don't change while the host, its postgres and its disks stay the same
+STATIC_FACTS = ("CLOUDPROVIDER", "INSTANCETYPE", "HDTYPE")
+# sent for a fact that couldn't be probed and wasn't known from an earlier run, what the du/df/lsblk
+# commands used to yield for sizes they couldn't read, and the disk type most hosts have
+UNKNOWN = {"DATABASESIZE": 0, "MAXCONNECTIONS": 100, "DISKSIZE": 0, "AVAILABLEMEMORY": 0, "HDTYPE": "ssd"}
+
+
+def machine_id():
+    try:
+        with open("/etc/machine-id") as machine_id_file:
+            return machine_id_file.read().strip()
+    except OSError:
+        return None
+
+
+def cloud_and_instance_type():
+    try:
+        with open('/run/cloud-init/instance-data.json', 'r') as f:
+            meta_data = json.load(f)
+        cloud_name = meta_data['v1']['cloud-name']
+        if cloud_name == 'aws':
+            instance_type = meta_data['ds']['dynamic']['instance-identity']['document']['instanceType']
+        elif cloud_name == 'azure':
+            instance_type = meta_data['ds']['meta_data']['imds']['compute']['vmSize']
+        else:
+            instance_type = '-'
+    except Exception:
+        instance_type = '-'
+        cloud_name = '-'
+    return cloud_name, instance_type
+
+
+class Inventory:
+    """Collects the host and database facts sent as client info without walking the data directory.
+
+    The database size comes from pg_tablespace_size and pg_ls_waldir, the disk size
+    from statvfs and the disk type from sysfs. The probes run concurrently and
+    whatever hasn't answered within the budget is sent as measured by an earlier
+    run, or as a stand-in from UNKNOWN. Facts that don't change between runs, and
+    the last value of the others, are cached in cache_path, keyed by the host, the
+    data directory and the device it is on.
+    """
+
+    def __init__(self, executor, data_directory, cache_path=None, budget=BUDGET):
+        self.executor = executor
+        self.data_directory = data_directory
+        self.cache_path = cache_path
+        self.budget = budget
+
+    def collect(self):
+        started = time.monotonic()
+        fingerprint = self.fingerprint()
+        cache = self.load_cache(fingerprint)
+        cached, last_known = cache.get("facts", {}), cache.get("last_known", {})
+        probes = {
+            "DATABASESIZE": self.database_size,
+            "MAXCONNECTIONS": lambda: self.executor.query_value("SELECT current_setting('max_connections')", int),
+            "DISKSIZE": self.disk_size,
+            "AVAILABLEMEMORY": lambda: psutil.virtual_memory().available,
+        }
+        if not cached:
+            probes["HDTYPE"] = self.disk_type
+            probes["CLOUD"] = cloud_and_instance_type
+        results = {}
+
+        def run(name, probe):
+            try:
+                results[name] = (probe(), None)
+            except Exception as err:
+                results[name] = (None, err)
+
+        # daemon threads, so a probe stuck on a hung mount holds up neither the start nor the exit
+        threads = [threading.Thread(target=run, args=item, name="dbtune-inventory", daemon=True) for item in probes.items()]
+        for thread in threads:
+            thread.start()
+        deadline = time.monotonic() + self.budget
+        for thread in threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        # a probe that answers after the budget doesn't change what is sent
+        results = dict(results)
+        facts = dict(cached)
+        for name in probes:
+            value, err = results.get(name, (None, None))
+            if name not in results:
+                logging.warning("Inventory: {} not known within {}s".format(name, self.budget))
+            elif err is not None:
+                logging.warning("Inventory: couldn't get {} ({})".format(name, err))
+            if name == "CLOUD":
+                facts["CLOUDPROVIDER"], facts["INSTANCETYPE"] = value or ('-', '-')
+            elif value is not None:
+                facts[name] = value
+            elif last_known.get(name) is not None:
+                logging.warning("Inventory: sending {} from an earlier run".format(name))
+                facts[name] = last_known[name]
+            else:
+                logging.warning("Inventory: sending {} as unknown ({!r})".format(name, UNKNOWN[name]))
+                facts[name] = UNKNOWN[name]
+        measured = {name: value for name, (value, err) in results.items() if value is not None and name != "CLOUD"}
+        # static facts are cached once all of them were probed, a stand-in is never cached as one
+        if not cached and "HDTYPE" in measured and "CLOUD" in results:
+            cached = {name: facts[name] for name in STATIC_FACTS}
+        self.save_cache(fingerprint, cached, dict(last_known, **measured))
+        logging.debug("Inventory: collected in {:.2f}s{}".format(time.monotonic() - started, " (static facts cached)" if cached else ""))
+        return facts
+
+    def database_size(self):
+        try:
+            return self.executor.query_value(DATABASE_SIZE, int)
+        except QueryError:
+            # listing the WAL needs superuser or pg_monitor
+            return self.executor.query_value(TABLESPACE_SIZE, int)
+
+    def disk_size(self):
+        stat = os.statvfs(self.data_directory)
+        return stat.f_blocks * stat.f_frsize
+
+    def disk_type(self):
+        devices = DiskSampler.resolve_devices(self.data_directory)
+        return "hdd" if any(rotational(device) for device in devices) else "ssd"
+
+    def fingerprint(self):
+        try:
+            device = device_number(self.data_directory)
+        except OSError:
+            device = None
+        return {"machine_id": machine_id(), "data_directory": self.data_directory, "device": device,
+                "cpus": psutil.cpu_count(), "memory": psutil.virtual_memory().total}
+
+    def load_cache(self, fingerprint):
+        """The cached static facts and the last values measured of the others, when the host is unchanged."""
+        if not self.cache_path:
+            return {}
+        try:
+            with open(self.cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except (OSError, ValueError):
+            return {}
+        if cache.get("fingerprint") != fingerprint:
+            logging.info("Inventory: host changed since {} was written, probing again".format(self.cache_path))
+            return {}
+        return cache
+
+    def save_cache(self, fingerprint, facts, last_known):
+        if not self.cache_path:
+            return
+        temporary = self.cache_path + ".tmp"
+        try:
+            with open(temporary, "w") as cache_file:
+                json.dump({"fingerprint": fingerprint, "facts": facts, "last_known": last_known}, cache_file)
+            os.replace(temporary, self.cache_path)
+        except OSError as err:
+            logging.warning("Inventory: couldn't write {} ({})".format(self.cache_path, err))
@@ -12,29 +12,40 @@ import json
 from TuningError import TuningError
 import getpass
 from connectors.connector import Connector
+from pg_executor import PgExecutor
+from readiness import ReadinessProbe, READY
+from connectors.inventory import Inventory
+from connectors.profile import ConnectionProfile
+import config
 
-def get_connect(pg_isready_path, port):
-    p1 = subprocess.Popen([pg_isready_path, "-h", "localhost", "-p", str(port)],stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    command_output, _ = p1.communicate()
-    logging.debug(command_output.decode('ascii').strip())
-    return p1.returncode
+INVENTORY_CACHE = os.environ.get("DBTUNE_INVENTORY_CACHE", config.INVENTORY_CACHE)
+CONNECTION_PROFILE = os.environ.get("DBTUNE_CONNECTION_PROFILE", config.CONNECTION_PROFILE)
+CONNECTION_CACHE = os.environ.get("DBTUNE_CONNECTION_CACHE", config.CONNECTION_CACHE)
 
 
 class LinuxPgConnector(Connector):
-    def __init__(self, connector_data):
+    def __init__(self, connector_data, connection_details=None):
         user=os.popen("whoami").read().strip()
         if user!="root":
             sys.exit("You need to run the dbtune swclient as a root user")
         logging.info("Initiating LinuxPgConnector")
-        self.connection_details = self.establish_connection()
-
-        state = get_connect(self.connection_details["pg_isready_path"], self.connection_details["port"])
-        while not state == 0:
-            if state == 2:
-                sys.exit("Unable to connect to postgres")
-        postgres_server_version = self.psql("-At -c \"show server_version;\"").readlines()[-1].split(' ')[0].strip()
+        profile = None if connection_details else ConnectionProfile.from_environment(CONNECTION_PROFILE, CONNECTION_CACHE)
+        if connection_details:
+            self.connection_details = self.resume_connection(connection_details)
+        elif profile:
+            # unattended start, nothing is asked
+            self.connection_details = profile.connection_details()
+        else:
+            self.connection_details = self.establish_connection()
+
+        # postgres may still be starting up or recovering, but it has to be running
+        state = ReadinessProbe(self.connection_details["port"], database=self.connection_details["database_name"]).wait(down_timeout=0)
+        if state != READY:
+            sys.exit("Unable to connect to postgres ({})".format(state))
+        self.executor = PgExecutor.from_connection_details(self.connection_details, pool_size=1)
+        postgres_server_version = self.executor.query_value("SELECT current_setting('server_version')").split(' ')[0].strip()
         self.postgres_major_version = postgres_server_version.split('.')[0].strip()
-        postgres_client_version = self.psql("-At -V").readlines()[-1].split(' ')[2].strip()
+        postgres_client_version = subprocess.check_output([self.connection_details["psql_path"], "-V"]).decode('ascii').split(' ')[2].strip()
         self.db_version = postgres_server_version
         self.os_type = platform.system()
         self.memory = psutil.virtual_memory().total
@@ -47,14 +58,22 @@ class LinuxPgConnector(Connector):
         client_info_log_list.append('PostgreSQL-server-version:'+ postgres_server_version)
         logging.info('\n'.join(client_info_log_list))
 
+    def resume_connection(self, connection_details):
+        """Reuses the connection details of an interrupted session, asking only for the password, which isn't saved."""
+        db_connection_details = dict(connection_details)
+        if db_connection_details["password_auth"]:
+            password = os.environ.get("PGPASSWORD") or getpass.getpass("Enter the password for the postgres superuser: ")
+            os.environ["PGPASSWORD"] = password
+            db_connection_details["password"] = password
+        logging.info("Resuming with the connection to database {} on port {}".format(db_connection_details["database_name"], db_connection_details["port"]))
+        return db_connection_details
+
     def establish_connection(self):
         db_connection_details = {}
 
-        # Do they have iostat (sysstat) installed?
-        try:
-            subprocess.check_output('iostat', shell=True)
-        except:
-            logging.info(f"iostat threw an error. Please make sure the package sysstat is installed on your machine. Install with: sudo apt-get install sysstat, or corresponding on your system.")
+        # Disk metrics are read from /proc/diskstats
+        if not os.path.exists("/proc/diskstats"):
+            logging.info("/proc/diskstats is not available, disk metrics can't be collected on this system.")
             sys.exit()
 
         # Do they have a default installation of postgres or not?
@@ -186,47 +205,10 @@ class LinuxPgConnector(Connector):
 
     def get_client_info(self):
         logging.info("Getting client's system and DBMS information")
-        client_info = {}
+        data_directory_path = self.executor.query_value("SELECT current_setting('data_directory')")
+        client_info = Inventory(self.executor, data_directory_path, INVENTORY_CACHE).collect()
         client_info["DBVERSION"] = self.db_version
         client_info["OSTYPE"] = self.os_type
         client_info["NUMOFCPU"] = self.no_of_cpu
-        client_info["MAXCONNECTIONS"] = int(self.psql("-At -c \"show max_connections;\"").readlines()[-1].strip())
         client_info["TOTALMEMORY"] = self.memory
-        client_info["AVAILABLEMEMORY"] = psutil.virtual_memory().available
-        cloud_provider, instance_type = self.get_cloud_and_instance_info()
-        client_info["CLOUDPROVIDER"] =  cloud_provider
-        client_info["INSTANCETYPE"] = instance_type
-        data_directory_path = self.psql("-At -c \"show data_directory;\"").readlines()[-1].strip()
-        client_info["DATABASESIZE"] = os.popen('sudo du -sb {}'.format(data_directory_path)).read().split('\t')[0]
-        disk_info = os.popen('sudo df {}'.format(data_directory_path)).readlines()[1].split()
-        client_info["DISKSIZE"] = int(disk_info[1])*1024
-        hdd = bool(int(os.popen('lsblk {} -o name,rota'.format(disk_info[0])).readlines()[1].strip().split()[1]))
-        if hdd:
-            client_info["HDTYPE"] = "hdd"
-        else:
-            client_info["HDTYPE"] = "ssd"
         return client_info
-
-    def psql(self, command):
-        if self.connection_details["password_auth"]:
-            command = "{} -p {} -U {} -d {} -h localhost {}".format(self.connection_details["psql_path"], self.connection_details["port"], self.connection_details["username"], self.connection_details["database_name"], command)
-        else:
-            command = "sudo -i -u postgres {} -p {} {}".format(self.connection_details["psql_path"], self.connection_details["port"], command)
-        logging.debug(command)
-        return os.popen(command)
-
-    def get_cloud_and_instance_info(self):
-        try:
-            with open('/run/cloud-init/instance-data.json', 'r') as f:
-                meta_data=json.load(f)
-            cloud_name = meta_data['v1']['cloud-name']
-            if cloud_name == 'aws':
-                instance_type = meta_data['ds']['dynamic']['instance-identity']['document']['instanceType']
-            elif cloud_name == 'azure':
-                instance_type = meta_data['ds']['meta_data']['imds']['compute']['vmSize']
-            else:
-                instance_type = '-'
-        except:
-            instance_type = '-'
-            cloud_name = '-'
-        return cloud_name, instance_type
\ No newline at end of file
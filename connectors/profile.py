@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import shutil
+import hashlib
+import logging
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from connectors.inventory import machine_id
+
+# environment variables that set, or override, the fields of a connection profile
+VARIABLES = {
+    "DBTUNE_PG_DATABASE": "database_name",
+    "DBTUNE_PG_USER": "username",
+    "DBTUNE_PG_PORT": "port",
+    "DBTUNE_PG_BINARIES": "binaries_path",
+    "DBTUNE_PG_RESTART_COMMAND": "postgres_restart_command",
+    "DBTUNE_PG_STAT_STATEMENTS_RESTART": "pg_stat_statements_restart",
+}
+DEFAULTS = {
+    "username": "postgres",
+    "port": 5432,
+    "binaries_path": None,
+    "postgres_restart_command": "systemctl restart postgresql",
+    "pg_stat_statements_restart": False,
+}
+# seconds each validation command may take
+PROBE_TIMEOUT = 30
+
+
+def read_profile(path=None, environ=os.environ):
+    """The profile from the JSON file at path with the environment variables on top, None when neither names a database."""
+    profile = {}
+    if path:
+        try:
+            with open(path) as profile_file:
+                profile = json.load(profile_file)
+        except (OSError, ValueError) as err:
+            sys.exit("Unable to read the connection profile {} ({})".format(path, err))
+    for variable, field in VARIABLES.items():
+        if environ.get(variable):
+            profile[field] = environ[variable]
+    if not profile.get("database_name"):
+        return None
+    return {**DEFAULTS, **profile}
+
+
+def connection_details_of(profile, environ=os.environ):
+    binaries_path = profile["binaries_path"]
+    username = profile["username"]
+    password_auth = username != "postgres"
+    try:
+        port = int(profile["port"])
+    except ValueError:
+        sys.exit("Invalid port {} in the connection profile".format(profile["port"]))
+    if password_auth and not environ.get("PGPASSWORD"):
+        sys.exit("PGPASSWORD has to be set to connect as {}".format(username))
+    return {
+        "psql_path": os.path.join(binaries_path, "psql") if binaries_path else "psql",
+        "pg_isready_path": os.path.join(binaries_path, "pg_isready") if binaries_path else "pg_isready",
+        "username": username,
+        "password": environ.get("PGPASSWORD", "") if password_auth else "",
+        "password_auth": password_auth,
+        "port": port,
+        "database_name": profile["database_name"],
+        "postgres_restart_command": profile["postgres_restart_command"],
+        # whether postgres may be restarted once to load pg_stat_statements when restarts aren't allowed
+        "pg_stat_statements_restart": str(profile["pg_stat_statements_restart"]).lower() in ("true", "on", "yes", "1"),
+        # the adapter asks nothing either, the checks above vouch for the restart command
+        "unattended": True,
+    }
+
+
+def fingerprint(details):
+    """Digest of the profile and of the parts of the host it was validated against."""
+    binaries = []
+    for name in ("psql_path", "pg_isready_path"):
+        path = shutil.which(details[name])
+        stat = os.stat(path) if path else None
+        binaries.append([path, stat.st_size, stat.st_mtime_ns] if stat else None)
+    facts = {"machine_id": machine_id(), "binaries": binaries,
+             "details": {key: value for key, value in details.items() if key != "password"}}
+    return hashlib.sha256(json.dumps(facts, sort_keys=True).encode()).hexdigest()
+
+
+def run(command, environ=None):
+    try:
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=PROBE_TIMEOUT, env=environ)
+    except (OSError, subprocess.TimeoutExpired) as err:
+        return str(err)
+    if result.returncode != 0:
+        return result.stdout.decode("utf-8", "replace").strip() or "exit code {}".format(result.returncode)
+    return None
+
+
+def check_diskstats(details):
+    if not os.path.exists("/proc/diskstats"):
+        return "/proc/diskstats is not available, disk metrics can't be collected on this system"
+
+
+def check_psql(details):
+    query = ["-At", "-c", "show server_version;"]
+    if details["password_auth"]:
+        command = [details["psql_path"], "-p", str(details["port"]), "-U", details["username"], "-d", details["database_name"], "-h", "localhost"]
+        error = run(command + query, {**os.environ, "PGPASSWORD": details["password"]})
+    else:
+        command = ["sudo", "-i", "-u", "postgres", details["psql_path"], "-p", str(details["port"]), "-d", details["database_name"]]
+        error = run(command + query)
+    if error:
+        return "psql can't connect to {} on port {}: {}".format(details["database_name"], details["port"], error)
+
+
+def check_pg_isready(details):
+    error = run([details["pg_isready_path"], "-h", "localhost", "-p", str(details["port"]), "-U", details["username"]])
+    if error:
+        return "pg_isready reports postgres isn't accepting connections on port {}: {}".format(details["port"], error)
+
+
+def check_restart_command(details):
+    status_command = details["postgres_restart_command"].replace("restart", "status")
+    try:
+        result = subprocess.run(status_command, shell=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=PROBE_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        return "The command: {} didn't finish within {}s".format(status_command, PROBE_TIMEOUT)
+    if result.returncode != 0:
+        return "The command: {} threw an error".format(status_command)
+
+
+CHECKS = (check_diskstats, check_psql, check_pg_isready, check_restart_command)
+
+
+def validate(details):
+    """Runs the checks the interactive setup runs one after the other at once, returns what failed."""
+    with ThreadPoolExecutor(max_workers=len(CHECKS), thread_name_prefix="dbtune-profile") as pool:
+        return [problem for problem in pool.map(lambda check: check(details), CHECKS) if problem]
+
+
+class ConnectionProfile:
+    """Connection details for an unattended start, from a profile file and environment variables.
+
+    A validated profile is cached with a fingerprint of the profile, the host and
+    the postgres binaries. Later starts with the same fingerprint skip the
+    validation, so the client reaches monitoring without running any command.
+    """
+
+    def __init__(self, profile, cache_path=None):
+        self.profile = profile
+        self.cache_path = cache_path
+
+    @classmethod
+    def from_environment(cls, path=None, cache_path=None):
+        profile = read_profile(path)
+        return cls(profile, cache_path) if profile else None
+
+    def connection_details(self):
+        details = connection_details_of(self.profile)
+        digest = fingerprint(details)
+        if self.cached_fingerprint() == digest:
+            logging.info("Using the connection profile validated before, skipping the validation")
+            return details
+        logging.info("Validating the connection profile")
+        problems = validate(details)
+        if problems:
+            sys.exit("The connection profile doesn't work:\n" + "\n".join(problems))
+        self.save(digest)
+        return details
+
+    def cached_fingerprint(self):
+        if not self.cache_path:
+            return None
+        try:
+            with open(self.cache_path) as cache_file:
+                return json.load(cache_file).get("fingerprint")
+        except (OSError, ValueError):
+            return None
+
+    def save(self, digest):
+        if not self.cache_path:
+            return
+        temporary = self.cache_path + ".tmp"
+        try:
+            with open(temporary, "w") as cache_file:
+                json.dump({"fingerprint": digest}, cache_file)
+            os.replace(temporary, self.cache_path)
+        except OSError as err:
+            logging.warning("Couldn't cache the validated connection profile in {} ({})".format(self.cache_path, err))
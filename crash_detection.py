@@ -1,36 +1,413 @@
-import math
+import os
+import re
+import glob
 import time
+import select
+import struct
+import ctypes
+import ctypes.util
 import logging
 import psutil
-import os
+from collections import deque
 from threading import Thread
-import subprocess
+
+PSI_SYSTEM_PATH = "/proc/pressure/memory"
+CGROUP_ROOT = "/sys/fs/cgroup"
+# wake up when tasks were fully stalled on memory for 150ms within any 1s window
+PSI_TRIGGER = b"full 150000 1000000\0"
+POLL_INTERVAL = 2
+SLOPE_WINDOW = 30
+EXHAUSTION_HORIZON = 30
+LOW_AVAILABLE_FRACTION = 0.2
+CRITICAL_AVAILABLE_FRACTION = 0.02
+SWAP_IN_RATE = 10 * 1024 * 1024
+SWAP_IN_SAMPLES = 3
+
+# reason codes left in db.CRASH_REASON
+MEMORY_PRESSURE = "memory_pressure"
+OOM_KILL = "oom_kill"
+MEMORY_LIMIT = "memory_limit"
+SWAP_THRASHING = "swap_thrashing"
+MEMORY_EXHAUSTION = "memory_exhaustion"
+
+
+def signal_crash(db, reason, detail):
+    if db.CRASH_DETECTED:
+        return
+    logging.warning("Crash detection: {} ({})".format(reason, detail))
+    db.CRASH_REASON = reason
+    db.CRASH_DETECTED = True
+    with db.CRASH_DETECTION:
+        db.CRASH_DETECTION.notify_all()
+
+
+def postmaster_pid(data_directory):
+    try:
+        with open(os.path.join(data_directory, "postmaster.pid")) as pid_file:
+            return int(pid_file.readline())
+    except (OSError, ValueError):
+        return None
+
+
+def postgres_cgroup(data_directory):
+    pid = postmaster_pid(data_directory)
+    if pid is None:
+        return None
+    try:
+        with open("/proc/{}/cgroup".format(pid)) as cgroup_file:
+            for line in cgroup_file:
+                if line.startswith("0::"):
+                    return CGROUP_ROOT + line[3:].strip()
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def read_memory_events(fd):
+    # reading through the polled descriptor is what re-arms its kernfs notification
+    events = {}
+    for line in os.pread(fd, 4096, 0).decode().splitlines():
+        name, value = line.split()
+        events[name] = int(value)
+    return events
 
 
 class MemMonitoring:
-    def __init__(self, db):
-        #Default config
-        self.thread = None
+    """Memory watchdog woken by PSI triggers and cgroup memory.events, with a low rate poll behind them."""
+
+    def __init__(self, db, poll_interval=POLL_INTERVAL):
         self.db = db
+        self.poll_interval = poll_interval
+        self.thread = None
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.available = deque(maxlen=max(2, int(SLOPE_WINDOW / poll_interval)))
+        self.swap_in = deque(maxlen=SWAP_IN_SAMPLES + 1)
+        self.memory_events = None
+        self.memory_events_fd = None
 
-    def run(self):
-        memory = psutil.virtual_memory()._asdict()
-        if float(memory["percent"]) > 90:
-            self.db.CRASH_DETECTED = True
-            with self.db.CRASH_DETECTION:
-                self.db.CRASH_DETECTION.notify()
-
-        time.sleep(0.1)
-        self.thread = Thread(target=self.check_memory)
-        self.thread.daemon = True
+    def start(self):
+        self.thread = Thread(target=self.run, name="memory-watchdog", daemon=True)
         self.thread.start()
 
-    def abort(self):
+    def stop(self):
+        os.write(self.wakeup_write, b"x")
         if self.thread is not None:
             self.thread.join()
             logging.debug("Crash detection aborted")
 
+    def run(self):
+        poller = select.poll()
+        poller.register(self.wakeup_read, select.POLLIN)
+        watched = {}
+        cgroup = postgres_cgroup(self.db.PG_DATA_DIRECTORY)
+        psi_fd = self.open_psi_trigger(os.path.join(cgroup, "memory.pressure") if cgroup else None)
+        if psi_fd is not None:
+            poller.register(psi_fd, select.POLLPRI)
+            watched[psi_fd] = self.on_pressure
+        events_fd = self.open_memory_events(cgroup)
+        if events_fd is not None:
+            poller.register(events_fd, select.POLLPRI | select.POLLERR)
+            watched[events_fd] = self.on_memory_events
+        if not watched:
+            logging.info("Crash detection: PSI and cgroup memory events unavailable, polling memory every {}s".format(self.poll_interval))
+        try:
+            while True:
+                for fd, event in poller.poll(self.poll_interval * 1000):
+                    if fd == self.wakeup_read:
+                        return
+                    if event & select.POLLERR and fd == psi_fd:
+                        # the trigger goes away with its cgroup, keep going on the poll
+                        poller.unregister(fd)
+                        continue
+                    watched[fd]()
+                self.check_memory()
+        finally:
+            for fd in watched:
+                os.close(fd)
+
+    def open_psi_trigger(self, cgroup_pressure):
+        for path in (cgroup_pressure, PSI_SYSTEM_PATH):
+            if path and os.path.exists(path):
+                try:
+                    fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+                    os.write(fd, PSI_TRIGGER)
+                    logging.debug("Crash detection: PSI trigger armed on {}".format(path))
+                    return fd
+                except OSError as err:
+                    logging.debug("Crash detection: can't arm PSI trigger on {}: {}".format(path, err))
+        return None
+
+    def open_memory_events(self, cgroup):
+        if cgroup is None or not os.path.exists(os.path.join(cgroup, "memory.events")):
+            return None
+        self.memory_events_fd = os.open(os.path.join(cgroup, "memory.events"), os.O_RDONLY)
+        self.memory_events = read_memory_events(self.memory_events_fd)
+        return self.memory_events_fd
+
+    def on_pressure(self):
+        signal_crash(self.db, MEMORY_PRESSURE, "PSI full memory stall over {}".format(PSI_TRIGGER.decode().strip("\0")))
+
+    def on_memory_events(self):
+        events = read_memory_events(self.memory_events_fd)
+        previous, self.memory_events = self.memory_events, events
+        if events.get("oom_kill", 0) > previous.get("oom_kill", 0):
+            signal_crash(self.db, OOM_KILL, "{} process(es) OOM killed in the postgres cgroup".format(events["oom_kill"] - previous.get("oom_kill", 0)))
+        elif events.get("max", 0) > previous.get("max", 0):
+            signal_crash(self.db, MEMORY_LIMIT, "postgres cgroup hit memory.max")
+
     def check_memory(self):
-        logging.debug("Stats flushing")
-        self.run()
+        now = time.monotonic()
+        memory = psutil.virtual_memory()
+        self.available.append((now, memory.available))
+        self.swap_in.append((now, psutil.swap_memory().sin))
+        if memory.available < memory.total * CRITICAL_AVAILABLE_FRACTION:
+            signal_crash(self.db, MEMORY_EXHAUSTION, "{:.1f}% memory available".format(100 * memory.available / memory.total))
+            return
+        if len(self.swap_in) == self.swap_in.maxlen:
+            rates = [(b[1] - a[1]) / (b[0] - a[0]) for a, b in zip(self.swap_in, list(self.swap_in)[1:]) if b[0] > a[0]]
+            if rates and min(rates) > SWAP_IN_RATE:
+                signal_crash(self.db, SWAP_THRASHING, "swapping in {:.1f}MB/s".format(min(rates) / 1024 ** 2))
+                return
+        if len(self.available) == self.available.maxlen and memory.available < memory.total * LOW_AVAILABLE_FRACTION:
+            (t0, a0), (t1, a1) = self.available[0], self.available[-1]
+            slope = (a1 - a0) / (t1 - t0) if t1 > t0 else 0
+            if slope < 0 and memory.available / -slope < EXHAUSTION_HORIZON:
+                signal_crash(self.db, MEMORY_EXHAUSTION, "available memory runs out in {:.0f}s".format(memory.available / -slope))
+
+
+KMSG_PATH = "/dev/kmsg"
+DEBIAN_LOG_GLOB = "/var/log/postgresql/postgresql-*.log"
+PID_POLL_INTERVAL = 1
+IN_MODIFY = 0x00000002
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+INOTIFY_EVENT = struct.Struct("iIII")
+
+POSTMASTER_EXIT = "postmaster_exit"
+BACKEND_CRASH = "backend_crash"
+CRASH_RECOVERY = "crash_recovery"
+
+SERVER_LOG_PATTERNS = [
+    (re.compile(r"terminated by signal|was terminated by exception"), BACKEND_CRASH),
+    (re.compile(r"all server processes terminated; reinitializing|database system is in recovery mode|"
+                r"database system was interrupted|terminating any other active server processes"), CRASH_RECOVERY),
+]
+KMSG_OOM_PATTERN = re.compile(r"Killed process \d+ \(postgres\)|oom-kill:.*task=postgres")
+
+
+class Inotify:
+    """Minimal inotify binding, the standard library doesn't have one."""
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(path))
+        return wd
+
+    def read(self):
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, _, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+            offset += INOTIFY_EVENT.size
+            name = buffer[offset:offset + length].rstrip(b"\0").decode()
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class CrashDetector:
+    """Wakes CRASH_DETECTION when the postmaster dies, a backend crashes or the kernel OOM kills postgres."""
+
+    def __init__(self, db):
+        self.db = db
+        self.thread = None
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        self.pid = None
+        self.pidfd = None
+        self.log_path = self.find_server_log()
+        self.log_file = None
+        self.log_buffer = ""
+
+    def find_server_log(self):
+        try:
+            current = self.db.executor.query_value("SELECT pg_current_logfile()")
+        except Exception:
+            current = None
+        if current:
+            return current if os.path.isabs(current) else os.path.join(self.db.PG_DATA_DIRECTORY, current)
+        # logging_collector is off, Debian's pg_ctlcluster sends stderr to /var/log/postgresql
+        candidates = glob.glob(DEBIAN_LOG_GLOB)
+        return max(candidates, key=os.path.getmtime) if candidates else None
+
+    def start(self):
+        self.thread = Thread(target=self.run, name="crash-detector", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        os.write(self.wakeup_write, b"x")
+        if self.thread is not None:
+            self.thread.join()
+            logging.debug("Crash detector stopped")
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self.wakeup_read, select.POLLIN)
+        inotify = self.open_log_watch()
+        if inotify is not None:
+            poller.register(inotify.fd, select.POLLIN)
+        kmsg = self.open_kmsg()
+        if kmsg is not None:
+            poller.register(kmsg, select.POLLIN)
+        try:
+            while True:
+                if self.pidfd is None:
+                    self.watch_postmaster(poller)
+                for fd, event in poller.poll(PID_POLL_INTERVAL * 1000):
+                    if fd == self.wakeup_read:
+                        return
+                    if fd == self.pidfd:
+                        poller.unregister(fd)
+                        self.on_postmaster_exit()
+                    elif inotify is not None and fd == inotify.fd:
+                        self.on_log_events(inotify.read())
+                    elif fd == kmsg:
+                        self.on_kmsg(kmsg)
+                if self.pidfd is None and self.pid is not None and not pid_alive(self.pid):
+                    # no pidfd support, the liveness check runs once per poll timeout instead
+                    self.on_postmaster_exit()
+        finally:
+            for fd in (self.pidfd, kmsg):
+                if fd is not None:
+                    os.close(fd)
+            if inotify is not None:
+                inotify.close()
+
+    def restarting(self):
+        return self.db.RESTART_IN_PROGRESS
+
+    def watch_postmaster(self, poller):
+        pid = postmaster_pid(self.db.PG_DATA_DIRECTORY)
+        if pid is None:
+            self.pid = None
+            return
+        if not pid_alive(pid):
+            return
+        if pid != self.pid:
+            logging.debug("Crash detector: watching postmaster {}".format(pid))
+        self.pid = pid
+        if hasattr(os, "pidfd_open"):
+            try:
+                self.pidfd = os.pidfd_open(pid)
+                poller.register(self.pidfd, select.POLLIN)
+            except OSError:
+                self.pidfd = None
+
+    def on_postmaster_exit(self):
+        if self.pidfd is not None:
+            os.close(self.pidfd)
+            self.pidfd = None
+        pid, self.pid = self.pid, None
+        if not self.restarting():
+            signal_crash(self.db, POSTMASTER_EXIT, "postmaster {} exited".format(pid))
+
+    def open_log_watch(self):
+        if self.log_path is None:
+            logging.info("Crash detector: server log not found, only watching the postmaster and kernel log")
+            return None
+        try:
+            inotify = Inotify()
+            # the directory watch also sees the file being replaced on rotation
+            inotify.watch(os.path.dirname(self.log_path), IN_MODIFY | IN_CREATE | IN_MOVED_TO)
+        except OSError as err:
+            logging.info("Crash detector: can't watch {}: {}".format(self.log_path, err))
+            return None
+        self.open_log(os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0)
+        return inotify
+
+    def open_log(self, position=0):
+        if self.log_file is not None:
+            self.log_file.close()
+        self.log_file = None
+        self.log_buffer = ""
+        try:
+            self.log_file = open(self.log_path, errors="replace")
+            self.log_file.seek(position)
+        except OSError:
+            pass
+
+    def on_log_events(self, events):
+        for _, mask, name in events:
+            path = os.path.join(os.path.dirname(self.log_path), name)
+            if mask & (IN_CREATE | IN_MOVED_TO) and name.endswith(".log") and path != self.log_path:
+                # the collector rotated to a new file
+                self.log_path = path
+                self.open_log()
+            elif path == self.log_path and mask & (IN_CREATE | IN_MOVED_TO):
+                self.open_log()
+        if self.log_file is None:
+            return
+        if os.fstat(self.log_file.fileno()).st_size < self.log_file.tell():
+            # truncated in place by copytruncate style rotation
+            self.log_file.seek(0)
+        self.log_buffer += self.log_file.read()
+        *lines, self.log_buffer = self.log_buffer.split("\n")
+        for line in lines:
+            self.match_log_line(line)
+
+    def match_log_line(self, line):
+        if self.restarting():
+            return
+        for pattern, reason in SERVER_LOG_PATTERNS:
+            if pattern.search(line):
+                signal_crash(self.db, reason, line.strip())
+                return
+
+    def open_kmsg(self):
+        try:
+            fd = os.open(KMSG_PATH, os.O_RDONLY | os.O_NONBLOCK)
+            os.lseek(fd, 0, os.SEEK_END)
+            return fd
+        except OSError as err:
+            logging.info("Crash detector: can't read {}: {}".format(KMSG_PATH, err))
+            return None
+
+    def on_kmsg(self, fd):
+        while True:
+            try:
+                record = os.read(fd, 8192).decode(errors="replace")
+            except BlockingIOError:
+                return
+            except BrokenPipeError:
+                # records were overwritten before we read them, carry on with the next one
+                continue
+            if not record:
+                return
+            message = record.split(";", 1)[-1]
+            if KMSG_OOM_PATTERN.search(message):
+                signal_crash(self.db, OOM_KILL, message.strip())
+
 
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
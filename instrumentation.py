@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import cProfile
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import psutil
+
+PREFIX = "dbtune_"
+SAMPLING_PROFILER_INTERVAL = 0.01
+PROFILE_OUTPUTS = {"cprofile": "dbtune_profile.pstats", "sampling": "dbtune_profile.folded"}
+
+
+def label_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"')) for name, value in labels) + "}"
+
+
+class Instrumentation:
+    """Timers and counters around what the client spends its time on.
+
+    Timers keep a count, a total and a maximum per name and label set. They use the
+    real monotonic clock, also in simulations, since they measure the client itself.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timers = {}
+        self.counters = {}
+        self.process = psutil.Process()
+        self.last_summary = ({}, {}, self.cpu_seconds())
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            count, total, maximum = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = (count + 1, total + seconds, max(maximum, seconds))
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def cpu_seconds(self):
+        # psql sessions and sudo the client started and already reaped count as its own overhead
+        times = self.process.cpu_times()
+        return times.user + times.system + times.children_user + times.children_system
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        with self.lock:
+            timers = sorted(self.timers.items())
+            counters = sorted(self.counters.items())
+        lines = []
+        for name in sorted({name for (name, _), _ in timers}):
+            metric = PREFIX + name + "_seconds"
+            lines.append("# TYPE {} summary".format(metric))
+            for (_, labels), (count, total, _) in (item for item in timers if item[0][0] == name):
+                lines.append("{}_count{} {}".format(metric, label_text(labels), count))
+                lines.append("{}_sum{} {:.6f}".format(metric, label_text(labels), total))
+            lines.append("# TYPE {}_max gauge".format(metric))
+            for (_, labels), (_, _, maximum) in (item for item in timers if item[0][0] == name):
+                lines.append("{}_max{} {:.6f}".format(metric, label_text(labels), maximum))
+        for name in sorted({name for (name, _), _ in counters}):
+            metric = PREFIX + name + "_total"
+            lines.append("# TYPE {} counter".format(metric))
+            for (_, labels), value in (item for item in counters if item[0][0] == name):
+                lines.append("{}{} {}".format(metric, label_text(labels), value))
+        lines.append("# TYPE process_cpu_seconds_total counter")
+        lines.append("process_cpu_seconds_total {:.3f}".format(self.cpu_seconds()))
+        lines.append("# TYPE process_resident_memory_bytes gauge")
+        lines.append("process_resident_memory_bytes {}".format(self.process.memory_info().rss))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """What was timed and counted since the previous summary, one line per name and label set."""
+        with self.lock:
+            timers, counters = dict(self.timers), dict(self.counters)
+        cpu_seconds = self.cpu_seconds()
+        last_timers, last_counters, last_cpu_seconds = self.last_summary
+        self.last_summary = (timers, counters, cpu_seconds)
+        parts = []
+        for (name, labels), (count, total, _) in sorted(timers.items()):
+            last_count, last_total, _ = last_timers.get((name, labels), (0, 0.0, 0.0))
+            if count > last_count:
+                parts.append("{}{} {}x {:.3f}s".format(name, label_text(labels), count - last_count, total - last_total))
+        for (name, labels), value in sorted(counters.items()):
+            if value > last_counters.get((name, labels), 0):
+                parts.append("{}{} {}".format(name, label_text(labels), value - last_counters.get((name, labels), 0)))
+        parts.append("client cpu {:.2f}s".format(cpu_seconds - last_cpu_seconds))
+        parts.append("client rss {:.1f}MB".format(self.process.memory_info().rss / 1024 ** 2))
+        return ", ".join(parts)
+
+
+class MetricsServer:
+    """Serves the instrumentation on http://127.0.0.1:<port>/metrics for Prometheus to scrape."""
+
+    def __init__(self, instrumentation, port, host="127.0.0.1"):
+        self.server = ThreadingHTTPServer((host, port), self.handler(instrumentation))
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="dbtune-metrics", daemon=True)
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logging.info("Serving client metrics on http://{}:{}/metrics".format(host, port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def handler(instrumentation):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = instrumentation.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+class SamplingProfiler:
+    """Samples the stacks of every thread at a fixed interval and writes them as folded stacks.
+
+    The output is what flamegraph.pl or speedscope read. Unlike cProfile it sees the
+    tuning, I/O and watcher threads too, at a cost that doesn't grow with call counts.
+    """
+
+    def __init__(self, interval=SAMPLING_PROFILER_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="dbtune-profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        own = threading.get_ident()
+        while not self.stop_event.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("{} ({}:{})".format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, path):
+        self.stop_event.set()
+        self.thread.join()
+        with open(path, "w") as output:
+            for stack, count in self.stacks.most_common():
+                output.write("{} {}\n".format(stack, count))
+
+
+class Profiler:
+    """Optional profiling of a whole session, "cprofile" (the event loop thread) or "sampling" (every thread)."""
+
+    def __init__(self, kind, path=None):
+        if kind not in PROFILE_OUTPUTS:
+            raise ValueError("unknown profiler {}, expected one of {}".format(kind, ", ".join(PROFILE_OUTPUTS)))
+        self.kind = kind
+        self.path = path or PROFILE_OUTPUTS[kind]
+        self.profiler = cProfile.Profile() if kind == "cprofile" else SamplingProfiler()
+
+    def start(self):
+        logging.info("Profiling the client with {} into {}".format(self.kind, self.path))
+        if self.kind == "cprofile":
+            self.profiler.enable()
+        else:
+            self.profiler.start()
+
+    def stop(self):
+        if self.kind == "cprofile":
+            self.profiler.disable()
+            self.profiler.dump_stats(self.path)
+        else:
+            self.profiler.stop(self.path)
+
+
+# shared by everything the client runs, like the logging module
+instrumentation = Instrumentation()
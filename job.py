@@ -1,16 +1,24 @@
 import json
+import gzip
 import time
 import datetime
 import logging
-import requests
 from requests.exceptions import HTTPError
+from transport import Transport
+
+# answers to a gzip list of samples meaning the platform only takes one sample per request
+BATCH_REJECTED = {400, 404, 405, 413, 415, 422}
+# seconds between two deliveries of an iteration result the platform didn't take, doubling up to the cap
+RESULT_RETRY_DELAY = 5
+RESULT_RETRY_CAP = 120
 
 
 class Job:
-    def __init__(self, endpoint, api_key, job_id):
+    def __init__(self, endpoint, api_key, job_id, transport=None):
         logging.info("Starting tuning session {}".format(job_id))
         self.api_key = api_key
         self.job_id = job_id
+        self.transport = transport or Transport(api_key)
         endpoint = endpoint + "job/"
         self.request = endpoint + self.job_id + '/request?v=2'
         self.response = endpoint + self.job_id + '/response?v=2'
@@ -19,75 +27,90 @@ class Job:
         self.update_status = endpoint + self.job_id +"/update-status"
         self.default_performance = endpoint + self.job_id + "/default-performance"
         self.iteration = None
+        # cleared once the platform rejects a batch of stats
+        self.stats_batching = True
 
     def get_tuning_request(self):
-        try:
-            response = requests.get(self.request,
-                                    headers={'X-HYPER-API-KEY': self.api_key}, )
-            response.raise_for_status()
-        except HTTPError as http_err:
-            logging.error(f'HTTP error occurred: {http_err}')  # Python 3.6
-        except Exception as err:
-            logging.exception(f'Other error occurred: {err}')  # Python 3.6
-        else:
-            data = response.json()
+        data = self.transport.get(self.request, "request")
+        if data is not None:
             if "iteration_no" in data.keys():
                 self.iteration = data["iteration_no"]
             logging.debug("Iteration {}".format(self.iteration))
-            return data
+        return data
 
     def update_tuning_status(self, state):
-        try:
-            response = requests.post(self.update_status,
-                                 json={"tuning_status": state},
-                                 headers={'X-HYPER-API-KEY': self.api_key}, )
-        except HTTPError as http_err:
-            logging.error(f'HTTP error occurred: {http_err}')  # Python 3.6
-        except Exception as err:
-            logging.exception(f'Other error occurred: {err}')  # Python 3.6
+        self.transport.post(self.update_status, "update-status", json={"tuning_status": state}, idempotent=True)
+
+    def post_stats_batch(self, samples):
+        """Delivers samples, raises when they weren't all delivered.
 
-    def post_stats(self, stats_data):
-        try:
-            response = requests.post(self.stats,
-                                 json=stats_data,
-                                 headers={'X-HYPER-API-KEY': self.api_key}, )
-        except HTTPError as http_err:
-            logging.error(f'HTTP error occurred: {http_err}')  # Python 3.6
-        except Exception as err:
-            logging.exception(f'Other error occurred: {err}')  # Python 3.6
-        else:
-            data = response.json()
-            return data
+        Retries are left to the stats uploader, which spools what it can't deliver.
+        When samples go one per request, the ones delivered before a failure are
+        removed from samples so they aren't sent twice.
+        """
+        if self.stats_batching:
+            body = gzip.compress(json.dumps(samples).encode('utf-8'))
+            try:
+                response = self.transport.request("POST", self.stats, "stats", data=body, idempotent=False,
+                                                  headers={'Content-Type': 'application/json', 'Content-Encoding': 'gzip'})
+            except HTTPError as err:
+                if err.response is None or err.response.status_code not in BATCH_REJECTED:
+                    raise
+                logging.warning("Stats: the platform rejected a batch of samples ({}), posting one sample per request from now on".format(err.response.status_code))
+                self.stats_batching = False
+            else:
+                return response_json(response)
+        response = None
+        while samples:
+            response = self.transport.request("POST", self.stats, "stats", json=samples[0], idempotent=False)
+            del samples[0]
+        return response_json(response)
 
     def iterate(self, metric_stats, stats_data=None):
-        try:
-            response = requests.post(self.response, json={"metric_stats": metric_stats, "stats_data": stats_data, "iteration": self.iteration, "timestamp": get_timestamp()},
-                                     headers={'X-HYPER-API-KEY': self.api_key}, )
-            response.raise_for_status()
-        except HTTPError as http_err:
-            logging.error(f'HTTP error occurred: {http_err}')  # Python 3.6
-            logging.info("Backing off for 30 sec and trying to get the new request again...")
-            time.sleep(30)
-            return self.get_tuning_request()
-        except Exception as err:
-            logging.exception(f'Other error occurred: {err}')  # Python 3.6
-        else:
-            data = response.json()
-            if "iteration_no" in data.keys():
-                self.iteration = data["iteration_no"]
-            if "error" in data:
-                raise Exception(data)
-            return data
+        """Delivers the result of the current iteration and returns the next tuning request.
+
+        The result carries a key made of the session and the iteration, so the
+        platform can tell a retry from a new result, and is sent until the
+        platform either takes it or has moved past the iteration.
+        """
+        iteration = self.iteration
+        payload = {"metric_stats": metric_stats, "stats_data": stats_data, "iteration": iteration, "timestamp": get_timestamp()}
+        headers = {"Idempotency-Key": "{}-{}".format(self.job_id, iteration)}
+        delay = RESULT_RETRY_DELAY
+        while True:
+            data = self.transport.post(self.response, "response", json=payload, idempotent=True, headers=headers)
+            if data is None:
+                logging.info("Couldn't post the iteration result, checking whether the platform got it...")
+                data = self.get_tuning_request()
+                if data is not None and data.get("iteration_no") == iteration and "endOfJob" not in data:
+                    # still asking for the same iteration, so the result didn't arrive
+                    data = None
+            if data is not None:
+                break
+            logging.info("Posting the result of iteration {} again in {}s".format(iteration, delay))
+            time.sleep(delay)
+            delay = min(delay * 2, RESULT_RETRY_CAP)
+        if "iteration_no" in data.keys():
+            self.iteration = data["iteration_no"]
+        if "error" in data:
+            raise Exception(data)
+        return data
 
     def post_default_performance(self, default_performance, default_configuration):
-        try:
-            requests.post(self.default_performance, json={"default_performance": default_performance, "default_configuration":default_configuration, "default_configuration_timestamp":get_timestamp()}, headers={'X-HYPER-API-KEY': self.api_key}, )
-        except HTTPError as http_err:
-            logging.error(f'HTTP error occurred: {http_err}')  # Python 3.6
-        except Exception as err:
-            logging.exception(f'Other error occurred: {err}')  # Python 3.6
+        self.transport.post(self.default_performance, "default-performance", json={"default_performance": default_performance, "default_configuration":default_configuration, "default_configuration_timestamp":get_timestamp()}, idempotent=True)
+
+
+def response_json(response):
+    # delivery is decided by the status code, a body that isn't JSON doesn't undo it
+    if response is None or not response.content:
+        return None
+    try:
+        return response.json()
+    except ValueError:
+        logging.debug("Stats: response isn't JSON: {!r}".format(response.content[:200]))
+        return None
 
 
 def get_timestamp():
     x = datetime.datetime.now()
-    return x.strftime("%Y-%m-%d %H:%M:%S.%f")
\ No newline at end of file
+    return x.strftime("%Y-%m-%d %H:%M:%S.%f")
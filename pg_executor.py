@@ -0,0 +1,233 @@
+import os
+import time
+import uuid
+import select
+import logging
+import threading
+import subprocess
+from collections import namedtuple
+from queue import LifoQueue, Empty
+from TuningError import TuningError
+from instrumentation import instrumentation
+
+# psql prints NULLs as this byte so they can be told apart from empty strings
+NULL_DISPLAY = "\x01"
+# separates the status fields echoed after each script, \echo can't print a NUL byte
+STATUS_SEPARATOR = "\x1f"
+
+# fields are separated by NUL, the one byte no value can contain, and records by a string with a random
+# part no value contains in practice, so the header alone gives the width and multi-line values survive
+SESSION_SETUP = """\\pset format unaligned
+\\pset fieldsep_zero
+\\pset recordsep '{record_separator}'
+\\pset footer off
+\\pset pager off
+\\pset null '\\001'
+\\set VERBOSITY terse
+"""
+
+_row_types = {}
+
+
+class QueryError(TuningError):
+    def __init__(self, message, sqlstate=None):
+        super().__init__(message)
+        self.sqlstate = sqlstate
+
+
+class ConnectionLost(QueryError):
+    pass
+
+
+class QueryTimeout(ConnectionLost):
+    pass
+
+
+def parse_unaligned(output, record_separator, types=()):
+    """Rows of what psql printed in unaligned format, with NUL between fields and record_separator between records."""
+    text = output.decode("utf-8")
+    if not text:
+        return []
+    # psql ends the last record with a newline whatever the record separator is
+    if not text.endswith("\n"):
+        raise QueryError("unexpected psql output: no newline after the last record")
+    header, *records = [record.split("\0") for record in text[:-1].split(record_separator)]
+    Row = row_type(header)
+    rows = []
+    for record in records:
+        if len(record) != len(header):
+            raise QueryError("unexpected psql output: {} values in a row of {} columns".format(len(record), len(header)))
+        row = [None if value == NULL_DISPLAY else value for value in record]
+        for i, convert in enumerate(types):
+            if row[i] is not None:
+                row[i] = convert(row[i])
+        rows.append(Row(*row))
+    return rows
+
+
+def row_type(columns):
+    columns = tuple(columns)
+    if columns not in _row_types:
+        _row_types[columns] = namedtuple("Row", columns, rename=True)
+    return _row_types[columns]
+
+
+class PsqlSession:
+    """A single long-lived psql process holding one backend connection open."""
+
+    def __init__(self, command, timeout):
+        self.timeout = timeout
+        token = uuid.uuid4().hex
+        self.marker = "__dbtune_{}__".format(token).encode()
+        self.record_separator = "\x1e{}\x1e".format(token)
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        # round trip once so a failed login surfaces here and not on the first query
+        self.run(SESSION_SETUP.format(record_separator=self.record_separator.replace("\x1e", "\\036")))
+
+    def run(self, script):
+        deadline = time.monotonic() + self.timeout
+        self._write(script + "\n\\echo {} :ERROR '\\037' :SQLSTATE '\\037' :LAST_ERROR_MESSAGE\n".format(self.marker.decode()))
+        output, status = self._read_until_marker(deadline)
+        error, sqlstate, message = [field.strip() for field in (status.split(STATUS_SEPARATOR, 2) + ["", ""])[:3]]
+        if error == "true":
+            raise QueryError(message or "query failed", sqlstate or None)
+        return output
+
+    def query(self, sql, types=()):
+        sql = sql.strip()
+        if not sql.endswith(";"):
+            sql += ";"
+        return parse_unaligned(self.run(sql), self.record_separator, types)
+
+    def close(self):
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except Exception:
+                self.process.kill()
+
+    def _write(self, text):
+        try:
+            self.process.stdin.write(text.encode("utf-8"))
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError, ValueError) as err:
+            self.close()
+            raise ConnectionLost("psql session is gone: {}".format(err))
+
+    def _read_until_marker(self, deadline):
+        output = bytearray()
+        scanned = 0
+        while True:
+            index = output.find(self.marker, scanned)
+            if index >= 0:
+                end = output.find(b"\n", index)
+                if end >= 0:
+                    status = output[index + len(self.marker):end].decode("utf-8", "replace").strip()
+                    return bytes(output[:index]), status
+                scanned = index
+            else:
+                scanned = max(0, len(output) - len(self.marker))
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.process.kill()
+                self.process.wait()
+                raise QueryTimeout("psql did not answer within {}s".format(self.timeout))
+            ready, _, _ = select.select([self.process.stdout], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(self.process.stdout.fileno(), 1 << 16)
+            if not chunk:
+                self.close()
+                raise ConnectionLost("psql exited with code {}".format(self.process.poll()))
+            output.extend(chunk)
+
+
+class PgExecutor:
+    """Small pool of persistent psql sessions used for every query the client runs."""
+
+    def __init__(self, psql_path, port, database_name, username="postgres", password_auth=False, pool_size=2, timeout=60, name="queries"):
+        if password_auth:
+            command = [psql_path, "-h", "localhost", "-p", str(port), "-U", username, "-d", database_name]
+        else:
+            # peer authentication over the Unix socket, same as the one-shot calls used to do
+            command = ["sudo", "-i", "-u", "postgres", psql_path, "-p", str(port), "-d", database_name]
+        self.command = command + ["-X", "-q", "-v", "ON_ERROR_STOP=0"]
+        self.timeout = timeout
+        # tells the pools apart in the client's instrumentation
+        self.name = name
+        self.idle = LifoQueue()
+        self.slots = threading.BoundedSemaphore(pool_size)
+        self.lock = threading.Lock()
+        self.generation = 0
+
+    @classmethod
+    def from_connection_details(cls, details, **kwargs):
+        return cls(details["psql_path"], details["port"], details["database_name"], details["username"], details["password_auth"], **kwargs)
+
+    def query(self, sql, *types):
+        with self.slots, instrumentation.timer("psql_query", executor=self.name):
+            session, generation, reused = self._checkout()
+            try:
+                try:
+                    return session.query(sql, types)
+                except ConnectionLost as err:
+                    if not reused or isinstance(err, QueryTimeout):
+                        raise
+                    # an idle connection went stale, typically because postgres was restarted
+                    logging.debug("PgExecutor: reconnecting after lost connection")
+                    instrumentation.count("psql_reconnects", executor=self.name)
+                    session, generation, reused = self._checkout(fresh=True)
+                    return session.query(sql, types)
+            except QueryError:
+                instrumentation.count("psql_errors", executor=self.name)
+                raise
+            finally:
+                self._checkin(session, generation)
+
+    def query_one(self, sql, *types):
+        rows = self.query(sql, *types)
+        return rows[0] if rows else None
+
+    def query_value(self, sql, convert=str):
+        row = self.query_one(sql, convert)
+        return row[0] if row else None
+
+    def execute(self, sql):
+        self.query(sql)
+
+    def reset(self):
+        with self.lock:
+            self.generation += 1
+        self._drain()
+
+    def close(self):
+        self.reset()
+
+    def _checkout(self, fresh=False):
+        with self.lock:
+            generation = self.generation
+        if not fresh:
+            try:
+                return self.idle.get_nowait(), generation, True
+            except Empty:
+                pass
+        logging.debug("PgExecutor: opening psql session")
+        instrumentation.count("psql_sessions_opened", executor=self.name)
+        with instrumentation.timer("psql_connect", executor=self.name):
+            return PsqlSession(self.command, self.timeout), generation, False
+
+    def _checkin(self, session, generation):
+        with self.lock:
+            current = generation == self.generation
+        if current and session.process.poll() is None:
+            self.idle.put(session)
+        else:
+            session.close()
+
+    def _drain(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except Empty:
+                return
@@ -0,0 +1,133 @@
+import os
+import struct
+import socket
+import logging
+from clock import SystemClock
+
+# what a probe can tell about the server
+READY = "ready"
+STARTING_UP = "starting_up"
+RECOVERING = "recovering"
+SHUTTING_DOWN = "shutting_down"
+REJECTING = "rejecting"
+NO_RESPONSE = "no_response"
+
+PROTOCOL_VERSION = 3 << 16
+CANNOT_CONNECT_NOW = "57P03"
+TOO_MANY_CONNECTIONS = "53300"
+# seconds, an attempt that takes longer counts as no response
+PROBE_TIMEOUT = 1.0
+FIRST_DELAY = 0.01
+MAX_DELAY = 0.5
+# how long startup, crash recovery included, may take
+READY_TIMEOUT = 600
+# how long nothing may listen on the port, while the restart command hands over to the new postmaster
+DOWN_TIMEOUT = 30
+
+
+def startup_message(user, database):
+    parameters = "user\0{}\0database\0{}\0\0".format(user, database).encode()
+    return struct.pack("!ii", 8 + len(parameters), PROTOCOL_VERSION) + parameters
+
+
+def receive(sock, size):
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("server closed the connection")
+        data += chunk
+    return data
+
+
+def error_fields(body):
+    fields = {}
+    for field in body.split(b"\0"):
+        if field:
+            fields[chr(field[0])] = field[1:].decode("utf-8", "replace")
+    return fields
+
+
+def probe(address, user, database, timeout=PROBE_TIMEOUT):
+    """Sends a startup message to postgres at address and tells its state from the first reply.
+
+    address is the path of a Unix socket or a (host, port) pair. The server either
+    asks for authentication (or fails it), which means it accepts connections, or
+    refuses the connection with an error saying why. Like pg_isready, the probe
+    never authenticates and disconnects right after the reply.
+    """
+    try:
+        if isinstance(address, str):
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            sock.connect(address)
+        else:
+            sock = socket.create_connection(address, timeout)
+        with sock:
+            sock.sendall(startup_message(user, database))
+            kind = receive(sock, 1)
+            length, = struct.unpack("!i", receive(sock, 4))
+            if kind != b"E":
+                return READY, None
+            fields = error_fields(receive(sock, min(length - 4, 1 << 16)))
+    except OSError as err:
+        # no socket file, connection refused or reset, timed out
+        return NO_RESPONSE, str(err)
+    sqlstate, message = fields.get("C"), fields.get("M", "")
+    if sqlstate == CANNOT_CONNECT_NOW:
+        if "shutting down" in message:
+            return SHUTTING_DOWN, message
+        if "recovery" in message or "not yet accepting connections" in message:
+            return RECOVERING, message
+        return STARTING_UP, message
+    if sqlstate == TOO_MANY_CONNECTIONS:
+        return REJECTING, message
+    # failed authentication and unknown databases still come from a server that accepts connections
+    return READY, message
+
+
+class ReadinessProbe:
+    """Waits until postgres accepts connections, probing its socket with sub-second exponential backoff."""
+
+    def __init__(self, port, socket_directory=None, user="postgres", database="postgres", clock=None):
+        self.port = port
+        self.socket_directory = socket_directory
+        self.user = user
+        self.database = database
+        self.clock = clock or SystemClock()
+
+    def address(self):
+        if self.socket_directory:
+            path = os.path.join(self.socket_directory, ".s.PGSQL.{}".format(self.port))
+            if os.path.exists(path):
+                return path
+        return ("localhost", self.port)
+
+    def probe(self):
+        return probe(self.address(), self.user, self.database)
+
+    def wait(self, timeout=READY_TIMEOUT, down_timeout=DOWN_TIMEOUT):
+        """Returns READY, or the last state seen once timeout passed or nothing listened for down_timeout."""
+        started = self.clock.monotonic()
+        down_since = None
+        delay = FIRST_DELAY
+        last_state = None
+        while True:
+            state, detail = self.probe()
+            now = self.clock.monotonic()
+            if state != last_state:
+                logging.debug("Readiness: {} after {:.2f}s ({})".format(state, now - started, detail))
+                last_state = state
+            if state == READY:
+                return state
+            if state == NO_RESPONSE:
+                down_since = now if down_since is None else down_since
+                if now - down_since >= down_timeout:
+                    return state
+            else:
+                down_since = None
+            if now - started >= timeout:
+                logging.warning("Readiness: postgres not ready after {}s ({})".format(timeout, detail))
+                return state
+            self.clock.sleep(delay)
+            delay = min(delay * 2, MAX_DELAY)
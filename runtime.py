@@ -0,0 +1,117 @@
+import signal
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from TuningError import SessionInterrupted
+from stats.stats import Stats
+from crash_detection import MemMonitoring, CrashDetector
+from instrumentation import instrumentation, MetricsServer, Profiler
+
+IO_WORKERS = 2
+
+
+class Runtime:
+    """Runs everything a tuning session does concurrently as tasks on one asyncio event loop.
+
+    Sampling, uploading, abort handling and the tuning state machine all live on the
+    loop. psql and the HTTP client are blocking, so their short calls go to a small
+    I/O pool; the long tuning steps (restart, warmup, measurement) go to a single
+    worker of their own, which interrupt() wakes up. The memory and crash watchers
+    keep their poll threads, asyncio can't wait for the POLLPRI events they need.
+    """
+
+    def __init__(self, job, db, interval=1, metrics_port=None, profile=None, sample_store=None):
+        self.job = job
+        self.db = db
+        self.interval = interval
+        self.sample_store = sample_store
+        self.metrics_server = MetricsServer(instrumentation, metrics_port) if metrics_port is not None else None
+        self.profiler = Profiler(profile) if profile else None
+        self.io = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="dbtune-io")
+        self.steps = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dbtune-tuning")
+        # prompts and aborts can block for as long as the user takes to answer
+        self.control = ThreadPoolExecutor(max_workers=1, thread_name_prefix="dbtune-control")
+        self.stats = None
+        self.monitoring = []
+        self.session = None
+        self.aborting = None
+        self.prompting = None
+
+    def run(self, session):
+        """Runs the session coroutine, called with this runtime, until it returns."""
+        if self.metrics_server is not None:
+            self.metrics_server.start()
+        if self.profiler is not None:
+            self.profiler.start()
+        # safely_abort ends the process without returning here
+        self.db.exit_hooks.append(self.shutdown)
+        try:
+            asyncio.run(self.main(session))
+        finally:
+            self.shutdown()
+            for executor in (self.io, self.steps, self.control):
+                executor.shutdown(wait=False)
+
+    def shutdown(self):
+        """Writes the profile and stops the metrics endpoint, once."""
+        profiler, self.profiler = self.profiler, None
+        if profiler is not None:
+            profiler.stop()
+        metrics_server, self.metrics_server = self.metrics_server, None
+        if metrics_server is not None:
+            metrics_server.stop()
+
+    async def main(self, session):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGINT, self.on_interrupt)
+        self.stats = Stats(self.job, self.db, self, interval=self.interval, store=self.sample_store)
+        self.monitoring = [asyncio.ensure_future(self.stats.run()), MemMonitoring(self.db), CrashDetector(self.db)]
+        for watcher in self.monitoring[1:]:
+            watcher.start()
+        self.session = asyncio.ensure_future(session(self))
+        try:
+            await self.session
+        except (SessionInterrupted, asyncio.CancelledError):
+            logging.debug("Runtime: tuning interrupted")
+        finally:
+            # an abort in progress ends the process itself once postgres is back up
+            if self.aborting is not None:
+                await self.aborting
+            await self.stop_monitoring()
+
+    async def stop_monitoring(self):
+        if not self.monitoring:
+            return
+        stats, mem_monitoring, crash_detector = self.monitoring
+        self.monitoring = []
+        self.stats.stop()
+        await stats
+        await self.blocking(mem_monitoring.stop)
+        await self.blocking(crash_detector.stop)
+
+    async def blocking(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.io, partial(function, *args, **kwargs))
+
+    async def step(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self.steps, partial(function, *args, **kwargs))
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def abort(self, abort_type, user_selected_configuration=None):
+        # called on the loop as soon as the platform reports the session aborted
+        if self.aborting is not None:
+            return
+        logging.info("Runtime: tuning session aborted ({})".format(abort_type))
+        self.db.interrupt()
+        self.session.cancel()
+        handler = partial(self.db.abort_optimization, abort_type=abort_type, user_selected_configuration=user_selected_configuration)
+        self.aborting = asyncio.get_running_loop().run_in_executor(self.control, handler)
+
+    def on_interrupt(self):
+        if self.aborting is not None or (self.prompting is not None and not self.prompting.done()):
+            return
+        # the user is asked whether to abort, tuning carries on meanwhile
+        handler = partial(self.db.abort_signal_handler, signal.SIGINT, None, self.job)
+        self.prompting = asyncio.get_running_loop().run_in_executor(self.control, handler)
@@ -0,0 +1,80 @@
+import os
+import json
+import time
+import logging
+
+# what a restarted client needs to pick a tuning session up where it stopped
+CONNECTED = "connected"
+DEFAULT_MEASURED = "default_measured"
+CONFIG_APPLIED = "config_applied"
+MEASURED = "measured"
+REPORTED = "reported"
+POST_TUNING = "post_tuning"
+
+
+class SessionState:
+    """Progress of a tuning session, saved after every phase so a restarted client can resume it.
+
+    Saving writes a temporary file, syncs it and renames it over the previous state,
+    so a crash at any point leaves either the old or the new state on disk. Passwords
+    are never saved. Without a path nothing is saved and nothing is resumed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.state = {}
+
+    def load(self, db_id):
+        if not self.path:
+            return {}
+        try:
+            with open(self.path) as state_file:
+                state = json.load(state_file)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as err:
+            logging.warning("SessionState: ignoring unreadable {} ({})".format(self.path, err))
+            return {}
+        if state.get("db_id") != db_id:
+            return {}
+        self.state = state
+        logging.info("SessionState: found tuning session {} at phase {}".format(state.get("tuning_session_id"), state.get("phase")))
+        return dict(state)
+
+    def get(self, key, default=None):
+        return self.state.get(key, default)
+
+    def save(self, **changes):
+        self.state.update(changes, saved_at=time.time())
+        if not self.path:
+            return
+        temporary = self.path + ".tmp"
+        fd = os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as state_file:
+            json.dump(self.state, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temporary, self.path)
+        # the rename itself is only durable once the directory is synced
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    def clear(self):
+        self.state = {}
+        if not self.path:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def resumes(self, phase, iteration=None, knobs=None):
+        """Whether the saved state is at phase, for this iteration and knobs when they are given."""
+        if self.state.get("phase") != phase:
+            return False
+        if iteration is not None and self.state.get("iteration") != iteration:
+            return False
+        return knobs is None or self.state.get("knobs") == knobs
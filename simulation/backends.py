@@ -0,0 +1,274 @@
+import os
+import re
+import json
+import zlib
+import numpy as np
+from readiness import READY, NO_RESPONSE
+from pg_executor import QueryError, ConnectionLost
+
+FIELDS = ["xact_commit", "xact_rollback", "blks_read", "blks_hit", "calls", "total_exec_time", "sum_sq_exec_time", "reads"]
+# seconds at the end of a trace whose average rates carry it on past its last point
+TAIL = 60
+QUERYID = ("10", "1", "1")
+BACKEND_PID = 1000
+# counters of a server that has been up for a while, the adapter treats zero commits as unreadable
+INITIAL_COUNTERS = {"xact_commit": 1e6, "xact_rollback": 1e4, "blks_read": 1e6, "blks_hit": 1e8}
+# what get_default_configuration reads back, in pg_settings units
+DEFAULT_SETTINGS = {
+    "shared_buffers": ("16384", "8kB"),
+    "work_mem": ("4096", "kB"),
+    "random_page_cost": ("4", None),
+    "effective_io_concurrency": ("1", None),
+    "max_wal_size": ("1024", "MB"),
+}
+# knobs that only change on restart, the rest are applied by a reload
+POSTMASTER_KNOBS = {"shared_buffers", "max_worker_processes", "max_wal_senders", "shared_preload_libraries"}
+
+
+class Trace:
+    """Cumulative database counters against the seconds since a configuration was installed."""
+
+    def __init__(self, seconds, counters):
+        self.seconds = np.asarray(seconds, dtype=np.float64)
+        # counters start from zero so a trace can be appended to whatever came before it
+        self.counters = {field: np.asarray(counters[field], dtype=np.float64) - counters[field][0] for field in FIELDS}
+        tail = self.seconds >= self.seconds[-1] - TAIL
+        span = self.seconds[-1] - self.seconds[tail][0]
+        self.rates = {field: (values[-1] - values[tail][0]) / span if span > 0 else 0.0 for field, values in self.counters.items()}
+
+    @classmethod
+    def load(cls, path):
+        """JSON lines with "t" in seconds and the cumulative counters, as written by simulation.record."""
+        with open(path) as trace_file:
+            rows = [json.loads(line) for line in trace_file if line.strip()]
+        return cls([row["t"] - rows[0]["t"] for row in rows], {field: [row.get(field, 0) for row in rows] for field in FIELDS})
+
+    @classmethod
+    def synthetic(cls, throughput=1000, latency=2.0, warmup=60, hit_ratio=0.99, blocks_per_commit=20, noise=0.05, duration=3600, seed=0):
+        """A workload that starts cold and settles to throughput commits/s and latency ms per statement."""
+        rng = np.random.default_rng(seed)
+        seconds = np.arange(duration + 1, dtype=np.float64)
+        warm = 1 - np.exp(-seconds / warmup)
+        commits = throughput * (0.5 + 0.5 * warm) * np.maximum(1 + noise * rng.standard_normal(len(seconds)), 0)
+        calls = 5 * commits
+        mean = latency * (2 - warm)
+        blocks = blocks_per_commit * commits
+        hits = blocks * (hit_ratio - 0.2 * (1 - warm))
+        rates = {
+            "xact_commit": commits,
+            "xact_rollback": 0.01 * commits,
+            "blks_read": blocks - hits,
+            "blks_hit": hits,
+            "calls": calls,
+            "total_exec_time": calls * mean,
+            "sum_sq_exec_time": calls * (mean ** 2 + (0.3 * mean) ** 2),
+            "reads": (blocks - hits) / 4,
+        }
+        counters = {field: np.concatenate(([0.0], np.cumsum(rate[1:]))) for field, rate in rates.items()}
+        return cls(seconds, counters)
+
+    def at(self, elapsed):
+        if elapsed <= self.seconds[-1]:
+            return {field: float(np.interp(elapsed, self.seconds, values)) for field, values in self.counters.items()}
+        beyond = elapsed - self.seconds[-1]
+        return {field: float(values[-1] + self.rates[field] * beyond) for field, values in self.counters.items()}
+
+
+class SyntheticModel:
+    """Synthetic traces whose level depends on the knobs, the same knobs always perform the same."""
+
+    def __init__(self, throughput=1000, latency=2.0, spread=(0.3, 1.3), seed=0, **trace_settings):
+        self.throughput = throughput
+        self.latency = latency
+        self.spread = spread
+        self.seed = seed
+        self.trace_settings = trace_settings
+
+    def trace_for(self, knobs, configuration):
+        key = zlib.crc32(json.dumps(knobs, sort_keys=True).encode()) ^ self.seed
+        low, high = self.spread
+        factor = low + (high - low) * (key % 1000) / 999
+        return Trace.synthetic(self.throughput * factor, self.latency / factor, seed=key + configuration, **self.trace_settings)
+
+
+class ReplayModel:
+    """Recorded traces replayed in turn, one per configuration installed."""
+
+    def __init__(self, traces):
+        self.traces = traces
+
+    def trace_for(self, knobs, configuration):
+        return self.traces[configuration % len(self.traces)]
+
+
+class SimulatedDatabase:
+    """Counters of a postgres instance following a model, switched whenever a configuration is applied."""
+
+    def __init__(self, clock, model, conf_path):
+        self.clock = clock
+        self.model = model
+        self.conf_path = conf_path
+        self.data_directory = os.path.join(conf_path, "data")
+        self.configurations = 0
+        self.restarts = 0
+        self.backend_pid = BACKEND_PID
+        self.restarted_at = None
+        self.base = {field: INITIAL_COUNTERS.get(field, 0.0) for field in FIELDS}
+        self.started = clock.monotonic()
+        self.postmaster_knobs = self.restart_knobs(self.knobs())
+        self.pending_restart = []
+        self.trace = model.trace_for(self.knobs(), 0)
+        # False once the postmaster died, until the adapter restarts postgres
+        self.running = True
+        # [pattern, queries left to fail] of the scripted query failures
+        self.failures = []
+
+    @staticmethod
+    def restart_knobs(knobs):
+        return {name: value for name, value in knobs.items() if name in POSTMASTER_KNOBS}
+
+    def knobs(self):
+        knobs = {}
+        try:
+            with open(os.path.join(self.conf_path, "conf.d", "99_dbtune.conf")) as conf_file:
+                for line in conf_file:
+                    if "=" in line:
+                        name, value = line.split("=", 1)
+                        knobs[name.strip()] = value.strip()
+        except OSError:
+            pass
+        return knobs
+
+    def counters(self):
+        relative = self.trace.at(self.clock.monotonic() - self.started)
+        return {field: self.base[field] + relative[field] for field in FIELDS}
+
+    def apply(self, restart=False):
+        knobs = self.knobs()
+        if restart:
+            self.postmaster_knobs = self.restart_knobs(knobs)
+        # until the next restart, postmaster knobs keep the values postgres started with
+        running = dict({name: value for name, value in knobs.items() if name not in POSTMASTER_KNOBS}, **self.postmaster_knobs)
+        self.pending_restart = sorted(name for name in POSTMASTER_KNOBS if knobs.get(name) != self.postmaster_knobs.get(name))
+        self.base = self.counters()
+        self.started = self.clock.monotonic()
+        self.configurations += 1
+        self.trace = self.model.trace_for(running, self.configurations)
+
+    def restart(self):
+        # both of the adapter's executors are reset for the same restart
+        if self.restarted_at == self.clock.monotonic():
+            return
+        self.restarted_at = self.clock.monotonic()
+        self.running = True
+        self.apply(restart=True)
+        self.restarts += 1
+        self.backend_pid += 1
+
+    def crash(self):
+        """The postmaster dies, every query fails until postgres is restarted."""
+        self.running = False
+
+    def fail_queries(self, pattern, count=1):
+        """The next count queries containing pattern fail with a QueryError."""
+        self.failures.append([pattern, count])
+
+    def check_query(self, sql):
+        if not self.running:
+            raise ConnectionLost("server closed the connection unexpectedly")
+        for failure in self.failures:
+            if failure[0] in sql and failure[1] > 0:
+                failure[1] -= 1
+                raise QueryError("simulated failure of a query on {}".format(failure[0]), "XX000")
+
+
+class TraceExecutor:
+    """Answers the queries the adapter sends to postgres from a SimulatedDatabase."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def query(self, sql, *types):
+        database = self.database
+        database.check_query(sql)
+        if "pg_reload_conf()" in sql:
+            database.apply()
+            return [(repr(database.clock.time()), "t")]
+        if "pg_conf_load_time()" in sql:
+            return [("t",)]
+        if "clock_timestamp()" in sql:
+            counters = database.counters()
+            summary = ("s", repr(database.clock.time()), *(str(int(counters[field])) for field in FIELDS[:4]), str(database.backend_pid), None)
+            if "pg_stat_statements" not in sql:
+                return [summary]
+            statement = ("c", *QUERYID, str(int(counters["calls"])), repr(counters["total_exec_time"]), repr(counters["sum_sq_exec_time"]), "0", "1e12")
+            return [summary + (None,), statement]
+        if "FROM pg_stat_database" in sql:
+            rows = [(str(int(database.counters()["xact_commit"])),)]
+        elif "shared_preload_libraries" in sql:
+            rows = [("pg_stat_statements",)]
+        elif "FROM pg_extension" in sql:
+            rows = [("1",)]
+        elif "current_setting('data_directory')" in sql:
+            rows = [(database.data_directory,)]
+        elif "current_setting('config_file')" in sql:
+            rows = [(os.path.join(database.conf_path, "postgresql.conf"),)]
+        elif "FROM pg_settings WHERE name in" in sql:
+            rows = [(name, setting, unit) for name, (setting, unit) in DEFAULT_SETTINGS.items()]
+        elif "SELECT name, context FROM pg_settings" in sql:
+            names = re.findall(r"'([a-z_]+)'", sql)
+            rows = [(name, "postmaster" if name in POSTMASTER_KNOBS else "user") for name in names]
+        elif "WHERE pending_restart" in sql:
+            rows = [(name,) for name in database.pending_restart]
+        else:
+            rows = []
+        return [tuple(value if value is None else convert(value) for convert, value in zip(types + (str,) * len(row), row)) for row in rows]
+
+    def query_one(self, sql, *types):
+        rows = self.query(sql, *types)
+        return rows[0] if rows else None
+
+    def query_value(self, sql, convert=str):
+        row = self.query_one(sql, convert)
+        return row[0] if row else None
+
+    def execute(self, sql):
+        self.query(sql)
+
+    def reset(self):
+        # the adapter drops its connections right after restarting postgres
+        self.database.restart()
+
+    def close(self):
+        pass
+
+
+class TraceHostSampler:
+    """Host metrics for a SimulatedDatabase, reads follow its trace and the rest stays flat."""
+
+    def __init__(self, database):
+        self.database = database
+        self.last = None
+
+    def sample(self):
+        now = self.database.clock.monotonic()
+        reads = self.database.counters()["reads"]
+        read_rate = 0.0
+        if self.last is not None and now > self.last[0]:
+            read_rate = (reads - self.last[1]) / (now - self.last[0])
+        self.last = (now, reads)
+        return {
+            "io": {"Device": "simulated", "r/s": read_rate, "w/s": 0.0, "iops": read_rate},
+            "mem": {"total": 16 * 1024 ** 3, "available": 8 * 1024 ** 3, "percent": 50.0},
+            "cpu": {"cpu_util": 50.0},
+        }
+
+
+class InstantReadiness:
+    """A simulated postgres accepts connections as soon as it is restarted, and none while its postmaster is dead."""
+
+    def __init__(self, database):
+        self.database = database
+
+    def wait(self, timeout=None, down_timeout=None):
+        return READY if self.database.running else NO_RESPONSE
@@ -0,0 +1,77 @@
+import sys
+import json
+import time
+import logging
+import argparse
+from pg_executor import PgExecutor
+from stats.disk_stats import DiskSampler
+
+DATABASE_COUNTERS = """SELECT xact_commit, xact_rollback, blks_read, blks_hit FROM pg_stat_database WHERE datname = current_database()"""
+STATEMENT_COUNTERS = """SELECT coalesce(sum(calls), 0), coalesce(sum(total_exec_time), 0),
+                               coalesce(sum(calls * (stddev_exec_time ^ 2 + mean_exec_time ^ 2)), 0)
+                        FROM pg_stat_statements"""
+
+
+class TraceRecorder:
+    """Records the counters a simulated postgres replays, once per interval, from a real one.
+
+    Writes JSON lines that simulation.backends.Trace.load reads: the wall time "t" and
+    the cumulative pg_stat_database and pg_stat_statements counters, plus "reads", the
+    disk reads of the data directory integrated from /proc/diskstats.
+    """
+
+    def __init__(self, executor, data_directory, interval=1):
+        self.executor = executor
+        self.interval = interval
+        self.disk_sampler = DiskSampler(data_directory)
+        self.statements = executor.query_value("SELECT count(*) FROM pg_extension WHERE extname = 'pg_stat_statements'", int) > 0
+        self.reads = 0.0
+        self.last = time.monotonic()
+
+    def row(self):
+        xact_commit, xact_rollback, blks_read, blks_hit = self.executor.query_one(DATABASE_COUNTERS, int, int, int, int)
+        row = {"t": time.time(), "xact_commit": xact_commit, "xact_rollback": xact_rollback, "blks_read": blks_read, "blks_hit": blks_hit}
+        if self.statements:
+            calls, total, sum_sq = self.executor.query_one(STATEMENT_COUNTERS, int, float, float)
+            row.update(calls=calls, total_exec_time=total, sum_sq_exec_time=sum_sq)
+        now = time.monotonic()
+        self.reads += self.disk_sampler.sample()["r/s"] * (now - self.last)
+        self.last = now
+        row["reads"] = self.reads
+        return row
+
+    def record(self, output, duration=None):
+        started = time.monotonic()
+        while duration is None or time.monotonic() - started < duration:
+            output.write(json.dumps(self.row()) + "\n")
+            output.flush()
+            time.sleep(self.interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a trace of a running postgres for the simulation to replay")
+    parser.add_argument("database")
+    parser.add_argument("--port", type=int, default=5432)
+    parser.add_argument("--psql-path", default="psql")
+    parser.add_argument("--username", default="postgres")
+    parser.add_argument("--password-auth", action="store_true")
+    parser.add_argument("--interval", type=float, default=1)
+    parser.add_argument("--duration", type=float, help="stop after this many seconds instead of on Ctrl-C")
+    parser.add_argument("--output", help="trace file, standard output when not given")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
+    executor = PgExecutor(args.psql_path, args.port, args.database, args.username, args.password_auth, pool_size=1)
+    recorder = TraceRecorder(executor, executor.query_value("SELECT current_setting('data_directory')"), args.interval)
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        recorder.record(output, args.duration)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.close()
+        if args.output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
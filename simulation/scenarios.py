@@ -0,0 +1,84 @@
+import sys
+import logging
+import argparse
+from simulation.session import Simulation, generate_iterations
+from simulation.backends import SyntheticModel
+
+
+def crash_reverts_and_restarts():
+    """A crash kills the postmaster mid-measurement, the adapter reverts to the default configuration and restarts postgres."""
+    result = Simulation(SyntheticModel(), generate_iterations(3), crashes={2: (100, "backend_crash")}).run()
+    iterations = result["iterations"]
+    problems = []
+    if len(iterations) != 3:
+        problems.append("the session ended after {} iterations".format(len(iterations)))
+    elif iterations[1]["performance"]["Valid"] != "false":
+        problems.append("the crashed iteration was reported as valid")
+    elif iterations[2]["performance"]["Valid"] != "true":
+        problems.append("the iteration after the crash wasn't measured")
+    if result["restarts"] < 1:
+        problems.append("postgres wasn't restarted after the crash")
+    return problems
+
+
+def failed_reload_restarts():
+    """Reloading the configuration fails, the adapter restarts postgres instead when it may."""
+    result = Simulation(SyntheticModel(), generate_iterations(2), {"restart_allowed": True}, failures={2: (0, "pg_reload_conf", 1)}).run()
+    iterations = result["iterations"]
+    problems = []
+    if len(iterations) != 2:
+        problems.append("the session ended after {} iterations".format(len(iterations)))
+    elif iterations[1]["performance"].get("config_applied_by") != "restart":
+        problems.append("the configuration was applied by {}".format(iterations[1]["performance"].get("config_applied_by")))
+    return problems
+
+
+def stale_crash_signal_ignored():
+    """Memory pressure is signaled while the defaults are monitored, the first configuration is still measured and reloaded."""
+    result = Simulation(SyntheticModel(), generate_iterations(2), crashes={0: (300, "memory_pressure")}).run()
+    iterations = result["iterations"]
+    problems = []
+    if len(iterations) != 2:
+        problems.append("the session ended after {} iterations".format(len(iterations)))
+    elif iterations[0]["performance"]["Valid"] != "true":
+        problems.append("the first configuration was reported as crashed")
+    elif iterations[0]["performance"].get("config_applied_by") != "reload":
+        problems.append("the first configuration was applied by {}".format(iterations[0]["performance"].get("config_applied_by")))
+    return problems
+
+
+SCENARIOS = {
+    "crash_reverts_and_restarts": crash_reverts_and_restarts,
+    "failed_reload_restarts": failed_reload_restarts,
+    "stale_crash_signal_ignored": stale_crash_signal_ignored,
+}
+
+
+def run(name):
+    try:
+        return SCENARIOS[name]()
+    except BaseException as err:
+        # the adapter exits when it can't get postgres back
+        return ["failed with {}: {}".format(type(err).__name__, err)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run tuning sessions with a known outcome against the simulated postgres")
+    parser.add_argument("scenarios", nargs="*", help="scenarios to run, all by default: {}".format(", ".join(SCENARIOS)))
+    args = parser.parse_args()
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error("unknown scenario(s) {}".format(", ".join(unknown)))
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.ERROR)
+    failed = 0
+    for name in args.scenarios or SCENARIOS:
+        problems = run(name)
+        print("{} {}".format("FAIL" if problems else "ok  ", name))
+        for problem in problems:
+            print("    " + problem)
+        failed += bool(problems)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
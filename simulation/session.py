@@ -0,0 +1,186 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+from TuningError import SessionInterrupted
+from crash_detection import signal_crash, MEMORY_PRESSURE, SWAP_THRASHING, MEMORY_EXHAUSTION
+from adapters.ubuntu_pg_adapter import UbuntuPgAdapter
+from simulation.virtual_clock import VirtualClock
+from simulation.backends import SimulatedDatabase, TraceExecutor, TraceHostSampler, InstantReadiness, SyntheticModel, ReplayModel, Trace
+
+# knob values the generated sessions pick from
+KNOB_CHOICES = {
+    "shared_buffers": [131072, 524288],
+    "work_mem": [1024, 4096, 16384, 65536, 262144],
+    "random_page_cost": [1.1, 2.0, 4.0],
+    "effective_io_concurrency": [1, 32, 200],
+}
+ADAPTER_DATA = {
+    "restart_allowed": False,
+    "optimization_target": "throughput",
+    "psql_path": "psql",
+    "pg_isready_path": "true",
+    "postgres_restart_command": "true",
+    "port": 5432,
+    "username": "postgres",
+    "password_auth": False,
+    "database_name": "simulated",
+    "db_version": "15.4",
+}
+# crash reasons signaled while postgres keeps running
+WARNINGS = {MEMORY_PRESSURE, SWAP_THRASHING, MEMORY_EXHAUSTION}
+
+
+def generate_iterations(count, seed=0):
+    rng = random.Random(seed)
+    return [{name: rng.choice(values) for name, values in KNOB_CHOICES.items()} for _ in range(count)]
+
+
+class Simulation:
+    """A whole tuning session against a simulated postgres on a virtual clock.
+
+    The real adapter measures every iteration, only postgres, the host and the
+    passing of time are simulated, so sessions that take hours finish in seconds.
+    crashes maps an iteration number, 0 for the monitoring of the defaults, to
+    (seconds after it starts, reason), a crash also kills the simulated postmaster
+    unless its reason is one of WARNINGS; failures maps an iteration number to
+    (seconds after it starts, pattern, count) to fail that many queries containing
+    pattern; abort is (iteration, seconds after it starts).
+    """
+
+    def __init__(self, model, iterations, settings=None, interval=1, crashes=None, abort=None, failures=None):
+        self.model = model
+        self.iterations = iterations
+        self.adapter_data = dict(ADAPTER_DATA, **(settings or {}))
+        self.interval = interval
+        self.crashes = crashes or {}
+        self.abort = abort
+        self.failures = failures or {}
+        self.clock = VirtualClock()
+        self.db = None
+        self.snapshot = None
+        self.ticks = 0
+
+    def tick(self):
+        # what the stats sampler does every interval during a real session
+        _, self.snapshot = self.db.get_metric_stats_monitoring(self.snapshot)
+        self.ticks += 1
+
+    def run(self):
+        with tempfile.TemporaryDirectory() as conf_path:
+            open(os.path.join(conf_path, "postgresql.conf"), "w").close()
+            database = SimulatedDatabase(self.clock, self.model, conf_path)
+            self.db = db = UbuntuPgAdapter(self.adapter_data, clock=self.clock,
+                                           executor_factory=lambda *args, **kwargs: TraceExecutor(database),
+                                           host_sampler_factory=lambda path: TraceHostSampler(database),
+                                           readiness_probe_factory=lambda *args, **kwargs: InstantReadiness(database))
+            self.snapshot = db.get_snapshot()
+            self.clock.call_every(self.interval, self.tick)
+            results = []
+            objective = db.OPTIMIZATION_OBJECTIVE
+            started = time.monotonic()
+            self.schedule_crash(0, database)
+            default_performance = db.get_metric_stats(state="monitoring")
+            db.bestPerformance = default_performance[objective]
+            try:
+                for iteration, knobs in enumerate(self.iterations, 1):
+                    results.append(self.run_iteration(iteration, knobs, database))
+            except SessionInterrupted:
+                results.append({"iteration": iteration, "knobs": knobs, "aborted": True})
+            return {
+                "default_performance": default_performance,
+                "best_performance": db.bestPerformance,
+                "best_configuration": db.bestPointFound,
+                "iterations": results,
+                "restarts": database.restarts,
+                "stats_ticks": self.ticks,
+                "simulated_seconds": self.clock.monotonic(),
+                "wall_seconds": time.monotonic() - started,
+            }
+
+    def run_iteration(self, iteration, knobs, database):
+        db = self.db
+        self.schedule_crash(iteration, database)
+        if iteration in self.failures:
+            after, pattern, count = self.failures[iteration]
+            if after > 0:
+                self.clock.call_later(after, lambda: database.fail_queries(pattern, count))
+            else:
+                # before the configuration is applied, the clock only moves once it's applied
+                database.fail_queries(pattern, count)
+        if self.abort is not None and self.abort[0] == iteration:
+            self.clock.call_later(self.abort[1], db.interrupt)
+        started = self.clock.monotonic()
+        db.MODE = "tuning"
+        db.update_config(knobs)
+        restart_report = db.restart()
+        performance = db.get_metric_stats()
+        performance.update(restart_report)
+        objective = performance.get(db.OPTIMIZATION_OBJECTIVE)
+        if performance["Valid"] == "true" and objective is not None and self.better(objective, db.bestPerformance):
+            db.bestPerformance = objective
+            db.bestPointFound = knobs
+        return {"iteration": iteration, "knobs": knobs, "performance": performance, "seconds": self.clock.monotonic() - started}
+
+    def schedule_crash(self, iteration, database):
+        if iteration not in self.crashes:
+            return
+        after, reason = self.crashes[iteration]
+
+        def crash():
+            if reason not in WARNINGS:
+                database.crash()
+            signal_crash(self.db, reason, "simulated")
+        self.clock.call_later(after, crash)
+
+    def better(self, value, best):
+        if best is None:
+            return True
+        return value > best if self.db.OPTIMIZATION_OBJECTIVE == "throughput" else value < best
+
+
+def parse_event(value):
+    """iteration:seconds[:reason]"""
+    parts = value.split(":")
+    return int(parts[0]), float(parts[1]), parts[2] if len(parts) > 2 else "simulated_crash"
+
+
+def parse_failure(value):
+    """iteration:seconds:pattern[:count]"""
+    parts = value.split(":")
+    return int(parts[0]), float(parts[1]), parts[2], int(parts[3]) if len(parts) > 3 else 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a tuning session against a simulated postgres on a virtual clock")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--interval", type=float, default=1, help="stats sampling interval in simulated seconds")
+    parser.add_argument("--trace", action="append", help="recorded trace to replay, once per configuration in turn")
+    parser.add_argument("--settings", default="{}", help="JSON tuning session settings, e.g. WARMUP_MODE or optimization_target")
+    parser.add_argument("--crash", action="append", default=[], help="iteration:seconds[:reason] to signal a crash at")
+    parser.add_argument("--fail-query", action="append", default=[], help="iteration:seconds:pattern[:count] to fail the next count queries containing pattern from")
+    parser.add_argument("--abort", help="iteration:seconds to abort the session at")
+    parser.add_argument("--output", help="write the results to this JSON file instead of standard output")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.WARNING)
+    model = ReplayModel([Trace.load(path) for path in args.trace]) if args.trace else SyntheticModel(seed=args.seed)
+    crashes = {iteration: (after, reason) for iteration, after, reason in map(parse_event, args.crash)}
+    abort = parse_event(args.abort)[:2] if args.abort else None
+    failures = {iteration: (after, pattern, count) for iteration, after, pattern, count in map(parse_failure, args.fail_query)}
+    simulation = Simulation(model, generate_iterations(args.iterations, args.seed), json.loads(args.settings), args.interval, crashes, abort, failures)
+    result = simulation.run()
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2, default=str)
+    else:
+        json.dump(result, sys.stdout, indent=2, default=str)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+import heapq
+import itertools
+
+# 2023-11-14, any fixed instant keeps simulated timestamps reproducible
+EPOCH = 1700000000.0
+
+
+class VirtualClock:
+    """Discrete event clock for running the tuning loop without waiting in real time.
+
+    Sleeping or waiting doesn't block, it runs the scheduled events that fall due in
+    the meantime (stats ticks, injected crashes, aborts) and jumps straight to the
+    end. Everything runs on the calling thread.
+    """
+
+    def __init__(self, epoch=EPOCH):
+        self.now = 0.0
+        self.epoch = epoch
+        self.events = []
+        self.sequence = itertools.count()
+
+    def time(self):
+        return self.epoch + self.now
+
+    def monotonic(self):
+        return self.now
+
+    def call_at(self, at, callback, interval=None):
+        heapq.heappush(self.events, (at, next(self.sequence), callback, interval))
+
+    def call_later(self, delay, callback):
+        self.call_at(self.now + delay, callback)
+
+    def call_every(self, interval, callback):
+        self.call_at(self.now + interval, callback, interval)
+
+    def run_until(self, deadline, stop=None):
+        """Runs the events due up to deadline, returns True when stop() became true first."""
+        while self.events and self.events[0][0] <= deadline:
+            at, _, callback, interval = heapq.heappop(self.events)
+            self.now = max(self.now, at)
+            if interval:
+                self.call_at(at + interval, callback, interval)
+            callback()
+            if stop is not None and stop():
+                return True
+        self.now = max(self.now, deadline)
+        return False
+
+    def sleep(self, seconds):
+        self.run_until(self.now + seconds)
+
+    def condition(self):
+        return VirtualCondition(self)
+
+
+class VirtualCondition:
+    """Stand-in for threading.Condition on a VirtualClock, waits end when notified or timed out."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.notified = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def wait(self, timeout):
+        self.notified = False
+        notified = self.clock.run_until(self.clock.now + max(timeout, 0), lambda: self.notified)
+        self.notified = False
+        return notified
+
+    def notify_all(self):
+        self.notified = True
+
+    notify = notify_all
@@ -0,0 +1,138 @@
+import os
+import time
+import logging
+
+DISKSTATS_PATH = "/proc/diskstats"
+SYS_BLOCK_PATH = "/sys/block"
+SECTOR_KB = 0.5
+
+# Column order of the per-device counters in /proc/diskstats, after major, minor and name
+DISKSTATS_FIELDS = ["reads", "reads_merged", "sectors_read", "ms_reading",
+                    "writes", "writes_merged", "sectors_written", "ms_writing",
+                    "in_flight", "ms_io", "ms_weighted",
+                    "discards", "discards_merged", "sectors_discarded", "ms_discarding",
+                    "flushes", "ms_flushing"]
+
+
+def device_number(path):
+    st_dev = os.stat(path).st_dev
+    if os.major(st_dev) == 0:
+        # btrfs, overlay and other filesystems hand out anonymous device numbers,
+        # fall back to the block device the mount was made from
+        source = mount_source(path)
+        if source and os.path.exists(source):
+            return os.stat(source).st_rdev
+    return st_dev
+
+
+def mount_source(path):
+    path = os.path.realpath(path)
+    best_mount, best_source = "", None
+    with open("/proc/self/mountinfo") as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            mount_point = fields[4]
+            source = fields[fields.index("-") + 2]
+            if (path == mount_point or path.startswith(mount_point.rstrip("/") + "/")) and len(mount_point) >= len(best_mount):
+                best_mount, best_source = mount_point, source
+    return best_source
+
+
+def block_device_name(dev):
+    link = "/sys/dev/block/{}:{}".format(os.major(dev), os.minor(dev))
+    return os.path.basename(os.path.realpath(link))
+
+
+def backing_devices(name):
+    # dm (LVM, dm-crypt) and md devices list the devices they sit on under slaves/
+    slaves_dir = os.path.join(SYS_BLOCK_PATH, name, "slaves")
+    if os.path.isdir(slaves_dir) and os.listdir(slaves_dir):
+        devices = []
+        for slave in sorted(os.listdir(slaves_dir)):
+            devices.extend(backing_devices(slave))
+        return devices
+    return [name]
+
+
+def rotational(name):
+    # partitions have no queue of their own, the disk they are on has
+    path = os.path.realpath(os.path.join("/sys/class/block", name))
+    if not os.path.isdir(os.path.join(path, "queue")):
+        path = os.path.dirname(path)
+    with open(os.path.join(path, "queue", "rotational")) as flag:
+        return flag.read().strip() == "1"
+
+
+def physical_devices():
+    return sorted(name for name in os.listdir(SYS_BLOCK_PATH) if os.path.exists(os.path.join(SYS_BLOCK_PATH, name, "device")))
+
+
+def read_diskstats(devices):
+    counters = {}
+    with open(DISKSTATS_PATH) as diskstats:
+        for line in diskstats:
+            fields = line.split()
+            if fields[2] in devices:
+                values = [int(value) for value in fields[3:]]
+                values += [0] * (len(DISKSTATS_FIELDS) - len(values))
+                counters[fields[2]] = dict(zip(DISKSTATS_FIELDS, values))
+    return counters
+
+
+class DiskSampler:
+    """Computes iostat -x style disk metrics from /proc/diskstats deltas without blocking."""
+
+    def __init__(self, path):
+        self.devices = self.resolve_devices(path)
+        logging.info("Monitoring disk activity of {} on {}".format(path, ", ".join(self.devices)))
+        self.previous = read_diskstats(self.devices)
+        self.previous_time = time.monotonic()
+
+    @staticmethod
+    def resolve_devices(path):
+        try:
+            return backing_devices(block_device_name(device_number(path)))
+        except OSError as err:
+            logging.warning("Couldn't resolve the block device of {} ({}), monitoring all disks".format(path, err))
+            return physical_devices()
+
+    def sample(self):
+        current = read_diskstats(self.devices)
+        now = time.monotonic()
+        elapsed = now - self.previous_time
+        delta = dict.fromkeys(DISKSTATS_FIELDS, 0)
+        util_ms = 0
+        for device, counters in current.items():
+            if device not in self.previous:
+                continue
+            for field in DISKSTATS_FIELDS:
+                delta[field] += max(counters[field] - self.previous[device][field], 0)
+            # devices are busy in parallel, so %util is the busiest one rather than the sum
+            util_ms = max(util_ms, counters["ms_io"] - self.previous[device]["ms_io"])
+        self.previous, self.previous_time = current, now
+        return self.compute(delta, util_ms, elapsed)
+
+    def compute(self, delta, util_ms, elapsed):
+        def rate(value):
+            return value / elapsed if elapsed > 0 else 0.0
+
+        def ratio(value, count):
+            return value / count if count else 0.0
+
+        stats = {"Device": "+".join(self.devices)}
+        for prefix, ios, merged, sectors, ms in (("r", "reads", "reads_merged", "sectors_read", "ms_reading"),
+                                                  ("w", "writes", "writes_merged", "sectors_written", "ms_writing"),
+                                                  ("d", "discards", "discards_merged", "sectors_discarded", "ms_discarding")):
+            stats[prefix + "/s"] = rate(delta[ios])
+            stats[prefix + "kB/s"] = rate(delta[sectors] * SECTOR_KB)
+            stats[prefix + "rqm/s"] = rate(delta[merged])
+            stats["%" + prefix + "rqm"] = 100 * ratio(delta[merged], delta[merged] + delta[ios])
+            stats[prefix + "_await"] = ratio(delta[ms], delta[ios])
+            stats[prefix + "areq-sz"] = ratio(delta[sectors] * SECTOR_KB, delta[ios])
+        stats["f/s"] = rate(delta["flushes"])
+        stats["f_await"] = ratio(delta["ms_flushing"], delta["flushes"])
+        stats["await"] = ratio(delta["ms_reading"] + delta["ms_writing"], delta["reads"] + delta["writes"])
+        stats["aqu-sz"] = rate(delta["ms_weighted"] / 1000)
+        stats["%util"] = min(100.0, 100 * rate(util_ms / 1000))
+        stats["iops"] = stats["r/s"] + stats["w/s"]
+        return stats
@@ -0,0 +1,16 @@
+import psutil
+from stats.disk_stats import DiskSampler
+
+
+class HostSampler:
+    """Disk, memory and CPU utilisation of the host postgres runs on."""
+
+    def __init__(self, path):
+        self.disk_sampler = DiskSampler(path)
+
+    def sample(self):
+        return {
+            "io": self.disk_sampler.sample(),
+            "mem": psutil.virtual_memory()._asdict(),
+            "cpu": {"cpu_util": psutil.cpu_percent()},
+        }
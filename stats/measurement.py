@@ -0,0 +1,98 @@
+import math
+from statistics import NormalDist
+import numpy as np
+
+CONFIDENCE = 0.95
+RELATIVE_PRECISION = 0.02
+MIN_BATCHES = 10
+MAX_BATCHES = 30
+# batch means further apart than this are treated as independent
+MAX_BATCH_AUTOCORRELATION = 0.2
+
+# stop reasons reported with the performance
+PRECISE = "precise"
+WORSE = "worse_than_best"
+MAX_DURATION = "max_duration"
+
+
+def t_quantile(p, df):
+    """Student t quantile from the normal one (Cornish-Fisher expansion), within 1% for df >= 5."""
+    z = NormalDist().inv_cdf(p)
+    return (z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+            + (3 * z ** 7 + 19 * z ** 5 + 17 * z ** 3 - 15 * z) / (384 * df ** 3))
+
+
+def lag1_autocorrelation(values):
+    centered = values - values.mean()
+    variance = np.dot(centered, centered)
+    if variance == 0:
+        return 0.0
+    return float(np.dot(centered[:-1], centered[1:]) / variance)
+
+
+class MeasurementWindow:
+    """Per second samples of the optimization objective and when they are enough to stop measuring.
+
+    Consecutive samples are autocorrelated, so the confidence interval is built from
+    the means of contiguous batches of samples (batch means), made longer until the
+    batch means themselves no longer look correlated.
+    """
+
+    def __init__(self, higher_is_better=True, confidence=CONFIDENCE, relative_precision=RELATIVE_PRECISION):
+        self.higher_is_better = higher_is_better
+        self.confidence = confidence
+        self.relative_precision = relative_precision
+        self.samples = []
+        self.stop_reason = None
+
+    def add(self, value):
+        self.samples.append(value)
+
+    def batch_means(self):
+        samples = np.asarray(self.samples, dtype=np.float64)
+        batches = MAX_BATCHES
+        while batches >= MIN_BATCHES:
+            size = len(samples) // batches
+            if size >= 2:
+                # the oldest samples are the ones left out when the batches don't divide them evenly
+                means = samples[len(samples) - batches * size:].reshape(batches, size).mean(axis=1)
+                if lag1_autocorrelation(means) <= MAX_BATCH_AUTOCORRELATION:
+                    return means
+            batches = batches * 2 // 3
+        return None
+
+    def interval(self):
+        """Mean and half width of the confidence interval, None while the samples can't support one."""
+        means = self.batch_means()
+        if means is None:
+            return None
+        half_width = t_quantile(0.5 + self.confidence / 2, len(means) - 1) * means.std(ddof=1) / math.sqrt(len(means))
+        return float(means.mean()), float(half_width)
+
+    def decision(self, best_performance=None):
+        interval = self.interval()
+        if interval is None:
+            return None
+        mean, half_width = interval
+        if best_performance:
+            if self.higher_is_better and mean + half_width < best_performance:
+                return WORSE
+            if not self.higher_is_better and mean - half_width > best_performance:
+                return WORSE
+        if half_width <= self.relative_precision * abs(mean):
+            return PRECISE
+        return None
+
+    def report(self, duration):
+        report = {
+            "measurement_duration": duration,
+            "measurement_samples": len(self.samples),
+            "measurement_stop_reason": self.stop_reason,
+            "confidence_level": self.confidence,
+        }
+        interval = self.interval()
+        if interval is not None:
+            mean, half_width = interval
+            report["confidence_interval"] = [mean - half_width, mean + half_width]
+            report["relative_half_width"] = half_width / abs(mean) if mean else None
+        return report
@@ -0,0 +1,94 @@
+import numpy as np
+
+KEY_DTYPE = np.dtype((np.void, 16))
+
+
+def pack_keys(userid, dbid, queryid):
+    keys = np.empty((len(queryid), 2), dtype=np.int64)
+    keys[:, 0] = (np.asarray(userid, dtype=np.int64) << 32) | np.asarray(dbid, dtype=np.int64)
+    keys[:, 1] = queryid
+    # one opaque 16 byte value per entry so a single sorted merge matches all three columns
+    return keys.view(KEY_DTYPE).ravel()
+
+
+def contains(sorted_keys, keys):
+    if len(sorted_keys) == 0:
+        return np.zeros(len(keys), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[index] == keys
+
+
+class QueryStats:
+    """pg_stat_statements counters held as arrays aligned on (userid, dbid, queryid)."""
+
+    def __init__(self, keys, calls, total_exec_time, sum_sq_exec_time=None, min_exec_time=None, max_exec_time=None, reset_at=None):
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.calls = np.asarray(calls, dtype=np.int64)[order]
+        self.total_exec_time = np.asarray(total_exec_time, dtype=np.float64)[order]
+        # sum of squared execution times, rebuilt from stddev and mean, for per interval variance
+        self.sum_sq_exec_time = self.column(sum_sq_exec_time, 0.0)[order]
+        self.min_exec_time = self.column(min_exec_time, 0.0)[order]
+        self.max_exec_time = self.column(max_exec_time, np.inf)[order]
+        # pg_stat_statements_info.stats_reset, when the server reports it
+        self.reset_at = reset_at
+
+    def column(self, values, default):
+        if values is None:
+            return np.full(len(self.calls), default, dtype=np.float64)
+        return np.asarray(values, dtype=np.float64)
+
+    @classmethod
+    def from_columns(cls, userid, dbid, queryid, calls, total_exec_time, sum_sq_exec_time=None, min_exec_time=None, max_exec_time=None, reset_at=None):
+        return cls(pack_keys(userid, dbid, queryid), calls, total_exec_time, sum_sq_exec_time, min_exec_time, max_exec_time, reset_at)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0, dtype=KEY_DTYPE), [], [])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def merge(self, changed, removed_keys, reset_at=None):
+        """A new image of the view with changed entries replaced and removed entries dropped."""
+        dropped = contains(changed.keys, self.keys) | contains(np.sort(removed_keys), self.keys)
+        kept = ~dropped
+        return QueryStats(*(np.concatenate((getattr(self, name)[kept], getattr(changed, name)))
+                            for name in ("keys", "calls", "total_exec_time", "sum_sq_exec_time", "min_exec_time", "max_exec_time")),
+                          reset_at=reset_at)
+
+    def delta(self, start):
+        """Per entry calls, execution time and squared execution time accumulated since start, aligned with self."""
+        calls = self.calls.copy()
+        total_exec_time = self.total_exec_time.copy()
+        sum_sq_exec_time = self.sum_sq_exec_time.copy()
+        if len(start) == 0 or start.reset_at != self.reset_at:
+            # everything was counted again from zero after pg_stat_statements_reset()
+            return calls, total_exec_time, sum_sq_exec_time
+        start_index = np.minimum(np.searchsorted(start.keys, self.keys), len(start) - 1)
+        # entries missing from start are new, entries only in start were evicted and are ignored;
+        # an entry whose counter went backwards was deallocated and counted again from zero
+        matched = (start.keys[start_index] == self.keys) & (self.calls >= start.calls[start_index])
+        end_index, start_index = np.nonzero(matched)[0], start_index[matched]
+        calls[end_index] -= start.calls[start_index]
+        total_exec_time[end_index] -= start.total_exec_time[start_index]
+        sum_sq_exec_time[end_index] -= start.sum_sq_exec_time[start_index]
+        return calls, total_exec_time, sum_sq_exec_time
+
+    def mean_latency(self, start):
+        calls, total_exec_time, _ = self.delta(start)
+        total_calls = calls.sum()
+        if total_calls <= 0:
+            return 0.0
+        mean_exec_times = np.divide(total_exec_time, calls, out=np.zeros_like(total_exec_time), where=calls > 0)
+        return float(np.sum(calls / total_calls * mean_exec_times))
+
+    def interval_moments(self, start):
+        """Calls, mean, stddev, min and max of the executions of each entry that ran since start."""
+        calls, total_exec_time, sum_sq_exec_time = self.delta(start)
+        active = calls > 0
+        calls = calls[active].astype(np.float64)
+        mean = total_exec_time[active] / calls
+        # cancellation in the difference of two large sums can push the variance slightly negative
+        stddev = np.sqrt(np.maximum(sum_sq_exec_time[active] / calls - mean ** 2, 0))
+        return calls, mean, stddev, self.min_exec_time[active], self.max_exec_time[active]
@@ -0,0 +1,77 @@
+import math
+import numpy as np
+
+RELATIVE_ACCURACY = 0.01
+MAX_BINS = 2048
+MIN_VALUE = 1e-9
+# probabilists' Gauss-Hermite nodes and weights, they sum to 1
+HERMITE_NODES = (-2.856970013872806, -1.355626179974266, 0.0, 1.355626179974266, 2.856970013872806)
+HERMITE_WEIGHTS = (0.011257411327721, 0.222075922005613, 0.533333333333333, 0.222075922005613, 0.011257411327721)
+
+
+class DDSketch:
+    """Mergeable quantile sketch with bounded relative error (Masson et al., VLDB 2019).
+
+    Values are counted in logarithmic bins, so memory depends on the value range
+    rather than on the number of values. Past max_bins the lowest bins are
+    collapsed together, which keeps the upper quantiles accurate.
+    """
+
+    def __init__(self, relative_accuracy=RELATIVE_ACCURACY, max_bins=MAX_BINS):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.zero_count = 0.0
+        self.count = 0.0
+
+    def add(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones_like(values) if weights is None else np.asarray(weights, dtype=np.float64)
+        positive = values > MIN_VALUE
+        self.zero_count += float(weights[~positive].sum())
+        keys = np.ceil(np.log(values[positive]) / self.log_gamma).astype(np.int64)
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
+        for key, weight in zip(unique_keys.tolist(), np.bincount(inverse, weights=weights[positive]).tolist()):
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+        self.count += float(weights.sum())
+        self.collapse()
+
+    def add_distributions(self, calls, mean, stddev, minimum, maximum):
+        # Each query's executions in an interval are only known by their moments, so they are
+        # represented by the 5 point Gauss-Hermite rule of a normal with the same mean and
+        # variance, clipped to the range the query has ever run in.
+        values = [np.clip(mean + node * stddev, minimum, maximum) for node in HERMITE_NODES]
+        weights = [calls * weight for weight in HERMITE_WEIGHTS]
+        self.add(np.concatenate(values), np.concatenate(weights))
+
+    def merge(self, other):
+        for key, weight in other.bins.items():
+            self.bins[key] = self.bins.get(key, 0.0) + weight
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.collapse()
+
+    def collapse(self):
+        if len(self.bins) <= self.max_bins:
+            return
+        keys = sorted(self.bins)
+        excess = keys[:len(keys) - self.max_bins + 1]
+        self.bins[excess[-1]] = sum(self.bins.pop(key) for key in excess[:-1]) + self.bins[excess[-1]]
+
+    def quantile(self, q):
+        if self.count <= 0:
+            return 0.0
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.bins):
+            seen += self.bins[key]
+            if seen > rank:
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.bins) / (self.gamma + 1)
+
+    def percentiles(self, prefix, quantiles=(50, 95, 99)):
+        return {"{}_p{}".format(prefix, q): self.quantile(q / 100) for q in quantiles}
@@ -1,79 +1,79 @@
-import math
 import time
 import logging
-import psutil
-import datetime
-import os
-from _thread import interrupt_main
-from threading import Thread
-import subprocess
+import asyncio
+from stats.uploader import StatsUploader
+from instrumentation import instrumentation
 
 
-def shell_command(command):
-    p1 = subprocess.Popen([command],stdout=subprocess.PIPE, stderr=subprocess.STDOUT, shell=True)
-    command_output, _ = p1.communicate()
-    command_output = command_output.decode('ascii')
-    return command_output
-
 class Stats:
-    def __init__(self, job, db):
+    def __init__(self, job, db, runtime, interval=1, store=None):
         #Default config
         self.job = job
-        self.thread = None
+        self.interval = interval
+        # keeps every sample locally as well, see stats.timeseries
+        self.store = store
+        self.runtime = runtime
+        self.uploader = StatsUploader(job, self.handle_response, runtime)
+        self.stop_event = asyncio.Event()
+        self.missed_ticks = 0
         self.db = db
         self.check_state = None
         self.abort_type = None
         self.user_selected_configuration = None
         self.stats = None
-        self.pg_isready_path = self.db.PG_ISREADY_PATH
-        self.pg_port = self.db.PG_PORT
-        self.start_commit_monitoring = self.db.get_xact_commit()
-        self.start_time_monitoring = time.time()
-        if self.db.PG_STATS_STATEMENTS_ENABLE:
-            self.start_query_stats_monitoring = self.db.get_pg_queries_statistics()
-
-    def get_connect(self):
-        self.pg_port
-        p1 = subprocess.Popen([self.pg_isready_path, "-h", "localhost", "-p", str(self.pg_port)],stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        command_output, _ = p1.communicate()
-        logging.debug(command_output.decode('ascii').strip())
-        return p1.returncode
+        # taken off the event loop once run() starts
+        self.start_snapshot = None
 
-    def get_timestamp(self):
-        x = datetime.datetime.now()
-        return x.strftime("%Y-%m-%d %H:%M:%S.%f")
+    def stop(self):
+        self.stop_event.set()
 
-    def run(self):
-        if self.check_state == 'aborted':
-            if self.user_selected_configuration:
-                self.db.abort_optimization(abort_type=self.abort_type, user_selected_configuration=self.user_selected_configuration)
-            else:
-                self.db.abort_optimization(abort_type=self.abort_type)
-        logging.debug("Stats running")
+    async def run(self):
+        uploader = asyncio.ensure_future(self.uploader.run())
         try:
-            self.stats, self.start_commit_monitoring, self.start_time_monitoring, self.start_query_stats_monitoring = self.db.get_metric_stats_monitoring(self.start_commit_monitoring, self.start_time_monitoring, self.start_query_stats_monitoring)
-        except:
-            time.sleep(0.1)
-        self.thread = Thread(target=self.flush)
-        self.thread.daemon = True
-        self.thread.start()
+            self.start_snapshot = await self.runtime.blocking(self.db.get_snapshot)
+            await self.sample_loop()
+        finally:
+            self.uploader.stop()
+            await uploader
+            if self.store is not None:
+                self.store.flush()
+            logging.debug("Stats stopped")
 
+    async def sample_loop(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.interval
+            try:
+                await asyncio.wait_for(self.stop_event.wait(), max(next_tick - loop.time(), 0))
+                return
+            except asyncio.TimeoutError:
+                pass
+            lag = loop.time() - next_tick
+            if lag >= self.interval:
+                # keep the original phase instead of bursting to catch up
+                missed = int(lag // self.interval)
+                next_tick += missed * self.interval
+                self.missed_ticks += missed
+                instrumentation.count("stats_missed_ticks", missed)
+                logging.warning("Stats: sampling fell behind, skipped {} tick(s) ({} in total)".format(missed, self.missed_ticks))
+            try:
+                with instrumentation.timer("stats_sample"):
+                    self.stats, self.start_snapshot = await self.runtime.blocking(self.db.get_metric_stats_monitoring, self.start_snapshot)
+            except Exception:
+                logging.exception("Stats: sampling failed")
+                continue
+            self.uploader.submit(self.stats)
+            if self.store is not None:
+                self.store.append(self.stats, time.time(), self.db.ITERATION)
 
-
-    def abort(self):
-        if self.thread is not None:
-            self.thread.join()
-            logging.debug("Stats aborted")
-
-    def flush(self):
+    def handle_response(self, check_state_data):
         try:
-            logging.debug("Stats flushing")
-            self.run()
-            self.check_state_data = self.job.post_stats(self.stats)
-            self.check_state = self.check_state_data["tuning_session_state"]
-            self.abort_type = self.check_state_data["abort_tuning_type"]
-            self.user_selected_configuration = self.check_state_data["applied_config_on_abort"]
-            self.stats = None
-        except:
-            time.sleep(0.1)
-            self.run()
\ No newline at end of file
+            self.check_state = check_state_data["tuning_session_state"]
+            self.abort_type = check_state_data["abort_tuning_type"]
+            self.user_selected_configuration = check_state_data["applied_config_on_abort"]
+        except (KeyError, TypeError):
+            logging.debug("Stats: unexpected response {}".format(check_state_data))
+            return
+        if self.check_state == 'aborted':
+            self.runtime.abort(self.abort_type, self.user_selected_configuration)
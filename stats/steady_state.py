@@ -0,0 +1,67 @@
+import math
+from collections import deque
+import numpy as np
+
+WINDOW = 60
+BATCHES = 5
+# largest drift between the two halves of the window that still counts as steady,
+# relative to the mean and absolute, per series
+TOLERANCES = {
+    "throughput": (0.05, 1.0),
+    "hit_ratio": (0.0, 0.005),
+    "read_iops": (0.10, 5.0),
+}
+
+
+class SteadyStateDetector:
+    """Tells when the commit rate, buffer hit ratio and read IOPS have stopped trending.
+
+    The last WINDOW samples of each series are split in two halves. A series is
+    steady when the means of the halves differ by no more than its tolerance plus
+    twice the standard error of that difference, which is estimated from batch
+    means so that noisy but flat series aren't kept warming up forever.
+    """
+
+    def __init__(self, window=WINDOW, tolerances=TOLERANCES):
+        self.window = window
+        self.tolerances = tolerances
+        self.samples = {name: deque(maxlen=window) for name in tolerances}
+        self.count = 0
+
+    def add(self, sample):
+        self.count += 1
+        for name, values in self.samples.items():
+            value = sample.get(name)
+            values.append(np.nan if value is None else value)
+
+    def drift(self, name):
+        """Difference between the means of the two halves of the window and its standard error."""
+        values = np.asarray(self.samples[name], dtype=np.float64)
+        halves = np.array_split(values, 2)
+        if any(np.isnan(half).all() for half in halves):
+            return None
+        means = [np.nanmean(half) for half in halves]
+        variances = []
+        for half in halves:
+            batch_means = np.array([np.nanmean(batch) for batch in np.array_split(half, BATCHES) if not np.isnan(batch).all()])
+            variances.append(batch_means.var(ddof=1) / len(batch_means) if len(batch_means) > 1 else 0.0)
+        return means[1] - means[0], math.sqrt(sum(variances))
+
+    def unsteady(self):
+        """The series still trending, or None while there are fewer than a window of samples."""
+        if self.count < self.window:
+            return None
+        unsteady = []
+        for name, (relative, absolute) in self.tolerances.items():
+            drift = self.drift(name)
+            if drift is None:
+                # e.g. no block was read in the window, nothing to wait for
+                continue
+            difference, standard_error = drift
+            level = abs(np.nanmean(self.samples[name]))
+            if abs(difference) > relative * level + absolute + 2 * standard_error:
+                unsteady.append(name)
+        return unsteady
+
+    def steady(self):
+        return self.unsteady() == []
@@ -0,0 +1,127 @@
+import os
+import json
+import logging
+import numpy as np
+
+MAGIC = b"DBTUNETS"
+VERSION = 1
+HEADER_SIZE = 4096
+# records between two flushes of the mapping to disk
+FLUSH_EVERY = 60
+# column, path of the value in a sample from get_metric_stats_monitoring
+COLUMNS = [
+    ("throughput", ("db", "throughput")),
+    ("query_runtime", ("db", "query_runtime")),
+    ("query_runtime_p50", ("db", "query_runtime_p50")),
+    ("query_runtime_p95", ("db", "query_runtime_p95")),
+    ("query_runtime_p99", ("db", "query_runtime_p99")),
+    ("cpu_util", ("cpu", "cpu_util")),
+    ("mem_percent", ("mem", "percent")),
+    ("mem_available", ("mem", "available")),
+    ("reads_per_second", ("io", "r/s")),
+    ("writes_per_second", ("io", "w/s")),
+    ("read_kb_per_second", ("io", "rkB/s")),
+    ("write_kb_per_second", ("io", "wkB/s")),
+    ("await", ("io", "await")),
+    ("disk_util", ("io", "%util")),
+]
+RECORD = np.dtype([("t", "<f8"), ("iteration", "<i4")] + [(name, "<f4") for name, _ in COLUMNS])
+HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("capacity", "<u8"), ("written", "<u8"), ("layout", "S{}".format(HEADER_SIZE - 28))])
+
+
+def value_at(sample, path):
+    for key in path:
+        if not isinstance(sample, dict) or key not in sample:
+            return np.nan
+        sample = sample[key]
+    try:
+        return float(sample)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+class SampleStore:
+    """Append-only store of per second samples in a memory-mapped ring buffer.
+
+    Each sample is one fixed-width record (a timestamp, the iteration and one
+    float32 column per metric, 68 bytes), so a day of 1s samples takes under 6MB.
+    Once capacity records were written the oldest are overwritten. The file is
+    reopened as it was after a client restart, and recreated if its layout changed.
+    """
+
+    def __init__(self, path, capacity=86400):
+        self.path = path
+        self.capacity = capacity
+        layout = json.dumps(RECORD.descr).encode()
+        size = HEADER_SIZE + RECORD.itemsize * capacity
+        if not self.matches(layout, size):
+            logging.info("SampleStore: creating {} for {} samples".format(path, capacity))
+            with open(path, "wb") as store_file:
+                store_file.truncate(size)
+            self.header = np.memmap(path, dtype=HEADER, mode="r+", shape=(1,))
+            self.header[0] = (MAGIC, VERSION, capacity, 0, layout)
+        else:
+            self.header = np.memmap(path, dtype=HEADER, mode="r+", shape=(1,))
+        self.records = np.memmap(path, dtype=RECORD, mode="r+", offset=HEADER_SIZE, shape=(capacity,))
+        self.unflushed = 0
+
+    def matches(self, layout, size):
+        try:
+            if os.path.getsize(self.path) != size:
+                return False
+            header = np.fromfile(self.path, dtype=HEADER, count=1)[0]
+        except (OSError, IndexError):
+            return False
+        return header["magic"] == MAGIC and header["version"] == VERSION and header["capacity"] == self.capacity and header["layout"] == layout
+
+    @property
+    def written(self):
+        return int(self.header[0]["written"])
+
+    def __len__(self):
+        return min(self.written, self.capacity)
+
+    def append(self, sample, t, iteration=0):
+        written = self.written
+        record = self.records[written % self.capacity]
+        record["t"] = t
+        record["iteration"] = iteration
+        for name, path in COLUMNS:
+            record[name] = value_at(sample, path)
+        # the record is complete before the counter makes it visible
+        self.header[0]["written"] = written + 1
+        self.unflushed += 1
+        if self.unflushed >= FLUSH_EVERY:
+            self.flush()
+
+    def ordered(self):
+        # oldest first, a view while the buffer hasn't wrapped yet
+        written = self.written
+        if written <= self.capacity:
+            return self.records[:written]
+        head = written % self.capacity
+        return np.concatenate((self.records[head:], self.records[:head]))
+
+    def range(self, start=None, end=None, iteration=None):
+        """Records with start <= t < end, of one iteration when given, oldest first."""
+        records = self.ordered()
+        if start is not None or end is not None:
+            # samples are appended in time order
+            first = np.searchsorted(records["t"], start, side="left") if start is not None else 0
+            last = np.searchsorted(records["t"], end, side="left") if end is not None else len(records)
+            records = records[first:last]
+        if iteration is not None:
+            records = records[records["iteration"] == iteration]
+        return np.array(records)
+
+    def iterations(self):
+        return np.unique(self.ordered()["iteration"])
+
+    def flush(self):
+        self.records.flush()
+        self.header.flush()
+        self.unflushed = 0
+
+    def close(self):
+        self.flush()
+        del self.records, self.header
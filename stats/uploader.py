@@ -0,0 +1,151 @@
+import os
+import json
+import random
+import asyncio
+import logging
+from threading import Lock
+
+BATCH_SIZE = 10
+BATCH_SECONDS = 5
+QUEUE_SIZE = 600
+MAX_ATTEMPTS = 4
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 10
+SPOOL_FILE = "stats_spool.jsonl"
+SPOOL_MAX_BYTES = 64 * 1024 * 1024
+
+
+class StatsUploader:
+    """Ships stats samples to the platform in gzip batches as a task on the runtime's loop.
+
+    Samples that can't be queued or delivered are appended to a local spool file
+    and replayed once the platform answers again.
+    """
+
+    def __init__(self, job, on_response, runtime, batch_size=BATCH_SIZE, batch_seconds=BATCH_SECONDS, queue_size=QUEUE_SIZE, spool_file=SPOOL_FILE):
+        self.job = job
+        self.on_response = on_response
+        self.runtime = runtime
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.spool_file = spool_file
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.spool_lock = Lock()
+        self.stop_event = asyncio.Event()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def submit(self, sample):
+        # never hold up the sampler, a full queue means the platform is behind
+        try:
+            self.queue.put_nowait(sample)
+        except asyncio.QueueFull:
+            self.spool([sample])
+
+    async def run(self):
+        while not self.stop_event.is_set():
+            batch = await self.next_batch()
+            if batch and await self.send(batch):
+                await self.replay_spool()
+        # flush whatever is left so a clean shutdown doesn't lose samples
+        batch = self.drain()
+        if batch and not await self.send(batch, attempts=1):
+            logging.info("Stats: {} unsent sample(s) kept in {}".format(len(batch), self.spool_file))
+        logging.debug("Stats uploader stopped")
+
+    async def get(self, timeout):
+        stopped = asyncio.ensure_future(self.stop_event.wait())
+        got = asyncio.ensure_future(self.queue.get())
+        await asyncio.wait([got, stopped], timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        stopped.cancel()
+        if got.done():
+            return got.result()
+        got.cancel()
+        return None
+
+    async def next_batch(self):
+        sample = await self.get(self.batch_seconds)
+        if sample is None:
+            return []
+        batch = [sample]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.batch_seconds
+        while len(batch) < self.batch_size:
+            remaining = deadline - loop.time()
+            if remaining <= 0 or self.stop_event.is_set():
+                break
+            sample = await self.get(remaining)
+            if sample is None:
+                break
+            batch.append(sample)
+        return batch
+
+    def drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except asyncio.QueueEmpty:
+                return batch
+
+    async def send(self, batch, attempts=MAX_ATTEMPTS):
+        for attempt in range(attempts):
+            try:
+                response = await self.runtime.blocking(self.job.post_stats_batch, batch)
+            except Exception as err:
+                logging.warning("Stats: uploading {} sample(s) failed: {}".format(len(batch), err))
+            else:
+                if response is not None:
+                    self.on_response(response)
+                return True
+            if attempt + 1 < attempts:
+                # full jitter so many clients don't retry in lockstep
+                delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+                try:
+                    await asyncio.wait_for(self.stop_event.wait(), delay)
+                    break
+                except asyncio.TimeoutError:
+                    pass
+        self.spool(batch)
+        return False
+
+    def spool(self, samples):
+        with self.spool_lock:
+            try:
+                if os.path.exists(self.spool_file) and os.path.getsize(self.spool_file) > SPOOL_MAX_BYTES:
+                    logging.warning("Stats: spool file {} is full, dropping {} sample(s)".format(self.spool_file, len(samples)))
+                    return
+                with open(self.spool_file, "a") as spool_file:
+                    for sample in samples:
+                        spool_file.write(json.dumps(sample) + "\n")
+            except OSError as err:
+                logging.error("Stats: couldn't spool samples to {}: {}".format(self.spool_file, err))
+
+    async def replay_spool(self):
+        replay_file = self.spool_file + ".replay"
+        with self.spool_lock:
+            # a replay the client didn't finish before it stopped goes first, the spool waits for the next one
+            if not os.path.exists(replay_file):
+                if not os.path.exists(self.spool_file):
+                    return
+                os.replace(self.spool_file, replay_file)
+        logging.info("Stats: replaying spooled samples from {}".format(replay_file))
+        delivered = True
+        with open(replay_file) as spool_file:
+            batch = []
+            for line in spool_file:
+                batch.append(json.loads(line))
+                if len(batch) == self.batch_size:
+                    delivered = await self.replay_batch(batch, delivered)
+                    batch = []
+            if batch:
+                await self.replay_batch(batch, delivered)
+        os.remove(replay_file)
+
+    async def replay_batch(self, batch, delivered):
+        # once the platform stops answering, put the rest straight back in the spool
+        if delivered:
+            return await self.send(batch, attempts=1)
+        self.spool(batch)
+        return False
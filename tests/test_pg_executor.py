@@ -0,0 +1,80 @@
+import os
+import shlex
+import shutil
+import unittest
+from pg_executor import PsqlSession, QueryError, parse_unaligned
+
+SEPARATOR = "\x1e5f0c\x1e"
+# psql's unaligned output with \pset fieldsep_zero, the record separator above and \pset null '\001':
+# the header, a separator before every row and a newline after the last record
+SELECT_OUTPUT = "name\0setting\0unit" + SEPARATOR + "shared_buffers\x0016384\x008kB" + SEPARATOR + "work_mem\x004096\0\x01\n"
+SHOW_OUTPUT = "server_version" + SEPARATOR + "16.2 (Ubuntu 16.2-1.pgdg22.04+1)\n"
+EMPTY_OUTPUT = "name\0setting\n"
+MULTILINE_OUTPUT = "query\0calls" + SEPARATOR + "SELECT 1\nFROM t\n\x001" + SEPARATOR + "\x002\n"
+
+
+class ParseUnalignedTest(unittest.TestCase):
+    def test_select(self):
+        rows = parse_unaligned(SELECT_OUTPUT.encode(), SEPARATOR, (str, int))
+        self.assertEqual(rows, [("shared_buffers", 16384, "8kB"), ("work_mem", 4096, None)])
+        self.assertEqual(rows[0].unit, "8kB")
+
+    def test_show(self):
+        # SHOW leaves ROW_COUNT at 0, the width comes from the header alone
+        self.assertEqual(parse_unaligned(SHOW_OUTPUT.encode(), SEPARATOR), [("16.2 (Ubuntu 16.2-1.pgdg22.04+1)",)])
+
+    def test_empty_result(self):
+        self.assertEqual(parse_unaligned(EMPTY_OUTPUT.encode(), SEPARATOR), [])
+
+    def test_no_output(self):
+        self.assertEqual(parse_unaligned(b"", SEPARATOR), [])
+
+    def test_values_with_newlines(self):
+        rows = parse_unaligned(MULTILINE_OUTPUT.encode(), SEPARATOR, (str, int))
+        self.assertEqual(rows, [("SELECT 1\nFROM t\n", 1), ("", 2)])
+
+    def test_row_of_the_wrong_width(self):
+        with self.assertRaises(QueryError):
+            parse_unaligned(("a\0b" + SEPARATOR + "1\n").encode(), SEPARATOR)
+
+
+@unittest.skipUnless(os.environ.get("DBTUNE_TEST_PSQL"), "set DBTUNE_TEST_PSQL to a psql command line, e.g. 'psql -d postgres'")
+class PsqlSessionTest(unittest.TestCase):
+    """The same cases against the output of a real psql."""
+
+    def setUp(self):
+        command = shlex.split(os.environ["DBTUNE_TEST_PSQL"])
+        if not shutil.which(command[0]):
+            self.skipTest("{} not found".format(command[0]))
+        self.session = PsqlSession(command + ["-X", "-q", "-v", "ON_ERROR_STOP=0"], timeout=30)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_select(self):
+        rows = self.session.query("SELECT * FROM (VALUES ('a', 1, NULL), ('', 2, 'x')) AS t(name, number, note)", (str, int))
+        self.assertEqual(rows, [("a", 1, None), ("", 2, "x")])
+
+    def test_show(self):
+        version = self.session.query("SHOW server_version")
+        self.assertEqual(len(version), 1)
+        self.assertEqual(self.session.query("SELECT current_setting('server_version')"), version)
+
+    def test_empty_result(self):
+        self.assertEqual(self.session.query("SELECT name FROM pg_settings WHERE false"), [])
+
+    def test_values_with_newlines(self):
+        self.assertEqual(self.session.query("SELECT E'a\\nb\\n' AS text, 1 AS number", (str, int)), [("a\nb\n", 1)])
+
+    def test_statement_without_rows(self):
+        self.assertEqual(self.session.query("SET application_name = 'dbtune_test'"), [])
+
+    def test_error(self):
+        with self.assertRaises(QueryError) as raised:
+            self.session.query("SELECT * FROM dbtune_missing_table")
+        self.assertEqual(raised.exception.sqlstate, "42P01")
+        self.assertEqual(self.session.query("SELECT 1 AS one", (int,)), [(1,)])
+
+
+if __name__ == "__main__":
+    unittest.main()
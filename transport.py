@@ -0,0 +1,86 @@
+import time
+import random
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import HTTPError, ConnectionError, ConnectTimeout, Timeout, RequestException
+from instrumentation import instrumentation
+
+# (connect, read) timeouts in seconds per endpoint
+TIMEOUTS = {
+    "default": (3.05, 30),
+    "stats": (3.05, 10),
+    "request": (3.05, 60),
+    "response": (3.05, 60),
+}
+RETRY_STATUS = {429, 500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+class Transport:
+    """One pooled keep-alive session for every call the client makes to the platform."""
+
+    def __init__(self, api_key, retries=3, backoff=0.5, backoff_cap=30, timeouts=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_cap = backoff_cap
+        self.timeouts = dict(TIMEOUTS, **(timeouts or {}))
+        self.session = requests.Session()
+        self.session.headers.update({'X-HYPER-API-KEY': api_key})
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=4)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, endpoint="default", idempotent=None, **kwargs):
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault("timeout", self.timeouts.get(endpoint, self.timeouts["default"]))
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+                response.raise_for_status()
+            except RequestException as err:
+                self.record(endpoint, time.monotonic() - start, failed=True)
+                if attempt >= self.retries or not self.retryable(err, idempotent):
+                    raise
+                attempt += 1
+                delay = random.uniform(0, min(self.backoff_cap, self.backoff * 2 ** attempt))
+                logging.debug("Transport: {} {} failed ({}), retry {} in {:.2f}s".format(method, endpoint, err, attempt, delay))
+                time.sleep(delay)
+            else:
+                self.record(endpoint, time.monotonic() - start)
+                return response
+
+    def call(self, method, url, endpoint="default", **kwargs):
+        try:
+            response = self.request(method, url, endpoint, **kwargs)
+        except HTTPError as http_err:
+            logging.error(f'HTTP error occurred: {http_err}')
+        except Exception as err:
+            logging.exception(f'Other error occurred: {err}')
+        else:
+            return response.json() if response.content else None
+
+    def get(self, url, endpoint="default", **kwargs):
+        return self.call("GET", url, endpoint, **kwargs)
+
+    def post(self, url, endpoint="default", **kwargs):
+        return self.call("POST", url, endpoint, **kwargs)
+
+    @staticmethod
+    def retryable(err, idempotent):
+        if isinstance(err, ConnectTimeout):
+            # the request never reached the server, so retrying can't duplicate it
+            return True
+        if isinstance(err, (ConnectionError, Timeout)):
+            return idempotent
+        if isinstance(err, HTTPError):
+            return idempotent and err.response is not None and err.response.status_code in RETRY_STATUS
+        return False
+
+    def record(self, endpoint, elapsed, failed=False):
+        instrumentation.observe("http_request", elapsed, endpoint=endpoint)
+        if failed:
+            instrumentation.count("http_errors", endpoint=endpoint)